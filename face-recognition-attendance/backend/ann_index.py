@@ -0,0 +1,159 @@
+import numpy as np
+
+
+# Never train k-means on more than this many points, a random sample is representative enough
+MAX_TRAINING_POINTS = 100000
+
+# Rows per block when assigning points to centroids, bounds the temporary (block, n_lists) matrix
+ASSIGN_BLOCK_SIZE = 65536
+
+
+def _sq_distances(points, centroids, centroid_sq_norms):
+    # Squared euclidean distances between every point and every centroid, shape (len(points), len(centroids))
+    return centroid_sq_norms - 2 * (points @ centroids.T) + np.einsum('ij,ij->i', points, points)[:, None]
+
+
+def _assign(points, centroids):
+
+    """
+    Function to find the closest centroid of every point, block by block to bound memory.
+    """
+
+    centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(points), dtype=np.int64)
+
+    for start in range(0, len(points), ASSIGN_BLOCK_SIZE):
+        block = points[start:start + ASSIGN_BLOCK_SIZE]
+        labels[start:start + len(block)] = np.argmin(_sq_distances(block, centroids, centroid_sq_norms), axis=1)
+
+    return labels
+
+
+def kmeans(points, n_clusters, n_iter=10, seed=0):
+
+    """
+    Function to cluster points with Lloyd's k-means, written in NumPy.
+
+    Parameters:
+    points (numpy.ndarray): float32 matrix of shape (N, D).
+    n_clusters (int): Number of clusters.
+    n_iter (int): Number of Lloyd iterations.
+    seed (int): Seed for the initial centroids and the training sample.
+
+    Returns:
+    numpy.ndarray: float32 centroid matrix of shape (n_clusters, D).
+    """
+
+    rng = np.random.default_rng(seed)
+
+    if len(points) > MAX_TRAINING_POINTS:
+        points = points[rng.choice(len(points), MAX_TRAINING_POINTS, replace=False)]
+
+    centroids = points[rng.choice(len(points), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _assign(points, centroids)
+
+        # Mean of every cluster, summed over contiguous runs of the points sorted by cluster
+        order = np.argsort(labels, kind='stable')
+        counts = np.bincount(labels, minlength=n_clusters)
+        non_empty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+
+        # Empty clusters keep their previous centroid
+        sums = np.add.reduceat(points[order], starts, axis=0)
+        centroids[non_empty] = sums / counts[non_empty, None]
+
+    return centroids
+
+
+class IVFIndex:
+
+    """
+    Inverted file (IVF) index for approximate nearest neighbour search over face embeddings.
+
+    The embeddings are clustered with k-means and every embedding is stored in the list of its closest
+    centroid. A query only scans the lists of its `nprobe` closest centroids, so `nprobe` is the
+    recall/latency knob: 1 is the fastest, n_lists is an exact search.
+
+    Parameters:
+    n_lists (int): Number of clusters, defaults to about sqrt(N) when the index is built.
+    nprobe (int): Number of lists scanned by a query.
+    """
+
+    def __init__(self, n_lists=None, nprobe=8):
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = []
+        # List of every row, -1 for the rows not in the index (the array may be longer than the rows)
+        self.labels = np.empty(0, dtype=np.int64)
+        self._centroid_sq_norms = None
+
+    def build(self, embeddings, n_iter=10, seed=0):
+
+        """
+        Train the centroids on the embeddings and fill the inverted lists with their row numbers.
+        """
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(embeddings))))
+        n_lists = min(n_lists, len(embeddings))
+
+        self.centroids = kmeans(embeddings, n_lists, n_iter=n_iter, seed=seed)
+        self._centroid_sq_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        labels = _assign(embeddings, self.centroids)
+
+        # Group the row numbers by list with one stable sort instead of a Python loop over rows
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(n_lists + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(n_lists)]
+        self.labels = labels
+        return self
+
+    def add(self, row, embedding):
+
+        """
+        Add one embedding, stored at `row` of the embedding matrix, to the list of its closest centroid.
+
+        A row already in the index (a replaced embedding) first leaves its previous list.
+        """
+
+        label = int(_assign(np.asarray(embedding, dtype=np.float32).reshape(1, -1), self.centroids)[0])
+        self.remove([row])
+
+        if row >= len(self.labels):
+            # Grown by doubling, so appending rows one at a time stays linear
+            grown = np.full(max(row + 1, 2 * len(self.labels)), -1, dtype=np.int64)
+            grown[:len(self.labels)] = self.labels
+            self.labels = grown
+
+        self.lists[label] = np.append(self.lists[label], row)
+        self.labels[row] = label
+
+    def remove(self, rows):
+
+        """
+        Remove rows from their lists, the rows not in the index are ignored.
+        """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[rows < len(self.labels)]
+        for label in np.unique(self.labels[rows]):
+            if label >= 0:
+                self.lists[label] = self.lists[label][~np.isin(self.lists[label], rows)]
+        self.labels[rows] = -1
+
+    def candidates(self, query, nprobe=None):
+
+        """
+        Return the row numbers stored in the `nprobe` lists closest to the query.
+        """
+
+        nprobe = min(nprobe or self.nprobe, len(self.lists))
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+
+        centroid_distances = _sq_distances(query, self.centroids, self._centroid_sq_norms)[0]
+        probes = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+
+        return np.concatenate([self.lists[i] for i in probes])
@@ -6,7 +6,10 @@
 # @Software : PyCharm
 
 import os
-import traceback
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 
 import cv2
 import math
@@ -17,6 +20,8 @@ import torch.nn.functional as F
 
 from anti_spoof.src.model_lib.MiniFASNet import MiniFASNetV1, MiniFASNetV2,MiniFASNetV1SE,MiniFASNetV2SE
 from anti_spoof.src.data_io import transform as trans
+from anti_spoof.src.batch_scheduler import MicroBatcher
+from anti_spoof.src.generate_patches import CropImage
 from anti_spoof.src.utility import get_kernel, parse_model_name
 
 MODEL_MAPPING = {
@@ -27,10 +32,32 @@ MODEL_MAPPING = {
 }
 
 
+def load_model(model_path, device):
+    # define model
+    model_name = os.path.basename(model_path)
+    h_input, w_input, model_type, _ = parse_model_name(model_name)
+    kernel_size = get_kernel(h_input, w_input,)
+    model = MODEL_MAPPING[model_type](conv6_kernel=kernel_size).to(device)
+
+    # load model weight
+    state_dict = torch.load(model_path, map_location=device)
+    keys = iter(state_dict)
+    first_layer_name = keys.__next__()
+    if first_layer_name.find('module.') >= 0:
+        new_state_dict = OrderedDict()
+        for key, value in state_dict.items():
+            name_key = key[7:]
+            new_state_dict[name_key] = value
+        model.load_state_dict(new_state_dict)
+    else:
+        model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
 class Detection:
     def __init__(self):
-        stack = traceback.extract_stack()
-        dirname = os.path.dirname(stack[-2].filename)
+        dirname = os.path.dirname(os.path.abspath(__file__))
 
         caffemodel = os.path.join(dirname, '..', 'resources', 'detection_model', 'Widerface-RetinaFace.caffemodel')
         deploy = os.path.join(dirname, '..', 'resources', 'detection_model', 'deploy.prototxt')
@@ -38,23 +65,53 @@ class Detection:
         self.detector = cv2.dnn.readNetFromCaffe(deploy, caffemodel)
         self.detector_confidence = 0.6
 
-    def get_bbox(self, img):
+    def _detect(self, img, input_size):
         height, width = img.shape[0], img.shape[1]
         aspect_ratio = width / height
-        if img.shape[1] * img.shape[0] >= 192 * 192:
+        if img.shape[1] * img.shape[0] >= input_size * input_size:
             img = cv2.resize(img,
-                             (int(192 * math.sqrt(aspect_ratio)),
-                              int(192 / math.sqrt(aspect_ratio))), interpolation=cv2.INTER_LINEAR)
+                             (int(input_size * math.sqrt(aspect_ratio)),
+                              int(input_size / math.sqrt(aspect_ratio))), interpolation=cv2.INTER_LINEAR)
 
         blob = cv2.dnn.blobFromImage(img, 1, mean=(104, 117, 123))
         self.detector.setInput(blob, 'data')
-        out = self.detector.forward('detection_out').squeeze()
+        return self.detector.forward('detection_out').reshape(-1, 7)
+
+    @staticmethod
+    def _to_bbox(detection, width, height):
+        left, top, right, bottom = detection[3]*width, detection[4]*height, \
+                                   detection[5]*width, detection[6]*height
+        return [int(left), int(top), int(right-left+1), int(bottom-top+1)]
+
+    def get_bbox(self, img):
+        height, width = img.shape[0], img.shape[1]
+        out = self._detect(img, 192)
         max_conf_index = np.argmax(out[:, 2])
-        left, top, right, bottom = out[max_conf_index, 3]*width, out[max_conf_index, 4]*height, \
-                                   out[max_conf_index, 5]*width, out[max_conf_index, 6]*height
-        bbox = [int(left), int(top), int(right-left+1), int(bottom-top+1)]
+        bbox = self._to_bbox(out[max_conf_index], width, height)
         return bbox
 
+    def get_detections(self, img, input_size=192):
+        """
+        Return the ([x, y, w, h], confidence) of every face detected with at least detector_confidence, best first.
+
+        The image is scaled down to about input_size x input_size pixels before detection, group photos
+        need a larger input_size than the default one used for single faces.
+        """
+        height, width = img.shape[0], img.shape[1]
+        out = self._detect(img, input_size)
+        out = out[out[:, 2] >= self.detector_confidence]
+        out = out[np.argsort(-out[:, 2])]
+
+        detections = []
+        for detection in out:
+            # boxes can reach past the image border, clip them so crops and encodings stay inside
+            left, top = max(0., detection[3]), max(0., detection[4])
+            right, bottom = min(1., detection[5]), min(1., detection[6])
+            if right > left and bottom > top:
+                detections.append((self._to_bbox([0, 0, 0, left, top, right, bottom], width, height),
+                                   float(detection[2])))
+        return detections
+
 
 class AntiSpoofPredict(Detection):
     def __init__(self, device_id):
@@ -63,25 +120,10 @@ class AntiSpoofPredict(Detection):
                                    if torch.cuda.is_available() else "cpu")
 
     def _load_model(self, model_path):
-        # define model
         model_name = os.path.basename(model_path)
-        h_input, w_input, model_type, _ = parse_model_name(model_name)
+        h_input, w_input, _, _ = parse_model_name(model_name)
         self.kernel_size = get_kernel(h_input, w_input,)
-        self.model = MODEL_MAPPING[model_type](conv6_kernel=self.kernel_size).to(self.device)
-
-        # load model weight
-        state_dict = torch.load(model_path, map_location=self.device)
-        keys = iter(state_dict)
-        first_layer_name = keys.__next__()
-        if first_layer_name.find('module.') >= 0:
-            from collections import OrderedDict
-            new_state_dict = OrderedDict()
-            for key, value in state_dict.items():
-                name_key = key[7:]
-                new_state_dict[name_key] = value
-            self.model.load_state_dict(new_state_dict)
-        else:
-            self.model.load_state_dict(state_dict)
+        self.model = load_model(model_path, self.device)
         return None
 
     def predict(self, img, model_path):
@@ -98,13 +140,151 @@ class AntiSpoofPredict(Detection):
         return result
 
 
+class AntiSpoofEngine(Detection):
+    """
+    Long-lived anti-spoofing predictor.
+
+    The RetinaFace detector and every MiniFASNet model of model_dir are loaded once, in eval mode,
+    when the engine is created, so predict() only runs inference. predict() can be called from
+    several threads at once: the OpenCV detector is guarded by a lock and the torch models are
+    only used for gradient-free forwards.
+
+    With max_batch_size > 1 every model gets a MicroBatcher, so crops from concurrent requests
+    are classified in one batched forward per model, waiting at most max_wait_ms for the batch.
+    """
+
+    def __init__(self, model_dir, device_id=0, max_batch_size=1, max_wait_ms=5):
+        super(AntiSpoofEngine, self).__init__()
+        self.device = torch.device("cuda:{}".format(device_id)
+                                   if torch.cuda.is_available() else "cpu")
+        self.image_cropper = CropImage()
+        self._detector_lock = threading.Lock()
+
+        # (model_name, h_input, w_input, scale, model) for every model of the ensemble
+        self.models = []
+        for model_name in sorted(os.listdir(model_dir)):
+            if not model_name.endswith('.pth'):
+                continue
+            h_input, w_input, _, scale = parse_model_name(model_name)
+            model = load_model(os.path.join(model_dir, model_name), self.device)
+            self.models.append((model_name, h_input, w_input, scale, model))
+
+        # models sharing an input shape get their patches converted as one tensor
+        self.groups = OrderedDict()
+        for entry in self.models:
+            self.groups.setdefault((entry[1], entry[2]), []).append(entry)
+
+        # one batcher per model, crops of different models can not share a forward
+        self.batchers = {}
+        if max_batch_size > 1:
+            for model_name, _, _, _, model in self.models:
+                self.batchers[model_name] = MicroBatcher(self._forward_fn(model), max_batch_size,
+                                                         max_wait_ms, name=model_name)
+
+    @staticmethod
+    def _forward_fn(model):
+        def forward(img):
+            with torch.no_grad():
+                return F.softmax(model.forward(img), dim=1).cpu().numpy()
+        return forward
+
+    def get_bbox(self, img):
+        # cv2.dnn.Net keeps its input and output buffers on the object, one forward at a time
+        with self._detector_lock:
+            return super(AntiSpoofEngine, self).get_bbox(img)
+
+    def get_detections(self, img, input_size=192):
+        with self._detector_lock:
+            return super(AntiSpoofEngine, self).get_detections(img, input_size)
+
+    def crop_patches(self, image, image_bbox):
+        """
+        Crop the patch of every model and convert each input-shape group to one tensor.
+
+        Returns a list of (models, batch) pairs, where batch[i] is the input of models[i].
+        """
+        groups = []
+        for (h_input, w_input), models in self.groups.items():
+            patches = [self.image_cropper.crop(org_img=image, bbox=image_bbox, scale=scale,
+                                               out_w=w_input, out_h=h_input, crop=scale is not None)
+                       for _, _, _, scale, _ in models]
+            # same conversion as trans.ToTensor, done once for the whole group
+            batch = torch.from_numpy(np.stack(patches).transpose((0, 3, 1, 2))).float()
+            groups.append((models, batch.to(self.device)))
+        return groups
+
+    def predict_detailed(self, image, image_bbox=None):
+        """
+        Run the ensemble on a 3:4 image and keep the per-model results.
 
+        Returns a dict with the ensemble label (1 for a real face), its averaged score, the face bbox,
+        the detection time and, for every model, its softmax scores and forward time in ms.
+        """
+        start = time.perf_counter()
+        if image_bbox is None:
+            image_bbox = self.get_bbox(image)
+        detect_ms = (time.perf_counter() - start) * 1000
 
+        # submit every crop before waiting, so the models' batches fill up side by side
+        pending = []
+        for models, batch in self.crop_patches(image, image_bbox):
+            for i, (model_name, _, _, _, model) in enumerate(models):
+                start = time.perf_counter()
+                if model_name in self.batchers:
+                    # timed when the batched result comes back, so it includes the batch wait
+                    pending.append((model_name, start, self.batchers[model_name].submit(batch[i:i + 1])))
+                else:
+                    result = Future()
+                    result.set_result(self._forward_fn(model)(batch[i:i + 1]))
+                    pending.append((model_name, time.perf_counter() - start, result))
 
+        # sum the prediction from single model's result
+        prediction = np.zeros((1, 3))
+        model_results = []
+        for model_name, start_or_elapsed, result in pending:
+            scores = result.result()
+            elapsed = start_or_elapsed if model_name not in self.batchers \
+                else time.perf_counter() - start_or_elapsed
+            prediction += scores
+            model_results.append({"model": model_name,
+                                  "scores": scores[0].tolist(),
+                                  "time_ms": elapsed * 1000})
 
+        label = int(np.argmax(prediction))
+        return {"label": label,
+                "score": float(prediction[0][label] / len(self.models)),
+                "bbox": image_bbox,
+                "detect_ms": detect_ms,
+                "models": model_results}
 
+    def predict_many(self, image, image_bboxes):
+        """
+        Run the ensemble on several faces of one image, every model classifying all of them in one forward.
 
+        The per-face batches are already full, so they are forwarded directly instead of going through
+        the micro-batchers. Returns one dict per bbox with the label (1 for a real face), its averaged
+        score and the bbox.
+        """
+        if len(image_bboxes) == 0:
+            return []
 
+        faces = [self.crop_patches(image, image_bbox) for image_bbox in image_bboxes]
 
+        # sum the prediction of every model, one row per face
+        prediction = np.zeros((len(image_bboxes), 3))
+        for group, (models, _) in enumerate(faces[0]):
+            for i, (_, _, _, _, model) in enumerate(models):
+                batch = torch.cat([face[group][1][i:i + 1] for face in faces])
+                prediction += self._forward_fn(model)(batch)
 
+        labels = np.argmax(prediction, axis=1)
+        return [{"label": int(label),
+                 "score": float(prediction[row][label] / len(self.models)),
+                 "bbox": image_bbox}
+                for row, (label, image_bbox) in enumerate(zip(labels, image_bboxes))]
 
+    def predict(self, image):
+        """
+        Return the ensemble label of a 3:4 image, 1 for a real face.
+        """
+        return self.predict_detailed(image)["label"]
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-request micro-batching for the anti-spoofing models
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class MicroBatcher:
+    """
+    Collect single-sample inputs from concurrent callers and run them as one batched forward.
+
+    A worker thread takes the first waiting sample, then keeps collecting until it holds
+    max_batch_size samples or max_wait_ms has passed since the first one arrived. The batch
+    goes through `forward` once and every caller gets its own row of the output back through
+    a Future, so a lone request waits at most max_wait_ms longer than without batching.
+    """
+
+    def __init__(self, forward, max_batch_size=16, max_wait_ms=5, name="batcher"):
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, sample):
+        """
+        Queue a 1xCxHxW tensor and return a Future resolving to its 1xK output.
+        """
+        future = Future()
+        self._queue.put((sample, future))
+        return future
+
+    def __call__(self, sample):
+        return self.submit(sample).result()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # put the stop marker back so _run sees it after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = self._collect(first)
+            try:
+                outputs = self.forward(torch.cat([sample for sample, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for i, (_, future) in enumerate(batch):
+                future.set_result(outputs[i:i + 1])
@@ -7,19 +7,22 @@
 
 import os
 import cv2
-import numpy as np
 import argparse
+import threading
 import warnings
-import time
 
-from anti_spoof.src.anti_spoof_predict import AntiSpoofPredict
-from anti_spoof.src.generate_patches import CropImage
-from anti_spoof.src.utility import parse_model_name
+from anti_spoof.src.anti_spoof_predict import AntiSpoofEngine
+from metrics import MODEL_LOADS, SPOOF_MODEL_LATENCY, STAGE_LATENCY
 warnings.filterwarnings('ignore')
 
 
 SAMPLE_IMAGE_PATH = "./images/sample/"
 
+# Resident inference engines, the models are loaded once per (model_dir, device_id), and the options
+# (max_batch_size, max_wait_ms) they were created with
+_engines = {}
+_engine_options = {}
+_engines_lock = threading.Lock()
 
 # 因为安卓端APK获取的视频流宽高比为3:4,为了与之一致，所以将宽高比限制为3:4
 def check_image(image):
@@ -31,40 +34,66 @@ def check_image(image):
         return True
 
 
-def test(image, model_dir, device_id):
-    model_test = AntiSpoofPredict(device_id)
-    image_cropper = CropImage()
+def get_engine(model_dir, device_id, **options):
+    # every caller passes the same options, an engine is never reused with other batching settings
+    key = (os.path.abspath(model_dir), device_id)
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = AntiSpoofEngine(model_dir, device_id, **options)
+            _engine_options[key] = options
+            MODEL_LOADS.inc(model='RetinaFace')
+            for model_name, _, _, _, _ in _engines[key].models:
+                MODEL_LOADS.inc(model=model_name)
+        elif options != _engine_options[key]:
+            raise ValueError("the engine of {} was created with {}, not {}".format(
+                model_dir, _engine_options[key], options))
+        return _engines[key]
+
+
+def batcher_queue_depths():
+    # crops waiting in the micro-batcher of every model, for the metrics endpoint
+    with _engines_lock:
+        engines = list(_engines.values())
+    return {(model_name,): batcher.queue_depth
+            for engine in engines for model_name, batcher in engine.batchers.items()}
+
+
+def test(image, model_dir, device_id, image_bbox=None, **options):
+    result = test_detailed(image, model_dir, device_id, image_bbox, **options)
+    if "label" not in result:
+        return result
+    return result["label"]
+
+
+def scale_bbox(image_bbox, from_shape, to_shape):
+    # [x, y, w, h] box of an image, in the coordinates of the same image resized to to_shape
+    scale_x = to_shape[1] / from_shape[1]
+    scale_y = to_shape[0] / from_shape[0]
+    x, y, w, h = image_bbox
+    return [int(x * scale_x), int(y * scale_y), max(1, int(w * scale_x)), max(1, int(h * scale_y))]
+
+
+def test_detailed(image, model_dir, device_id, image_bbox=None, **options):
     # image = cv2.imread(SAMPLE_IMAGE_PATH + image_name)
-    image = cv2.resize(image, (int(image.shape[0] * 3 / 4), image.shape[0]))
-    result = check_image(image)
+    # image_bbox is the face box found in the image as given, the detector does not run again
+    resized = cv2.resize(image, (int(image.shape[0] * 3 / 4), image.shape[0]))
+    result = check_image(resized)
     if result is False:
         return {"message" : "File Size is not correct!"}
-    image_bbox = model_test.get_bbox(image)
-    prediction = np.zeros((1, 3))
-    test_speed = 0
-    # sum the prediction from single model's result
-    for model_name in os.listdir(model_dir):
-        h_input, w_input, model_type, scale = parse_model_name(model_name)
-        param = {
-            "org_img": image,
-            "bbox": image_bbox,
-            "scale": scale,
-            "out_w": w_input,
-            "out_h": h_input,
-            "crop": True,
-        }
-        if scale is None:
-            param["crop"] = False
-        img = image_cropper.crop(**param)
-        start = time.time()
-        prediction += model_test.predict(img, os.path.join(model_dir, model_name))
-        test_speed += time.time()-start
-
-    # draw result of prediction
-    label = np.argmax(prediction)
-    value = prediction[0][label]/2
-
-    return label
+    if image_bbox is not None:
+        image_bbox = scale_bbox(image_bbox, image.shape, resized.shape)
+    # label, score, and the scores and speed of every model of the ensemble
+    detailed = get_engine(model_dir, device_id, **options).predict_detailed(resized, image_bbox)
+    if image_bbox is None:
+        STAGE_LATENCY.observe(detailed["detect_ms"] / 1000, stage='detect')
+    for model in detailed["models"]:
+        SPOOF_MODEL_LATENCY.observe(model["time_ms"] / 1000, model=model["model"])
+    return detailed
+
+
+def test_faces(image, image_bboxes, model_dir, device_id, **options):
+    # every face of a group photo, the boxes are in the coordinates of the image as given
+    return get_engine(model_dir, device_id, **options).predict_many(image, image_bboxes)
 
 
 if __name__ == "__main__":
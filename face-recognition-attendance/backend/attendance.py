@@ -0,0 +1,137 @@
+import datetime
+import threading
+
+import pytz
+
+
+# Attendance days follow the school's local time
+LOCAL_TIMEZONE = pytz.timezone('Asia/Kolkata')
+
+
+class AttendanceState:
+
+    """
+    In-memory presence table of the current day, kept in step with the storage.
+
+    The table maps every email seen today to True (IN) or False (OUT). It is rebuilt from the day's entries
+    in the storage on first use, at the date rollover and whenever the storage's signature of the day
+    (attendance_signature: the log file's modification time and size, or the last SQLite entry id) shows
+    an entry this process did not write, e.g. one written by another uvicorn worker. A lookup is that
+    signature (one stat or one indexed query) and a dictionary read, so it does not depend on how many
+    entries the day's log holds.
+
+    record() and log_in() write under the storage's attendance lock, shared by every process, after
+    refreshing the table: the check of log_in() and its write are atomic across the workers too.
+
+    Parameters:
+    storage (FileStorage or SQLiteStorage): Where the attendance entries are kept.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._date = None
+        self._signature = None
+        self._status = {}
+        self._lock = threading.Lock()
+
+    def _now(self):
+        return datetime.datetime.now(LOCAL_TIMEZONE)
+
+    def _current_table(self):
+        # Rebuild the table when the day has changed or another process wrote to the day's log
+        date = self._now().strftime("%Y-%m-%d")
+        if date != self._date or self.storage.attendance_signature(date) != self._signature:
+            with self._lock:
+                self._refresh(date)
+        return self._status
+
+    def _refresh(self, date):
+        # Under self._lock. The signature is read first, so an entry written meanwhile is either in the
+        # table or makes the next lookup rebuild it again.
+        signature = self.storage.attendance_signature(date)
+        if date != self._date or signature != self._signature:
+            self._status = self.storage.attendance_status(date)
+            self._date, self._signature = date, signature
+
+    def status(self, email):
+
+        """
+        Return True if the user is logged in, False if they logged out, None if they have no entry today.
+        """
+
+        return self._current_table().get(email)
+
+    def present(self):
+
+        """
+        Return the sorted emails of every user who is currently logged in.
+        """
+
+        return sorted(email for email, logged_in in self._current_table().items() if logged_in)
+
+    def record(self, email, direction):
+
+        """
+        Write an IN or OUT entry for the user to today's attendance and update the table.
+
+        Parameters:
+        email (str): The user's email.
+        direction (str): 'IN' or 'OUT'.
+
+        Returns:
+        str: The time of the entry, formatted as "HH:MM:SS".
+        """
+
+        return self._record(email, direction, skip_if_logged_in=False)
+
+    def log_in(self, email):
+
+        """
+        Record an IN entry unless the user is already logged in, as one atomic step.
+
+        Returns:
+        str: The time of the entry, or None if the user was already logged in.
+        """
+
+        return self._record(email, 'IN', skip_if_logged_in=True)
+
+    def log_in_many(self, emails):
+
+        """
+        Record an IN entry for every user who is not already logged in, in one append.
+
+        Returns:
+        dict: The time of the entry by email, None for the users who were already logged in.
+        """
+
+        return self._record_many(emails, 'IN', skip_if_logged_in=True)
+
+    def _record(self, email, direction, skip_if_logged_in):
+        return self._record_many([email], direction, skip_if_logged_in)[email]
+
+    def _record_many(self, emails, direction, skip_if_logged_in):
+        current_datetime = self._now()
+        formatted_date = current_datetime.strftime("%Y-%m-%d")
+        formatted_datetime = current_datetime.strftime("%H:%M:%S")
+
+        times = {}
+        with self._lock, self.storage.attendance_lock():
+            # The entries of the other processes are in the table before deciding who is already logged in
+            self._refresh(formatted_date)
+
+            for email in emails:
+                if email in times or (skip_if_logged_in and self._status.get(email) is True):
+                    times.setdefault(email, None)
+                else:
+                    times[email] = formatted_datetime
+
+            entries = [(email, formatted_date, formatted_datetime, direction)
+                       for email, time_ in times.items() if time_ is not None]
+            if entries:
+                self.storage.record_attendance(entries)
+                for email, _, _, _ in entries:
+                    self._status[email] = direction == 'IN'
+                # No other process writes while the lock is held, the new signature is this write's
+                self._signature = self.storage.attendance_signature(formatted_date)
+
+        return times
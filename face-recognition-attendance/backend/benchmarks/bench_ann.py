@@ -0,0 +1,97 @@
+"""
+Build and query benchmark of the IVF index against the exact matcher on synthetic identities.
+
+Run from the backend directory:
+    python -m benchmarks.bench_ann --sizes 10000 100000 1000000 --nprobe 1 4 8 16
+
+The synthetic encodings are drawn around random cluster centres so that, like real dlib encodings,
+the data has structure for k-means to find. Every query is an enrolled identity plus noise, so the
+expected answer is known and recall@1 can be measured for each nprobe value.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM
+
+
+def synthetic_encodings(n, n_clusters=1000, seed=0):
+
+    """
+    Function to generate n float32 encodings of shape (n, 128) grouped around n_clusters centres.
+    """
+
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.1, size=(n_clusters, EMBEDDING_DIM)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size=n)
+    return centres[labels] + rng.normal(0, 0.06, size=(n, EMBEDDING_DIM)).astype(np.float32)
+
+
+def make_matcher(embeddings, **options):
+    emails = ['user{}@example.com'.format(i) for i in range(len(embeddings))]
+
+    start = time.perf_counter()
+    matcher = EmbeddingMatcher(**options).load_arrays(emails, embeddings)
+    return matcher, time.perf_counter() - start
+
+
+def query(matcher, queries, expected):
+    latencies = []
+    hits = 0
+
+    for embedding, email in zip(queries, expected):
+        start = time.perf_counter()
+        found, _ = matcher.match(embedding)
+        latencies.append(time.perf_counter() - start)
+        hits += found == email
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'recall_at_1': hits / len(queries),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def run(sizes, nprobes, n_queries, seed):
+    results = []
+    rng = np.random.default_rng(seed + 1)
+
+    for size in sizes:
+        embeddings = synthetic_encodings(size, seed=seed)
+        rows = rng.choice(size, n_queries, replace=False)
+        queries = embeddings[rows] + rng.normal(0, 0.02, size=(n_queries, EMBEDDING_DIM)).astype(np.float32)
+        expected = ['user{}@example.com'.format(row) for row in rows]
+
+        exact, build_time = make_matcher(embeddings)
+        results.append(dict(size=size, index='exact', build_s=build_time, **query(exact, queries, expected)))
+
+        # One index build per size, nprobe is a query-time setting
+        ivf, build_time = make_matcher(embeddings, index='ivf', exact_fallback=False)
+        for nprobe in nprobes:
+            ivf.nprobe = nprobe
+            results.append(dict(size=size, index='ivf', nprobe=nprobe, build_s=build_time,
+                                **query(ivf, queries, expected)))
+
+        for result in results[-len(nprobes) - 1:]:
+            print(json.dumps(result))
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IVF index build and query benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.nprobe, args.queries, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,148 @@
+"""
+Accuracy and latency of the reduced-precision scans (float16, int8) against the float32 matcher.
+
+Run from the backend directory:
+    python -m benchmarks.bench_quantization --sizes 10000 100000 --rerank 1 10 --output quantization.json
+
+For every size a synthetic registry (see benchmarks.bench_ann.synthetic_encodings) is loaded into one
+matcher per precision. Half of the queries are enrolled identities moved away by a distance drawn
+uniformly from 0.3 to 0.9, so many of them fall on both sides of the 0.6 tolerance of compare_faces; the
+other half are unknown faces. The float32 matcher gives the reference answer of every query.
+
+Reported per precision and rerank setting (rows rescored for a query that can not match):
+- scan_mb: bytes read by the scan of every query (the quantized copy, or the float32 matrix and norms);
+- p50/p95/p99 match() latency and the per-query latency of match_many() on batches of --batch queries;
+- same_match: share of queries answered with the reference email;
+- decision_flips: queries accepted by one and rejected by the other at the tolerance, and how many of the
+  queries within 0.05 of the tolerance there are (the ones a flip could come from);
+- candidate_recall: share of queries whose reference winner is among the rows rescored in float32,
+  candidates_mean/max the number of these rows;
+- error_bound: the largest quantization error of a row, scan_error_mean/max: the error of the scan's
+  distances before the rerank, against float32.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM, DEFAULT_TOLERANCE
+from benchmarks.bench_ann import synthetic_encodings
+
+
+PRECISIONS = ('float32', 'float16', 'int8')
+
+# Queries whose reference distance is this close to the tolerance are counted as borderline
+BORDERLINE = 0.05
+
+
+def make_queries(embeddings, n_queries, rng):
+    # Enrolled identities at a distance drawn from 0.3 to 0.9, and faces far from every centre
+    n_known = n_queries // 2
+    rows = rng.choice(len(embeddings), n_known, replace=False)
+    directions = rng.normal(size=(n_known, EMBEDDING_DIM))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    known = embeddings[rows] + directions * rng.uniform(0.3, 0.9, size=(n_known, 1))
+    unknown = rng.normal(0, 0.3, size=(n_queries - n_known, EMBEDDING_DIM))
+    return np.concatenate([known, unknown]).astype(np.float32)
+
+
+def latencies(matcher, queries):
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        matcher.match(query)
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    return {
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'p99_ms': float(np.percentile(timings, 99)),
+    }
+
+
+def batch_latency(matcher, queries, batch):
+    start = time.perf_counter()
+    for first in range(0, len(queries), batch):
+        matcher.match_many(queries[first:first + batch])
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def scan_accuracy(matcher, reference, queries, reference_rows):
+
+    """
+    Function to measure the candidates and the distance error of the reduced-precision scan.
+    """
+
+    quantized = matcher._state[4]
+    candidates = matcher._candidates(quantized, queries)
+    approximate = np.sqrt(np.maximum(quantized.sq_distances(queries), 0))
+    errors = np.concatenate([np.abs(distances - reference.distances(query))
+                             for distances, query in zip(approximate, queries)])
+    sizes = [len(rows) for rows in candidates]
+    return {
+        'candidate_recall': sum(row in rows for rows, row in zip(candidates, reference_rows)) / len(queries),
+        'candidates_mean': float(np.mean(sizes)),
+        'candidates_max': int(np.max(sizes)),
+        'error_bound': quantized.error,
+        'scan_error_mean': float(errors.mean()),
+        'scan_error_max': float(errors.max()),
+    }
+
+
+def run(sizes, reranks, n_queries, batch, seed):
+    results = []
+    rng = np.random.default_rng(seed + 1)
+
+    for size in sizes:
+        embeddings = synthetic_encodings(size, n_clusters=max(1, min(1000, size // 10)), seed=seed)
+        emails = ['user{}@example.com'.format(i) for i in range(size)]
+        queries = make_queries(embeddings, n_queries, rng)
+
+        reference = EmbeddingMatcher().load_arrays(emails, embeddings)
+        answers = reference.match_many(queries)
+        row_of = {email: row for row, email in enumerate(emails)}
+        reference_rows = [row_of[email] for email, _ in answers]
+        accepted = np.array([distance <= DEFAULT_TOLERANCE for _, distance in answers])
+        borderline = sum(abs(distance - DEFAULT_TOLERANCE) <= BORDERLINE for _, distance in answers)
+
+        for precision in PRECISIONS:
+            for rerank in (reranks if precision != 'float32' else [None]):
+                start = time.perf_counter()
+                matcher = EmbeddingMatcher(precision=precision, rerank=rerank or 1).load_arrays(emails, embeddings)
+                build_time = time.perf_counter() - start
+
+                _, matrix, sq_norms, _, quantized, _ = matcher._state
+                found = [matcher.match(query) for query in queries]
+                flips = int(np.sum(np.array([distance <= DEFAULT_TOLERANCE for _, distance in found]) != accepted))
+
+                result = dict(size=size, precision=precision, rerank=rerank, build_s=build_time,
+                              scan_mb=(quantized.nbytes if quantized else matrix.nbytes + sq_norms.nbytes) / 2 ** 20,
+                              **latencies(matcher, queries),
+                              batch_ms_per_query=batch_latency(matcher, queries, batch),
+                              same_match=sum(email == expected for (email, _), (expected, _) in zip(found, answers))
+                              / len(queries),
+                              decision_flips=flips, borderline_queries=int(borderline), queries=len(queries))
+                if quantized is not None:
+                    result.update(scan_accuracy(matcher, reference, queries, reference_rows))
+                print(json.dumps(result))
+                results.append(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and latency of the float16 and int8 scans")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--rerank", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--batch", type=int, default=32, help="queries per match_many() call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.rerank, args.queries, args.batch, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
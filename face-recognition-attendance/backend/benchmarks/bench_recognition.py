@@ -0,0 +1,243 @@
+"""
+Scaling benchmark of recognition with the size of the registry.
+
+Run from the backend directory:
+    python -m benchmarks.bench_recognition --sizes 100 1000 10000 100000 --output results.json
+    python -m benchmarks.bench_recognition --baseline benchmarks/baseline_recognition.json
+
+For every size a synthetic DB_PATH (user_details.csv and the embedding store, or a SQLite database with
+--backend sqlite) is written to a temporary directory with random 128-d encodings. Every matcher path of
+MATCHER_PATHS is then measured through the same functions as a login:
+- cold start: the time to read the registry and build the matcher (get_matcher), the memory it allocates
+  and the latency of the first query;
+- warm queries: p50/p95/p99 latency of match_embedding(), half of the queries being enrolled identities
+  with noise and half unknown faces, plus recall@1 on the enrolled ones.
+The face encoding of recognize() does not depend on the registry size; --image adds the full recognize()
+latency on one image for reference.
+
+With --baseline the results are compared with a stored run and every latency or memory figure more than
+--tolerance above the baseline is reported as a regression (exit code 1). Timings only compare between
+runs on the same host: the stored baseline must be regenerated (--output benchmarks/baseline_recognition.json)
+on the machine that runs the comparison, e.g. the CI host, whenever that machine changes.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import utils
+from matcher import EMBEDDING_DIM
+from benchmarks.bench_ann import synthetic_encodings
+
+
+# Matcher paths to measure, name -> get_matcher() options. New index or matcher paths are added here.
+MATCHER_PATHS = {
+    'exact': dict(index='exact'),
+    'ivf': dict(index='ivf', nprobe=8),
+    'int8': dict(index='exact', precision='int8'),
+}
+
+# Figures compared with the baseline (all of them lower is better) and the smallest absolute change that
+# counts, so timer noise on sub-millisecond figures is not reported as a regression. The tail percentiles of
+# a small registry swing by several times between two runs of the same code (a scheduler or GC pause is a
+# few queries), hence their larger floors.
+COMPARED_FIELDS = {
+    'cold_load_s': 0.01,
+    'cold_first_query_ms': 0.5,
+    'p50_ms': 0.05,
+    'p95_ms': 0.5,
+    'p99_ms': 1.0,
+    'load_peak_mb': 1.0,
+}
+
+# A tail percentile is only compared when both runs have at least this many queries above it (p95 from
+# 400 queries, p99 from 2000), below that it is the time of a handful of queries
+TAIL_SAMPLES = 20
+TAIL_PERCENTILES = {'p95_ms': 95, 'p99_ms': 99}
+
+# Queries per registry size, also assumed for the baseline runs that do not record it
+DEFAULT_QUERIES = 400
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline_recognition.json')
+
+
+def write_registry(db_path, embeddings, backend):
+
+    """
+    Function to write a synthetic registry of len(embeddings) users to db_path through the storage layer.
+    """
+
+    users = [('User {}'.format(i), 'user{}@example.com'.format(i), '', str(i % 12 + 1), 'ABCD'[i % 4],
+              os.path.join(db_path, 'user{}@example.com.png'.format(i)), [embedding.astype(np.float64)])
+             for i, embedding in enumerate(embeddings)]
+    utils.open_storage(db_path, db_path, backend=backend,
+                       sqlite_path=os.path.join(db_path, 'attendance.sqlite3')).add_users(users)
+
+
+def reset_caches(db_path):
+    # Forget the resident matcher so the next get_matcher() reads the registry again, a cold start
+    utils._matchers.pop(db_path, None)
+
+
+def cold_load(db_path, options):
+    reset_caches(db_path)
+    start = time.perf_counter()
+    matcher = utils.get_matcher(db_path, **options)
+    return matcher, time.perf_counter() - start
+
+
+def measure_path(db_path, options, queries, expected):
+    _, load_time = cold_load(db_path, options)
+
+    # Memory allocated by a cold load, measured on a separate load since tracemalloc slows it down
+    tracemalloc.start()
+    matcher, _ = cold_load(db_path, options)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    utils.match_embedding(queries[0], db_path)
+    first_query = time.perf_counter() - start
+
+    latencies = []
+    hits = 0
+    for embedding, email in zip(queries, expected):
+        start = time.perf_counter()
+        found, match_status = utils.match_embedding(embedding, db_path)
+        latencies.append(time.perf_counter() - start)
+        hits += email is not None and found == email
+
+    latencies = np.array(latencies) * 1000
+    # Bytes read by the scan: the reduced-precision copy when there is one, else the float32 matrix and norms
+    quantized = matcher._state[4]
+    state_bytes = quantized.nbytes if quantized is not None else sum(array.nbytes for array in matcher._state[1:3])
+    return {
+        'cold_load_s': load_time,
+        'cold_first_query_ms': first_query * 1000,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'queries': len(latencies),
+        'recall_at_1': hits / max(1, sum(email is not None for email in expected)),
+        'load_peak_mb': peak / 2 ** 20,
+        'matrix_mb': state_bytes / 2 ** 20,
+    }
+
+
+def measure_recognize(db_path, image_path):
+    import cv2
+
+    image = cv2.imread(image_path)
+    utils.recognize(image, db_path)
+
+    latencies = []
+    for _ in range(5):
+        start = time.perf_counter()
+        utils.recognize(image, db_path)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def run(sizes, n_queries, seed, backend, image_path=None, paths=None):
+    results = []
+    rng = np.random.default_rng(seed + 1)
+    paths = paths or list(MATCHER_PATHS)
+
+    for size in sizes:
+        db_path = tempfile.mkdtemp(prefix='bench_recognition_')
+        try:
+            embeddings = synthetic_encodings(size, n_clusters=max(1, min(1000, size // 10)), seed=seed)
+
+            start = time.perf_counter()
+            write_registry(db_path, embeddings, backend)
+            write_time = time.perf_counter() - start
+
+            # Half enrolled identities with noise, half faces far from every centre
+            n_known = n_queries // 2
+            rows = rng.choice(size, min(n_known, size), replace=False)
+            known = embeddings[rows] + rng.normal(0, 0.02, size=(len(rows), EMBEDDING_DIM)).astype(np.float32)
+            unknown = rng.normal(0, 0.3, size=(n_queries - len(rows), EMBEDDING_DIM)).astype(np.float32)
+            queries = np.concatenate([known, unknown])
+            expected = ['user{}@example.com'.format(row) for row in rows] + [None] * len(unknown)
+
+            for path in paths:
+                result = dict(size=size, path=path, backend=backend, write_s=write_time,
+                              **measure_path(db_path, MATCHER_PATHS[path], queries, expected))
+                if image_path:
+                    result['recognize_ms'] = measure_recognize(db_path, image_path)
+                print(json.dumps(result))
+                results.append(result)
+
+            reset_caches(db_path)
+            utils._storages.pop(db_path, None)
+        finally:
+            shutil.rmtree(db_path, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+
+    """
+    Function to compare a run with a baseline run.
+
+    Returns:
+    list: One dictionary per figure more than `tolerance` (relative) and more than its COMPARED_FIELDS
+          floor (absolute) above its baseline value, and one with the field 'missing_baseline' per result
+          the baseline has no entry for (regenerate it with --output). Tail percentiles measured on too
+          few queries for TAIL_SAMPLES are skipped.
+    """
+
+    reference = {(entry['size'], entry['path'], entry.get('backend', 'files')): entry for entry in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get((result['size'], result['path'], result['backend']))
+        if base is None:
+            # A path or size added since the baseline was stored would otherwise never be checked
+            regressions.append({'size': result['size'], 'path': result['path'], 'backend': result['backend'],
+                                'field': 'missing_baseline'})
+            continue
+        queries = min(result.get('queries', DEFAULT_QUERIES), base.get('queries', DEFAULT_QUERIES))
+        for field, floor in COMPARED_FIELDS.items():
+            if field in TAIL_PERCENTILES and queries * (100 - TAIL_PERCENTILES[field]) / 100 < TAIL_SAMPLES:
+                continue
+            if field in base and result[field] > base[field] * (1 + tolerance) and result[field] - base[field] > floor:
+                regressions.append({'size': result['size'], 'path': result['path'], 'field': field,
+                                    'baseline': base[field], 'value': result[field],
+                                    'ratio': result[field] / base[field] if base[field] else float('inf')})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recognition latency and memory against registry size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--paths", type=str, nargs="+", default=list(MATCHER_PATHS), choices=list(MATCHER_PATHS))
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", type=str, default='files', choices=['files', 'sqlite'])
+    parser.add_argument("--image", type=str, default=None, help="optional face image to time the full recognize()")
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="JSON results to compare with, {} is the stored one".format(DEFAULT_BASELINE))
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.queries, args.seed, args.backend, args.image, args.paths)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + json.dumps(regression))
+        print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,100 @@
+"""
+Latency of scoped searches (one section, one class) against the search of the whole registry.
+
+Run from the backend directory:
+    python -m benchmarks.bench_scope --size 100000 --classes 12 --divisions 25 --output scope.json
+
+A synthetic registry (see benchmarks.bench_ann.synthetic_encodings) is spread evenly over --classes x
+--divisions sections. Every query is an enrolled identity plus noise and is searched in the whole registry,
+in its own section ('10/A') and in its own class ('10'), with match() one query at a time and with
+match_many() on batches of queries of one section, like a kiosk frame. Reported per search: the candidate
+rows, p50/p95 latency, batch latency per query and recall@1, plus the time the first scoped search spends
+building the section sub-indexes.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM
+from benchmarks.bench_ann import synthetic_encodings
+
+
+def measure(matcher, queries, expected, scopes, batch):
+    latencies = []
+    hits = 0
+    for query, email, scope in zip(queries, expected, scopes):
+        start = time.perf_counter()
+        found, _ = matcher.match(query, scope)
+        latencies.append(time.perf_counter() - start)
+        hits += found == email
+
+    # Batches of queries sharing a scope, as the faces of one kiosk frame
+    start = time.perf_counter()
+    for first in range(0, len(queries), batch):
+        matcher.match_many(queries[first:first + batch], scopes[first])
+    batch_time = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p95_ms': float(np.percentile(latencies, 95)),
+        'batch_ms_per_query': batch_time / len(queries) * 1000,
+        'recall_at_1': hits / len(queries),
+    }
+
+
+def run(size, n_classes, n_divisions, n_queries, batch, seed):
+    rng = np.random.default_rng(seed + 1)
+    embeddings = synthetic_encodings(size, n_clusters=max(1, min(1000, size // 10)), seed=seed)
+    emails = ['user{}@example.com'.format(i) for i in range(size)]
+    sections = {email: (str(i % n_classes + 1), 'D{}'.format(i // n_classes % n_divisions))
+                for i, email in enumerate(emails)}
+
+    matcher = EmbeddingMatcher(sections=lambda users: [sections[email] for email in users])
+    matcher.load_arrays(emails, embeddings)
+
+    start = time.perf_counter()
+    matcher.match(embeddings[0], (sections[emails[0]],))
+    build_time = time.perf_counter() - start
+
+    # Queries grouped by section so a batch shares one
+    rows = np.sort(rng.choice(size, n_queries, replace=False))
+    rows = np.array(sorted(rows, key=lambda row: sections[emails[row]]))
+    queries = embeddings[rows] + rng.normal(0, 0.02, size=(len(rows), EMBEDDING_DIM)).astype(np.float32)
+    expected = [emails[row] for row in rows]
+
+    searches = {
+        'global': [None] * len(rows),
+        'section': [(sections[email],) for email in expected],
+        'class': [((sections[email][0], None),) for email in expected],
+    }
+
+    results = []
+    for name, scopes in searches.items():
+        candidates = [len(matcher._scope_rows(matcher._state, scope)) if scope else size for scope in scopes]
+        result = dict(size=size, sections=n_classes * n_divisions, search=name,
+                      candidates_mean=float(np.mean(candidates)), section_index_build_s=build_time,
+                      **measure(matcher, queries, expected, scopes, batch))
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scoped search latency against the whole registry")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--classes", type=int, default=12)
+    parser.add_argument("--divisions", type=int, default=25, help="divisions per class")
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--batch", type=int, default=8, help="queries per match_many() call")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    results = run(args.size, args.classes, args.divisions, args.queries, args.batch, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,121 @@
+"""
+Startup benchmark: time to accept connections, time to ready and first-request latency of a fresh server.
+
+Run from the backend directory:
+    python -m benchmarks.bench_startup --workers 1 --registry-size 1000 --output startup.json
+
+A uvicorn server (main:app) is started in a temporary working directory (or --workdir) holding a synthetic
+registry of --registry-size users plus the face of the sample image image_T1.jpg, like benchmarks.load_test.
+The server is polled on / (listening) and /ready (warm-up done), then the sample image is sent to /login
+once (first request) and --requests more times (warm requests), each time cropped a few more pixels so the
+login result cache does not answer. Every figure is measured from the start of the server process, and
+the startup timings reported by /ready are added to the results.
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import httpx
+import numpy as np
+
+from benchmarks.load_test import BACKEND_DIR, SAMPLE_DIR, load_samples, prepare_workdir, write_registry
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def cropped_variants(contents, count, step=8):
+    # JPEG copies of the image cropped by 0, step, 2 * step... pixels, whose perceptual hashes are too far
+    # apart for the login result cache to take one for another
+    image = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    return [cv2.imencode('.jpg', image[step * i:, step * i:])[1].tobytes() for i in range(count)]
+
+
+def wait_for(client, path, started, timeout_s):
+    # Seconds from started to the first 200 answer of path
+    while time.perf_counter() - started < timeout_s:
+        try:
+            if client.get(path).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        time.sleep(0.02)
+    raise TimeoutError("{} not answering after {} s".format(path, timeout_s))
+
+
+def run(args):
+    images = load_samples(SAMPLE_DIR)
+    prepare_workdir(args.workdir or tempfile.mkdtemp(prefix='bench_startup_'))
+
+    # The app's own storage from the working directory, so the registry uses the configured backend
+    sys.path.insert(0, BACKEND_DIR)
+    import main
+    write_registry(main.storage, args.registry_size, args.seed, images['image_T1.jpg'])
+
+    port = free_port()
+    command = [sys.executable, '-m', 'uvicorn', 'main:app', '--app-dir', BACKEND_DIR, '--host', '127.0.0.1',
+               '--port', str(port), '--workers', str(args.workers), '--log-level', 'warning']
+    frames = cropped_variants(images['image_T1.jpg'], args.requests + 1)
+
+    started = time.perf_counter()
+    server = subprocess.Popen(command, cwd=os.getcwd())
+    try:
+        with httpx.Client(base_url='http://127.0.0.1:{}'.format(port), timeout=None) as client:
+            listening = wait_for(client, '/', started, args.timeout)
+            ready = wait_for(client, '/ready', started, args.timeout)
+
+            start = time.perf_counter()
+            first = client.post('/login', files={'file': ('frame.jpg', frames[0], 'image/jpeg')})
+            first_request = time.perf_counter() - start
+
+            warm = []
+            for frame in frames[1:]:
+                client.post('/logout', params={'email': 'sample.user@example.com'})
+                start = time.perf_counter()
+                client.post('/login', files={'file': ('frame.jpg', frame, 'image/jpeg')})
+                warm.append(time.perf_counter() - start)
+
+            report = client.get('/ready').json()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'workers': args.workers,
+        'registry_size': args.registry_size,
+        'listening_s': listening,
+        'ready_s': ready,
+        'first_request_ms': first_request * 1000,
+        'first_request_answer': first.json(),
+        'warm_request_ms': statistics.median(warm) * 1000 if warm else None,
+        'server_timings': report['timings'],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time and first-request latency of a fresh server")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--registry-size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=5, help="warm /login requests after the first one")
+    parser.add_argument("--workdir", type=str, default=None)
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds to wait for the server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the results")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
@@ -0,0 +1,252 @@
+"""
+End-to-end load test of the FastAPI app under concurrency.
+
+Run from the backend directory:
+    python -m benchmarks.load_test --requests 500 --concurrency 16 --mix login=8 register=1 logout=1
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --requests 500 --concurrency 16
+
+Without --url the app (main.app) is driven in-process through httpx's ASGI transport, including its
+startup and shutdown events. It then runs in a temporary working directory (or --workdir), so ./db,
+./logs and ./login are created there and the real database is never touched; the anti_spoof folder is
+linked into it so the models are found. A synthetic registry of --registry-size users is written first,
+together with the face of the sample image image_T1.jpg so logins with it are matched, in the storage
+backend configured in main.py.
+
+With --url the requests go to a running server (for example `uvicorn main:app --workers 4`), whose
+registry is used as it is.
+
+Logins cycle over the images of anti_spoof/images/sample (real and spoofed faces), registrations use
+image_T1.jpg with a new email each time and logouts log the sample user out so the next login writes
+attendance again. The login result cache is disabled in-process unless --cache is given, since the same
+few images are sent over and over.
+
+Reported per endpoint and overall: requests, throughput (requests/s), p50/p95/p99 latency, HTTP error
+rate, application error rate (a 200 answer carrying a "status" >= 400) and the count of every answer.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DIR = os.path.join(BACKEND_DIR, 'anti_spoof', 'images', 'sample')
+SAMPLE_USER = 'sample.user@example.com'
+
+
+def load_samples(sample_dir):
+    names = sorted(name for name in os.listdir(sample_dir)
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png')) and '_result' not in name)
+    images = {}
+    for name in names:
+        with open(os.path.join(sample_dir, name), 'rb') as f:
+            images[name] = f.read()
+    return images
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        name, _, weight = item.partition('=')
+        if name not in ('login', 'register', 'logout'):
+            raise ValueError("unknown request type {!r}, expected login, register or logout".format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def prepare_workdir(workdir):
+
+    """
+    Function to make workdir the working directory of an in-process run, with the models linked into it.
+    """
+
+    os.makedirs(workdir, exist_ok=True)
+    anti_spoof_link = os.path.join(workdir, 'anti_spoof')
+    if not os.path.exists(anti_spoof_link):
+        os.symlink(os.path.join(BACKEND_DIR, 'anti_spoof'), anti_spoof_link)
+    os.chdir(workdir)
+
+
+def write_registry(storage, registry_size, seed, sample_image):
+
+    """
+    Function to write the synthetic users and the sample user to the app's storage, once per working directory.
+    """
+
+    import cv2
+    import utils
+    from benchmarks.bench_ann import synthetic_encodings
+
+    if storage.user_exists(SAMPLE_USER):
+        return
+
+    embeddings = synthetic_encodings(registry_size, n_clusters=max(1, min(1000, registry_size // 10)), seed=seed)
+    users = [('User {}'.format(i), 'user{}@example.com'.format(i), '', '10', 'A', '', [embedding.astype(np.float64)])
+             for i, embedding in enumerate(embeddings)]
+
+    _, embedding = utils.locate_and_encode_face(cv2.imdecode(np.frombuffer(sample_image, np.uint8), cv2.IMREAD_COLOR))
+    users.append(('Sample User', SAMPLE_USER, '', '10', 'A', '', [embedding]))
+    storage.add_users(users)
+
+
+@contextlib.asynccontextmanager
+async def in_process_client(args):
+    sys.path.insert(0, BACKEND_DIR)
+    images = load_samples(args.images)
+    prepare_workdir(args.workdir or tempfile.mkdtemp(prefix='load_test_'))
+
+    # Imported from the working directory, so the app creates ./db, ./logs and ./login there
+    import main
+
+    write_registry(main.storage, args.registry_size, args.seed, images['image_T1.jpg'])
+    if not args.cache:
+        main.login_cache.max_size = 0
+
+    # Run the startup events (models, matcher, worker pool) before the first request, like uvicorn does
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://loadtest', timeout=None) as client:
+            yield client
+
+
+@contextlib.asynccontextmanager
+async def remote_client(args):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=None, limits=limits) as client:
+        yield client
+
+
+async def send(client, kind, images, counter):
+    if kind == 'login':
+        name = random.choice(sorted(images))
+        return await client.post('/login', files={'file': (name, images[name], 'image/jpeg')})
+
+    if kind == 'register':
+        counter['register'] += 1
+        email = 'load{}.{}@example.com'.format(os.getpid(), counter['register'])
+        return await client.post('/register_new_user',
+                                 params={'name': 'load user', 'email': email, 'phone_number': '0',
+                                         'class_': '10', 'division': 'A'},
+                                 files={'file': ('image_T1.jpg', images['image_T1.jpg'], 'image/jpeg')})
+
+    return await client.post('/logout', params={'email': SAMPLE_USER})
+
+
+def outcome_of(response):
+    # Name the answer by its message or match status, enough to tell matched, spoofed and unknown apart
+    try:
+        body = response.json()
+    except ValueError:
+        return 'http_{}'.format(response.status_code), False
+    if response.status_code >= 400:
+        return 'http_{}'.format(response.status_code), False
+    app_error = isinstance(body.get('status'), int) and body['status'] >= 400
+    if 'match_status' in body:
+        label = 'matched' if body['match_status'] else body.get('user', 'unmatched')
+    else:
+        label = body.get('message', 'ok')
+    return label, app_error
+
+
+async def run(args):
+    images = load_samples(args.images)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    random.seed(args.seed)
+
+    factory = remote_client if args.url else in_process_client
+    records = []
+    counter = {'register': 0}
+
+    async with factory(args) as client:
+        remaining = [args.requests]
+
+        async def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                kind = random.choices(kinds, weights)[0]
+                start = time.perf_counter()
+                try:
+                    response = await send(client, kind, images, counter)
+                    outcome, app_error = outcome_of(response)
+                    http_error = response.status_code >= 400
+                except Exception as e:
+                    outcome, app_error, http_error = type(e).__name__, False, True
+                records.append((kind, time.perf_counter() - start, outcome, http_error, app_error))
+
+        # Warm-up requests are not measured
+        for _ in range(args.warmup):
+            await send(client, 'login', images, counter)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(records, elapsed, args)
+
+
+def summarize(records, elapsed, args):
+
+    """
+    Function to turn the (kind, latency, outcome, http error, app error) records into the report.
+    """
+
+    def stats(selected):
+        latencies = np.array([latency for _, latency, _, _, _ in selected]) * 1000
+        outcomes = {}
+        for _, _, outcome, _, _ in selected:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        return {
+            'requests': len(selected),
+            'throughput_rps': len(selected) / elapsed if elapsed > 0 else None,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'http_error_rate': sum(http_error for _, _, _, http_error, _ in selected) / len(selected),
+            'app_error_rate': sum(app_error for _, _, _, _, app_error in selected) / len(selected),
+            'outcomes': outcomes,
+        }
+
+    report = {
+        'target': args.url or 'in-process',
+        'concurrency': args.concurrency,
+        'registry_size': None if args.url else args.registry_size,
+        'elapsed_s': elapsed,
+        'overall': stats(records) if records else None,
+        'endpoints': {},
+    }
+    for kind in sorted({record[0] for record in records}):
+        report['endpoints'][kind] = stats([record for record in records if record[0] == kind])
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of /login, /register_new_user and /logout")
+    parser.add_argument("--url", type=str, default=None, help="base URL of a running server, in-process if missing")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mix", type=str, nargs="+", default=['login=8', 'register=1', 'logout=1'],
+                        help="request types and their weights, e.g. login=8 register=1 logout=1")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--registry-size", type=int, default=1000, help="synthetic users of an in-process run")
+    parser.add_argument("--images", type=str, default=SAMPLE_DIR)
+    parser.add_argument("--workdir", type=str, default=None, help="working directory of an in-process run")
+    parser.add_argument("--cache", action='store_true', help="keep the login result cache enabled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="optional JSON file for the report")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,238 @@
+import argparse
+import contextlib
+import os
+import pickle
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process lock on Windows, the appends of one process are still serialized
+    fcntl = None
+
+import numpy as np
+
+from matcher import EMBEDDING_DIM
+
+
+# The matrix file is a .npy file (format 1.0) whose header is padded to a fixed size, so the row count in it
+# can be rewritten in place after every append
+HEADER_BYTES = 128
+MATRIX_DTYPE = '<f4'
+ROW_BYTES = EMBEDDING_DIM * np.dtype(MATRIX_DTYPE).itemsize
+
+
+def _header(count):
+    # Magic string and version, little-endian length of the header text, then the padded dictionary literal
+    text = "{{'descr': '{}', 'fortran_order': False, 'shape': ({}, {}), }}".format(MATRIX_DTYPE, count, EMBEDDING_DIM)
+    text = text.ljust(HEADER_BYTES - 11) + '\n'
+    return np.lib.format.magic(1, 0) + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+
+def _read_count(f):
+    # Committed row count, from the shape in the header
+    f.seek(0)
+    np.lib.format.read_magic(f)
+    shape, _, _ = np.lib.format.read_array_header_1_0(f)
+    return shape[0]
+
+
+def _empty():
+    return [], np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+
+class EmbeddingStore:
+
+    """
+    Append-only columnar store of the embeddings of a DB_PATH.
+
+    All the embeddings are rows of one float32 matrix in '<DB_PATH>/embeddings.npy' and the email of every
+    row is the same line of '<DB_PATH>/embeddings.ids'. load() memory-maps the matrix, so reading 100k
+    users is one file read of the ids instead of 100k pickle files to open and unpickle, and the pages of
+    the matrix are shared by every process mapping it.
+
+    An append writes the new rows at the end of the matrix, their emails at the end of the ids, and then
+    the new row count in the header, which commits them: a reader never sees rows past the count, and the
+    next append drops whatever a crashed one left behind it. A user enrolled again gets a new row, load()
+    returns the latest row of every email.
+
+    Parameters:
+    DB_PATH (str): The directory of the user details and embeddings.
+    name (str): Base name of the matrix and ids files.
+    """
+
+    def __init__(self, DB_PATH, name='embeddings'):
+        self.matrix_path = os.path.join(DB_PATH, '{}.npy'.format(name))
+        self.ids_path = os.path.join(DB_PATH, '{}.ids'.format(name))
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.matrix_path)
+
+    def __len__(self):
+        # Rows, including the ones replaced by a later row of the same email
+        if not self.exists():
+            return 0
+        with open(self.matrix_path, 'rb') as f:
+            return _read_count(f)
+
+    @contextlib.contextmanager
+    def _open_for_write(self):
+        # The thread lock excludes the other threads of this process, flock the other processes
+        with self._lock:
+            # Create the file if needed, then reopen it for in-place writes of the header
+            open(self.matrix_path, 'ab').close()
+            with open(self.matrix_path, 'r+b') as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                yield f
+
+    def append(self, emails, embeddings):
+
+        """
+        Function to append the embeddings of several users to the store.
+
+        Parameters:
+        emails (list): The emails of the users.
+        embeddings (array-like): One 128-d embedding per email.
+
+        Returns:
+        int: The number of rows in the store after the append.
+        """
+
+        matrix = np.ascontiguousarray(embeddings, dtype=MATRIX_DTYPE).reshape(-1, EMBEDDING_DIM)
+        if len(emails) != len(matrix):
+            raise ValueError("{} emails for {} embeddings".format(len(emails), len(matrix)))
+        if any('\n' in email for email in emails):
+            raise ValueError("emails can not contain a line break")
+        ids = ''.join(email + '\n' for email in emails).encode('utf-8')
+
+        with self._open_for_write() as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                f.write(_header(0))
+            count = _read_count(f)
+
+            # Rows of a crashed append are past the committed count, drop them
+            f.truncate(HEADER_BYTES + count * ROW_BYTES)
+            f.seek(0, os.SEEK_END)
+            f.write(matrix.tobytes())
+            f.flush()
+
+            with open(self.ids_path, 'a+b') as ids_file:
+                ids_file.seek(0)
+                lines = ids_file.read().split(b'\n', count)
+                if len(lines) > count:
+                    ids_file.truncate(sum(len(line) + 1 for line in lines[:count]))
+                ids_file.write(ids)
+                ids_file.flush()
+                os.fsync(ids_file.fileno())
+
+            # The rows and the ids are on disk before the count that commits them
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(_header(count + len(matrix)))
+
+        return count + len(matrix)
+
+    def load(self):
+
+        """
+        Function to map the embedding matrix and read the email of every row.
+
+        Returns:
+        tuple: The list of emails and the float32 (N, 128) embedding matrix, a read-only memory map of the
+               file unless some email has several rows (then a copy of the latest row of every email).
+        """
+
+        if not self.exists() or len(self) == 0:
+            return _empty()
+
+        # The shape of the header read by np.load is the count, the ids of these rows are already written
+        matrix = np.load(self.matrix_path, mmap_mode='r')
+        with open(self.ids_path, 'rb') as f:
+            emails = f.read().decode('utf-8').split('\n', len(matrix))[:len(matrix)]
+
+        if len(set(emails)) < len(emails):
+            # Users enrolled again, keep their latest row
+            rows = dict(zip(emails, range(len(emails))))
+            latest = np.sort(np.fromiter(rows.values(), dtype=np.intp, count=len(rows)))
+            return [emails[row] for row in latest], np.ascontiguousarray(matrix[latest])
+        return emails, matrix
+
+
+def read_pickles(DB_PATH):
+
+    """
+    Function to read the first embedding of every '<email>.pickle' file of the original layout.
+
+    Pickles without any embedding (registration image without a detectable face) are skipped.
+
+    Returns:
+    tuple: The list of emails and the float64 (N, 128) embedding matrix, in email order.
+    """
+
+    emails = []
+    embeddings = []
+
+    # Sorted so the row order is stable between restarts
+    for file_name in sorted(os.listdir(DB_PATH)):
+        if not file_name.endswith('.pickle'):
+            continue
+
+        with open(os.path.join(DB_PATH, file_name), 'rb') as file:
+            user_embeddings = pickle.load(file)
+
+        if len(user_embeddings) == 0:
+            continue
+
+        emails.append(file_name[:-7])
+        embeddings.append(user_embeddings[0])
+
+    matrix = np.empty((len(embeddings), EMBEDDING_DIM), dtype=np.float64)
+    if embeddings:
+        matrix[:] = embeddings
+    return emails, matrix
+
+
+def convert_pickles(DB_PATH, remove_pickles=False):
+
+    """
+    Function to copy the '<email>.pickle' embeddings of a DB_PATH into its embedding store.
+
+    Emails already in the store are skipped, so running the conversion twice does not duplicate them. Once
+    the store exists FileStorage reads and writes the embeddings there only.
+
+    Parameters:
+    DB_PATH (str): The directory of the user details and embeddings.
+    remove_pickles (bool): Delete the pickle files after the conversion.
+
+    Returns:
+    dict: The number of converted embeddings, of embeddings already stored and of removed pickle files.
+    """
+
+    store = EmbeddingStore(DB_PATH)
+    stored = set(store.load()[0])
+
+    emails, matrix = read_pickles(DB_PATH)
+    new_rows = [row for row, email in enumerate(emails) if email not in stored]
+    # Also creates an empty store when there is nothing to convert
+    store.append([emails[row] for row in new_rows], matrix[new_rows])
+
+    removed = 0
+    if remove_pickles:
+        for file_name in os.listdir(DB_PATH):
+            if file_name.endswith('.pickle'):
+                os.remove(os.path.join(DB_PATH, file_name))
+                removed += 1
+
+    return {"converted": len(new_rows), "already_stored": len(emails) - len(new_rows), "removed": removed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the per-user embedding pickles to the embedding store")
+    parser.add_argument("--db_path", type=str, default="./db")
+    parser.add_argument("--remove_pickles", action='store_true', help="delete the pickle files once converted")
+    args = parser.parse_args()
+
+    print(convert_pickles(args.db_path, args.remove_pickles))
@@ -0,0 +1,129 @@
+import datetime
+import json
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from attendance import LOCAL_TIMEZONE
+
+
+# Output formats of the attendance export and their media types
+EXPORT_MEDIA_TYPES = {
+    'zip': 'application/zip',
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# Number of closed days whose compressed zip member is kept in memory
+CLOSED_DAY_CACHE_SIZE = 400
+
+
+def _dos_date_time(date):
+    # Zip entries carry an MS-DOS timestamp, midnight of the attendance day
+    return 0, ((date.year - 1980) << 9) | (date.month << 5) | date.day
+
+
+class AttendanceExporter:
+
+    """
+    Streaming export of the attendance entries of a date range as a zip of daily CSV files, one CSV or NDJSON.
+
+    The responses are generated day by day, so memory does not grow with the range. For zip exports the
+    compressed member of every closed day (any day before today) is cached, since those days no longer
+    change; only today's entries are compressed on every request. Nothing is written to disk, so concurrent
+    exports do not interfere.
+
+    Parameters:
+    storage (FileStorage or SQLiteStorage): Where the attendance entries are kept.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._closed_days = OrderedDict()
+        self._lock = threading.Lock()
+
+    def dates(self, start=None, end=None):
+
+        """
+        Return the sorted "YYYY-MM-DD" dates with attendance entries between start and end, both included.
+        """
+
+        return [date for date in self.storage.attendance_dates()
+                if (start is None or date >= start) and (end is None or date <= end)]
+
+    def stream(self, dates, output_format):
+
+        """
+        Return a generator of the export of the given dates in 'zip', 'csv' or 'ndjson' format.
+        """
+
+        if output_format == 'zip':
+            return self._stream_zip(dates)
+        if output_format == 'csv':
+            return self._stream_csv(dates)
+        if output_format == 'ndjson':
+            return self._stream_ndjson(dates)
+        raise ValueError("format must be one of {}, got {!r}".format(', '.join(EXPORT_MEDIA_TYPES), output_format))
+
+    def _day_csv(self, date):
+        # Same content as the daily log files: email,time,direction
+        return ''.join('{},{},{}\n'.format(*row) for row in self.storage.attendance_rows(date)).encode()
+
+    def _stream_csv(self, dates):
+        yield b'date,email,time,direction\n'
+        for date in dates:
+            yield ''.join('{},{},{},{}\n'.format(date, *row) for row in self.storage.attendance_rows(date)).encode()
+
+    def _stream_ndjson(self, dates):
+        for date in dates:
+            yield ''.join(json.dumps({"date": date, "email": email, "time": time_, "direction": direction}) + '\n'
+                          for email, time_, direction in self.storage.attendance_rows(date)).encode()
+
+    def _compressed_member(self, date):
+
+        """
+        Return (crc32, compressed bytes, uncompressed size) of the day's CSV, cached for closed days.
+        """
+
+        closed = date < datetime.datetime.now(LOCAL_TIMEZONE).strftime("%Y-%m-%d")
+        if closed:
+            with self._lock:
+                if date in self._closed_days:
+                    self._closed_days.move_to_end(date)
+                    return self._closed_days[date]
+
+        data = self._day_csv(date)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        member = (zlib.crc32(data), compressor.compress(data) + compressor.flush(), len(data))
+
+        if closed:
+            with self._lock:
+                self._closed_days[date] = member
+                while len(self._closed_days) > CLOSED_DAY_CACHE_SIZE:
+                    self._closed_days.popitem(last=False)
+
+        return member
+
+    def _stream_zip(self, dates):
+        # Written by hand instead of with zipfile so cached compressed members can be reused as they are
+        central_directory = []
+        offset = 0
+
+        for date in dates:
+            name = '{}.csv'.format(date).encode()
+            crc, compressed, size = self._compressed_member(date)
+            dos_time, dos_date = _dos_date_time(datetime.date.fromisoformat(date))
+
+            local_header = struct.pack('<4s5H3L2H', b'PK\x03\x04', 20, 0, zlib.DEFLATED, dos_time, dos_date,
+                                       crc, len(compressed), size, len(name), 0)
+            yield local_header + name + compressed
+
+            central_directory.append(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', 20, 20, 0, zlib.DEFLATED,
+                                                 dos_time, dos_date, crc, len(compressed), size, len(name),
+                                                 0, 0, 0, 0, 0, offset) + name)
+            offset += len(local_header) + len(name) + len(compressed)
+
+        directory = b''.join(central_directory)
+        yield directory + struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(central_directory),
+                                      len(central_directory), len(directory), offset, 0)
@@ -2,32 +2,150 @@
 from __future__ import annotations
 
 import os
-import uuid
-import pickle
+import time
+
+# Start of the import of the app, the origin of the startup timings reported by /ready
+IMPORT_STARTED = time.perf_counter()
+
+import secrets
+import asyncio
+import zipfile
 import datetime
-import shutil
-import pytz
+import math
+import io
 import csv
 
-import cv2
-from fastapi import FastAPI, File, UploadFile, UploadFile
+from fastapi import FastAPI, File, UploadFile, UploadFile, BackgroundTasks, Query, WebSocket, Header
 from fastapi.middleware.cors import CORSMiddleware
-import face_recognition
 import starlette
 
-from anti_spoof.test import test
-
-from utils import get_login_status_csv, get_logged_in_users, get_registered_users
-from utils import spoof_test, user_already_registered, recognize
+# Nothing imported here loads torch or dlib, the models are imported and loaded by the warm-up
+from utils import open_storage, configure_matchers
+from utils import spoof_test, user_already_registered, get_matcher, warm_up, spoof_queue_depths
+from utils import encode_face, match_embedding, decode_image, save_login_frame, prune_login_frames
+from utils import detect_face, decode_and_hash_face, confirm_match
+from utils import enroll_image, read_manifest
+from utils import encode_faces, match_embeddings, spoof_test_faces, detect_frame, analyze_frame
+from workers import start_pool, shutdown_pool, run_cpu, run_io, pending_tasks, warm_up_pool, WORKER_POOL_SIZE
+from attendance import AttendanceState
+from export import AttendanceExporter, EXPORT_MEDIA_TYPES
+from tracker import FaceTracker
+from registry import USER_FIELDS
+from result_cache import ResultCache
+import metrics
+import profiler
+from metrics import REQUESTS, REQUEST_LATENCY, STAGE_LATENCY
 
 # Directories
 ATTENDANCE_LOG_DIR = './logs'
 DB_PATH = './db'
 LOGIN_DIR = './login'
+# Face matching: 'exact' scans every embedding, 'ivf' uses the approximate index for large registries.
+# ANN_NPROBE trades recall for latency, misses are always confirmed with an exact scan.
+MATCHER_INDEX = 'exact'
+ANN_NPROBE = 8
+# Precision of the matrix scanned by the exact search: 'float16' or 'int8' read half or a quarter of the bytes
+# and rescore their best candidates in float32 (see `python -m benchmarks.bench_quantization`). The float32
+# matrix stays in memory for that, the quantized copy comes on top of it. Not available with
+# SHARED_REGISTRY_PATH, whose segment is scanned in float32.
+MATCHER_PRECISION = 'float32'
+# Segment file of the embedding registry shared by the uvicorn workers (--workers N), None for one private
+# copy per process. Every worker maps the same file, so the embeddings are in memory once and a
+# registration handled by one worker is matched by all of them. Put it in /dev/shm to keep it off the disk.
+SHARED_REGISTRY_PATH = None
+
+# Login frames are decoded in memory. A sampled share of them can be kept in LOGIN_DIR for auditing,
+# written in the background after the response, and pruned by age and count.
+LOGIN_AUDIT_SAMPLE_RATE = 0.0
+LOGIN_AUDIT_RETENTION_DAYS = 7
+LOGIN_AUDIT_MAX_FILES = 10000
+
+# Where users, embeddings and attendance are kept: 'files' for user_details.csv, the memory-mapped embedding
+# store and one CSV per day, or 'sqlite' for a single indexed database (see `python storage.py` for the migration)
+STORAGE_BACKEND = 'files'
+SQLITE_PATH = os.path.join(DB_PATH, 'attendance.sqlite3')
+
+# Bulk enrollment: images in flight at once (keeps every pool worker busy without holding the whole
+# archive in memory) and largest accepted manifest
+BULK_REGISTER_CONCURRENCY = 2 * WORKER_POOL_SIZE
+BULK_REGISTER_MAX_ROWS = 5000
+# Limits checked on the archive's directory before any member is read, against zip bombs: number of
+# members, uncompressed size and compression ratio of a photo
+BULK_REGISTER_MAX_MEMBERS = 2 * BULK_REGISTER_MAX_ROWS
+BULK_REGISTER_MAX_IMAGE_BYTES = 10 * 2 ** 20
+BULK_REGISTER_MAX_COMPRESSION_RATIO = 100
+
+# Kiosk video streams: every frame only goes through the face detector (at about KIOSK_DETECTION_SIZE
+# pixels a side) and the IoU tracker. Encoding, matching and anti-spoofing run for new tracks, tracks
+# whose confidence (detector score x IoU with the previous box) falls under KIOSK_MIN_CONFIDENCE and,
+# every KIOSK_RETRY_FRAMES frames, tracks not recognized yet.
+KIOSK_DETECTION_SIZE = 192
+KIOSK_IOU_THRESHOLD = 0.3
+KIOSK_MAX_MISSED = 5
+KIOSK_MIN_CONFIDENCE = 0.5
+KIOSK_RETRY_FRAMES = 15
+
+# Results of recent login frames, keyed by the perceptual hash of the detected face crop. A double tap or a
+# retry with the very same crop (identical hash) within RESULT_CACHE_TRUST_S seconds reuses the cached user
+# without encoding the face. A near-duplicate crop, or an older one, skips the search of the registry only:
+# it is encoded and the cached match is confirmed by the distance to that user's embedding.
+# RESULT_CACHE_SPOOF also reuses the anti-spoofing verdict, off by default since a replayed photo of the same
+# face would inherit the verdict of the live one. Entries expire after RESULT_CACHE_TTL_S seconds or at any
+# enrollment change. A size of 0 disables the cache.
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL_S = 10.0
+RESULT_CACHE_TRUST_S = 2.0
+RESULT_CACHE_SPOOF = False
+# Bits of the 256-bit perceptual hash two shots of the same face may differ by (camera noise)
+RESULT_CACHE_MAX_DISTANCE = 8
+
+# Warm-up at startup: the registry, today's attendance and every model are loaded and the models run once on
+# a synthetic frame before the app reports itself ready on /ready. In the background the server accepts
+# connections meanwhile (/ready answers 503 until it is done), otherwise the startup waits for it.
+WARM_UP_IN_BACKGROUND = True
+
+# Token expected in the X-Admin-Token header of the /admin endpoints (on-demand profiling). The admin
+# endpoints are disabled when it is not set.
+ADMIN_TOKEN = os.environ.get('ATTENDANCE_ADMIN_TOKEN')
+
 for dir_ in [ATTENDANCE_LOG_DIR, DB_PATH, LOGIN_DIR]:
     if not os.path.exists(dir_):
         os.mkdir(dir_)
 
+storage = open_storage(DB_PATH, ATTENDANCE_LOG_DIR, backend=STORAGE_BACKEND, sqlite_path=SQLITE_PATH)
+
+# Options of the resident matcher, whether the warm-up or a request arriving before it loads it first
+configure_matchers(shared_path=SHARED_REGISTRY_PATH, index=MATCHER_INDEX, nprobe=ANN_NPROBE,
+                   precision=MATCHER_PRECISION)
+
+# Presence table of the current day, kept in memory and mirrored to the storage
+attendance = AttendanceState(storage)
+
+# Streaming attendance export, caches the compressed closed days
+exporter = AttendanceExporter(storage)
+
+# Recognition (and anti-spoofing) results of recent login frames
+login_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL_S, RESULT_CACHE_MAX_DISTANCE)
+
+# Gauges read when /metrics is scraped
+metrics.Gauge('attendance_queue_depth', 'Work waiting in the worker pool and in every model micro-batcher.',
+              ['queue'], callback=lambda: {('worker_pool',): pending_tasks(),
+                                           **{('batcher:' + name,): depth
+                                              for (name,), depth in spoof_queue_depths().items()}})
+metrics.Gauge('attendance_login_cache', 'Counters of the login result cache.', ['counter'],
+              callback=lambda: {(name,): value for name, value in login_cache.stats().items()
+                                if name in ('size', 'hits', 'misses', 'evictions', 'expirations')})
+
+
+# Startup timings in seconds since IMPORT_STARTED, and latency of the first request of every endpoint
+startup = {"ready": False, "error": None, "timings": {}, "first_request_s": {}}
+
+metrics.Gauge('attendance_startup_seconds', 'Duration of every startup phase, and seconds from import to ready.',
+              ['phase'], callback=lambda: {(phase,): value for phase, value in startup["timings"].items()})
+metrics.Gauge('attendance_first_request_seconds', 'Latency of the first request of every endpoint.',
+              ['endpoint'], callback=lambda: {(endpoint,): value
+                                              for endpoint, value in startup["first_request_s"].items()})
+
 # Create FastAPI app instance
 app = FastAPI()
 
@@ -42,57 +160,468 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Marks the requests sampled by the on-demand profiler, see /admin/profiling
+app.add_middleware(profiler.ProfilingMiddleware)
+
+@app.on_event("startup")
+def start_worker_pool():
+
+    """
+    Start the worker pool that runs the blocking CV/ML stages off the event loop.
+    """
+
+    startup["timings"]["import_s"] = time.perf_counter() - IMPORT_STARTED
+    start_pool()
+
+@app.on_event("startup")
+async def start_warm_up():
+
+    """
+    Run the warm-up, in the background when WARM_UP_IN_BACKGROUND is set.
+    """
+
+    if WARM_UP_IN_BACKGROUND:
+        # Keep a reference, the event loop only holds tasks weakly
+        app.state.warm_up_task = asyncio.create_task(warm_up_app())
+    else:
+        await warm_up_app()
+
+async def warm_up_app():
+
+    """
+    Load everything the first request would otherwise load, then mark the app ready.
+
+    The enrolled embeddings are loaded into the resident matcher, the presence table is built from today's
+    attendance log and every model is imported, loaded and run once on a synthetic frame (utils.warm_up)
+    where the requests run, in every worker with a process pool.
+    """
+
+    timings = startup["timings"]
+    try:
+        start = time.perf_counter()
+        await run_io(get_matcher, DB_PATH)
+        timings["embeddings_s"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await run_io(attendance.present)
+        timings["attendance_s"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        workers = await warm_up_pool(warm_up)
+        timings["models_s"] = time.perf_counter() - start
+
+        # Import, load and first run of the models, of the slowest worker with a process pool
+        for phase in workers[0]:
+            timings["models_" + phase] = max(worker[phase] for worker in workers)
+    except Exception as e:
+        startup["error"] = repr(e)
+        raise
+
+    timings["ready_s"] = time.perf_counter() - IMPORT_STARTED
+    startup["ready"] = True
+
+@app.on_event("startup")
+def prune_login_dir():
+
+    """
+    Apply the retention policy to the audit frames left by previous runs.
+    """
+
+    prune_login_frames(LOGIN_DIR, LOGIN_AUDIT_RETENTION_DAYS, LOGIN_AUDIT_MAX_FILES)
+
+@app.on_event("shutdown")
+def stop_worker_pool():
+    shutdown_pool()
+
 @app.get("/")
 async def root():
     return {'status': 200, "message": "App running successfully"}
 
+@app.get("/ready")
+async def ready():
+
+    """
+    Readiness endpoint for load balancers.
+
+    Answers 503 until the warm-up is done (or if it failed), then 200. The body reports the startup timings
+    in seconds (import of the app, embeddings, attendance, models and their import, load and first run,
+    and 'ready_s' from the import of the app to ready) and the latency of the first request of every endpoint.
+    """
+
+    body = {"ready": startup["ready"],
+            "timings": startup["timings"],
+            "first_request_s": startup["first_request_s"]}
+    if not startup["ready"]:
+        body["error"] = startup["error"]
+        return starlette.responses.JSONResponse(content=body, status_code=503)
+    return body
+
+def parse_scope(values):
+
+    """
+    Function to read the scope of a search from the repeated 'scope' query parameter.
+
+    Every value is a class ('10'), a division of a class ('10/A') or a division of every class ('/A'), the
+    scope is the union of all of them.
+
+    Parameters:
+    values (list): The 'scope' values of the request, None or empty to search everyone.
+
+    Returns:
+    tuple: The (class, division) entries of the scope for the matcher (see matcher.in_scope), or None.
+
+    Raises:
+    ValueError: If a value names neither a class nor a division.
+    """
+
+    if not values:
+        return None
+
+    scope = []
+    for value in values:
+        class_, _, division = value.strip().partition('/')
+        if not class_ and not division:
+            raise ValueError("Scopes must be formatted as CLASS, CLASS/DIVISION or /DIVISION.")
+        scope.append((class_ or None, division or None))
+    return tuple(dict.fromkeys(scope))
+
 @app.post("/login")
-async def login(file: UploadFile = File(...)):
+async def login(background_tasks: BackgroundTasks,
+                file: UploadFile = File(...),
+                scope: list[str] | None = Query(None),
+                fallback: bool = False):
     
     """
     Endpoint for user login.
 
     When called with a file upload, this function processes the image, recognizes the user, and
     handles the login process. The recognized user's identity and login status are returned as a response.
+    The image is decoded in memory; a sampled share of the frames is saved to LOGIN_DIR after the response.
+
+    Parameters:
+    file (UploadFile): The frame of the user's face.
+    scope (list): Only match the users of these sections, each one a class ('10'), a division of a class
+                  ('10/A') or a division of every class ('/A'). Everyone is searched without a scope.
+    fallback (bool): Search everyone when no user of the scope matches.
     """
 
-    # Set a unique filename for the uploaded image
-    file.filename = f"{LOGIN_DIR}/{uuid.uuid4()}.png" 
+    started = time.perf_counter()
+
+    try:
+        scope = parse_scope(scope)
+    except ValueError as e:
+        return finish('login', 'invalid_scope', started, {"status": 400, "message": str(e)})
 
     # Read the contents of the uploaded file
-    contents = await file.read()
+    with STAGE_LATENCY.time(stage='upload_read'):
+        contents = await file.read()
 
-    # Write the binary contents into the opened file
-    with open(file.filename, "wb") as f:
-        f.write(contents)
+    # Keep a sampled copy of the frame for auditing, written once the response is sent
+    if LOGIN_AUDIT_SAMPLE_RATE > 0:
+        background_tasks.add_task(save_login_frame, contents, LOGIN_DIR, LOGIN_AUDIT_SAMPLE_RATE,
+                                  LOGIN_AUDIT_RETENTION_DAYS, LOGIN_AUDIT_MAX_FILES)
 
-    # Recognize the user's face from the uploaded image
-    image = cv2.imread(file.filename)
-    email_id, match_status = recognize(image, DB_PATH)
+    # Recognize the user's face from the uploaded image. Decoding, detection and encoding run in the worker
+    # pool, the lookup in the resident matcher stays in this process. One face detection for the whole
+    # request: a frame without a face stops here, otherwise its box is reused by the hash of the face crop,
+    # the encoding and the anti-spoofing crops.
+    image, bbox, key = await run_cpu(decode_and_hash_face, contents)
+    if image is None:
+        return finish('login', 'invalid_image', started,
+                      {"status": 400, "message": "The uploaded file is not a valid image."})
+
+    # The matcher may still be loading during the warm-up, wait for it off the event loop
+    generation = (await run_io(get_matcher, DB_PATH)).generation
+
+    # A repeated face reuses the result computed for it, as long as no user was enrolled since and it is
+    # searched in the same scope (part of the cache key)
+    cached = None
+    if key is not None:
+        cached = login_cache.lookup(key, generation, (scope, fallback))
+
+    computed = False
+    if cached is not None and cached[1] == 0 and cached[2] <= RESULT_CACHE_TRUST_S:
+        # The same crop moments ago: the same face, its user is reused without encoding it
+        email_id, match_status, label = cached[0]
+    else:
+        cached = None if cached is None else cached[0]
+        embedding = None if bbox is None else await run_cpu(encode_face, image, bbox)
+        if embedding is None:
+            email_id, match_status, label = 'no_persons_found', False, None
+        else:
+            if cached is not None:
+                email_id, match_status, label = cached
+                # A cached match only stands if this face is within tolerance of that user, one distance
+                if match_status and not await run_io(confirm_match, embedding, email_id, DB_PATH):
+                    cached = None
+
+            if cached is None:
+                email_id, match_status = await run_io(match_embedding, embedding, DB_PATH, scope, fallback)
+                label = None
+
+        computed = cached is None and key is not None and embedding is not None
+
+    if match_status and label is None:
+        label = await run_cpu(spoof_test, image, bbox)
+
+    if computed:
+        login_cache.put(key, generation, (email_id, match_status, label if RESULT_CACHE_SPOOF else None),
+                        (scope, fallback))
 
     if match_status:
-        label = spoof_test(image)
         if label == 1:
-            # Check if the user is already logged in
-            logged_in_users = get_logged_in_users(ATTENDANCE_LOG_DIR)
-            if email_id in logged_in_users and logged_in_users[email_id]:
-                return {"user": email_id, "message": "You are already logged in."}
-
-            # If the user's face is recognized, update the login status and log the entry time
-            if match_status:
-                logged_in_users[email_id] = True
-                local_timezone = pytz.timezone('Asia/Kolkata')  
-                current_datetime = datetime.datetime.now(local_timezone)
-                formatted_date = current_datetime.strftime("%Y-%m-%d")
-                formatted_datetime = current_datetime.strftime("%H:%M:%S")
-                with open(os.path.join(ATTENDANCE_LOG_DIR, '{}.csv'.format(formatted_date)), 'a') as f:
-                    f.write('{},{},{}\n'.format(email_id, formatted_datetime, 'IN'))
-                    f.close()
-            return {'user': email_id, 'match_status': match_status}
+            # Log the entry time unless the user is already logged in
+            with STAGE_LATENCY.time(stage='attendance_write'):
+                logged_in = await run_io(attendance.log_in, email_id)
+            if logged_in is None:
+                return finish('login', 'already_logged_in', started,
+                              {"user": email_id, "message": "You are already logged in."})
+
+            return finish('login', 'matched', started, {'user': email_id, 'match_status': match_status})
         else:
-            return {'user': email_id, 'message' : "It seems like you are a spoofer! Try again if not a spoofer."}
+            return finish('login', 'spoofer', started,
+                          {'user': email_id, 'message' : "It seems like you are a spoofer! Try again if not a spoofer."})
     else:
-        return {'user': email_id, 'match_status': match_status}
+        return finish('login', 'no_face' if email_id == 'no_persons_found' else 'unknown', started,
+                      {'user': email_id, 'match_status': match_status})
+
+
+def finish(endpoint, outcome, started, response):
+
+    """
+    Count a request by outcome, record its latency and return its response unchanged.
+    """
+
+    elapsed = time.perf_counter() - started
+    REQUESTS.inc(endpoint=endpoint, outcome=outcome)
+    REQUEST_LATENCY.observe(elapsed, endpoint=endpoint)
+    if endpoint not in startup["first_request_s"]:
+        startup["first_request_s"][endpoint] = elapsed
+    return response
+
+@app.get("/cache_stats")
+async def cache_stats():
+
+    """
+    Endpoint to check the hit and miss counters of the login result cache, to tune its size and TTL.
+    """
+
+    return login_cache.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+
+    """
+    Endpoint exposing the pipeline metrics in the Prometheus text format.
+
+    Per-stage latency histograms (upload read, decode, detection, encoding, matching, anti-spoofing and
+    every model's forward, attendance and user writes), request counters by endpoint and outcome, queue
+    depths of the worker pool and the micro-batchers, model loads and the login cache counters.
+    With WORKER_POOL_KIND = 'process' the stages that run inside the workers (decode, detect, encode,
+    spoof) are recorded in the worker processes and do not appear here.
+    """
+
+    return starlette.responses.Response(content=metrics.render(),
+                                        media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.post("/group_login")
+async def group_login(file: UploadFile = File(...),
+                      scope: list[str] | None = Query(None),
+                      fallback: bool = False):
+
+    """
+    Endpoint to log in every registered user found in a group photo, such as a whole classroom.
+
+    Every face of the photo is detected once, all of them are encoded in one call and matched against the
+    registered users with one query, then each recognized face goes through the anti-spoofing test on its
+    own crop. The IN entries of all the recognized real faces are written in one append.
+
+    Parameters:
+    file (UploadFile): The group photo.
+    scope (list): Only match the users of these sections, as in /login, e.g. the class in the photo.
+    fallback (bool): Search everyone for the faces without a match in the scope.
+
+    Returns:
+    dict: The number of faces found, the users logged in by this photo and, under 'faces', the box
+          [x, y, w, h] of every face with its user, match distance and status: 'logged_in',
+          'already_logged_in', 'spoof', 'unknown_person' or 'duplicate' (the user was matched by a closer
+          face of the same photo).
+    """
+
+    try:
+        scope = parse_scope(scope)
+    except ValueError as e:
+        return {"status": 400, "message": str(e)}
+
+    contents = await file.read()
+
+    image = await run_cpu(decode_image, contents)
+    if image is None:
+        return {"status": 400, "message": "The uploaded file is not a valid image."}
+
+    # Detection and encoding in the worker pool, matching in the resident matcher
+    bboxes, embeddings = await run_cpu(encode_faces, image)
+    if len(embeddings) == 0:
+        return {"status": 200, "count": 0, "logged_in": [], "faces": []}
+
+    matches = await run_io(match_embeddings, embeddings, DB_PATH, scope, fallback)
+
+    faces = [{"bbox": bbox, "user": email_id, "distance": round(distance, 4) if math.isfinite(distance) else None,
+              "status": 'unknown_person' if not match_status else None}
+             for bbox, (email_id, match_status, distance) in zip(bboxes, matches)]
+
+    # A user can only be in the photo once, keep the closest face
+    closest = {}
+    for i, face in enumerate(faces):
+        if face["status"] is None:
+            best = closest.get(face["user"])
+            if best is None or face["distance"] < faces[best]["distance"]:
+                closest[face["user"]] = i
+    for i, face in enumerate(faces):
+        if face["status"] is None and closest[face["user"]] != i:
+            face["status"] = 'duplicate'
+
+    recognized = sorted(closest.values())
+    labels = await run_cpu(spoof_test_faces, image, [bboxes[i] for i in recognized])
+
+    real = []
+    for i, label in zip(recognized, labels):
+        if label == 1:
+            real.append(faces[i]["user"])
+        else:
+            faces[i]["status"] = 'spoof'
+
+    # Log the entry time of every real face unless the user is already logged in
+    times = await run_io(attendance.log_in_many, real)
+    for i in recognized:
+        if faces[i]["status"] is None:
+            faces[i]["status"] = 'logged_in' if times[faces[i]["user"]] is not None else 'already_logged_in'
+
+    return {"status": 200,
+            "count": len(faces),
+            "logged_in": [email for email in real if times[email] is not None],
+            "faces": faces}
+
+
+@app.websocket("/ws/kiosk")
+async def kiosk_stream(websocket: WebSocket,
+                       scope: list[str] | None = Query(None),
+                       fallback: bool = False):
+
+    """
+    WebSocket endpoint for attendance from a kiosk's camera stream.
+
+    The client sends every frame as one binary message (JPEG or PNG). Faces are tracked across frames and
+    the full recognition (encoding, matching, anti-spoofing, login) only runs when a track needs it, see the
+    KIOSK_* settings. Frames that arrive while the previous one is being processed are dropped, only the
+    latest one is kept, so a slow server never falls behind the camera.
+
+    A kiosk in front of a classroom connects with the sections it serves, e.g. /ws/kiosk?scope=10/A, and its
+    faces are only matched against these users (see /login), with fallback=true against everyone on a miss.
+
+    The server answers with JSON events, per track and not per frame:
+    - {"event": "recognized", "track", "bbox", "user", "status", "distance", "frame"} when a track gets an
+      identity or its identity changes. status is 'logged_in', 'already_logged_in', 'spoof' or 'unknown_person'.
+    - {"event": "lost", "track", "user", "frame"} when a track leaves the picture.
+    - {"event": "error", "message", "frame"} for a frame that is not a valid image.
+    - {"event": "error", "message"} for an invalid scope, then the connection is closed.
+    """
+
+    await websocket.accept()
+
+    try:
+        scope = parse_scope(scope)
+    except ValueError as e:
+        await websocket.send_json({"event": "error", "message": str(e)})
+        await websocket.close(code=1008)
+        return
+
+    tracker = FaceTracker(KIOSK_IOU_THRESHOLD, KIOSK_MAX_MISSED, KIOSK_MIN_CONFIDENCE, KIOSK_RETRY_FRAMES)
+    frames = asyncio.Queue(maxsize=1)
+
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes"):
+                    # Keep only the latest frame
+                    if frames.full():
+                        frames.get_nowait()
+                    frames.put_nowait(message["bytes"])
+        finally:
+            if frames.full():
+                frames.get_nowait()
+            frames.put_nowait(None)
+
+    receiver = asyncio.create_task(receive_frames())
+    frame = 0
+    try:
+        while True:
+            contents = await frames.get()
+            if contents is None:
+                break
+            frame += 1
+
+            for event in await process_kiosk_frame(tracker, contents, scope, fallback):
+                event["frame"] = frame
+                await websocket.send_json(event)
+    except starlette.websockets.WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+
+
+async def process_kiosk_frame(tracker, contents, scope=None, fallback=False):
+
+    """
+    Advance the tracker of a kiosk stream by one frame and recognize the tracks that need it, within the
+    scope of the kiosk.
+
+    Returns:
+    list: The events of this frame, see kiosk_stream().
+    """
+
+    detections = await run_cpu(detect_frame, contents, KIOSK_DETECTION_SIZE)
+    if detections is None:
+        return [{"event": "error", "message": "The frame is not a valid image."}]
+
+    to_recognize, dropped = tracker.update(detections)
+    events = [{"event": "lost", "track": track.id, "user": track.user} for track in dropped]
+    if not to_recognize:
+        return events
+
+    # All the tracks of the frame share one encoding call, one matcher query and one spoof forward per model
+    embeddings, labels = await run_cpu(analyze_frame, contents, [track.bbox for track in to_recognize])
+    matches = await run_io(match_embeddings, embeddings, DB_PATH, scope, fallback)
+
+    real = sorted({email_id for (email_id, match_status, _), label in zip(matches, labels)
+                   if match_status and label == 1})
+    times = await run_io(attendance.log_in_many, real) if real else {}
+
+    for track, (email_id, match_status, distance), label in zip(to_recognize, matches, labels):
+        if not match_status:
+            status = 'unknown_person'
+        elif label != 1:
+            status = 'spoof'
+        elif times[email_id] is not None:
+            status = 'logged_in'
+        else:
+            status = 'already_logged_in'
+
+        # A second check of a face that was already logged in is not news
+        if track.user == email_id and {track.status, status} <= {'logged_in', 'already_logged_in'}:
+            status = track.status
+        changed = (track.user, track.status) != (email_id, status)
+
+        tracker.recognized(track, email_id, status)
+        if changed:
+            events.append({"event": "recognized", "track": track.id, "bbox": track.bbox, "user": email_id,
+                           "status": status, "distance": round(distance, 4) if math.isfinite(distance) else None})
+
+    return events
 
 
 @app.post("/logout")
@@ -107,31 +636,115 @@ async def logout(email: str):
     The user's email and a logout success message are returned as a response.
     """
 
-    # Check if the user is already logged in
-    registered_users = get_registered_users()
-    registered_emails = [user['email'] for user in registered_users]
-    if email not in registered_emails:
+    # Check if the user is registered
+    if not await run_io(user_already_registered, email, DB_PATH):
         return {"user": email, "message": "User does not exist"}
 
 
-    logged_in_users = get_logged_in_users(ATTENDANCE_LOG_DIR)
-    if email not in logged_in_users.keys():
+    if await run_io(attendance.status, email) is None:
         return {"user": email, "message": "User is not logged in."}
     
     else:
-        local_timezone = pytz.timezone('Asia/Kolkata')  
-        current_datetime = datetime.datetime.now(local_timezone)
-        formatted_date = current_datetime.strftime("%Y-%m-%d")
-        formatted_datetime = current_datetime.strftime("%H:%M:%S")
-
         # Write the logout time into the attendance log file for the current date
-        with open(os.path.join(ATTENDANCE_LOG_DIR, '{}.csv'.format(formatted_date)), 'a') as f:
-            f.write('{},{},{}\n'.format(email, formatted_datetime, 'OUT'))
-
-        # Update the login status to indicate the user has logged out
-        logged_in_users[email] = False
+        await run_io(attendance.record, email, 'OUT')
         return {'user': email, 'message': 'Logged out successfully.'}
 
+@app.get("/present_users")
+async def present_users():
+
+    """
+    Endpoint to list the users who are currently logged in.
+
+    The answer comes from the in-memory presence table, today's log is only read again after another
+    worker wrote to it.
+    """
+
+    users = await run_io(attendance.present)
+    return {"count": len(users), "users": users}
+
+@app.get("/present_users/{email}")
+async def presence_status(email: str):
+
+    """
+    Endpoint to check whether one user is currently logged in.
+    """
+
+    status = await run_io(attendance.status, email)
+    return {"user": email, "logged_in": status is True, "logged_in_today": status is not None}
+
+def admin_denied(token):
+
+    """
+    Return the error response of an admin request with a missing or wrong token, or None if it is allowed.
+    """
+
+    if ADMIN_TOKEN is None:
+        return starlette.responses.JSONResponse(content={"message": "Admin endpoints are disabled."},
+                                                status_code=404)
+    if token is None or not secrets.compare_digest(token, ADMIN_TOKEN):
+        return starlette.responses.JSONResponse(content={"message": "Invalid admin token."}, status_code=403)
+    return None
+
+@app.post("/admin/profiling")
+async def start_profiling(route: str,
+                          every: int = Query(10, ge=0),
+                          trace_memory: bool = False,
+                          x_admin_token: str | None = Header(None)):
+
+    """
+    Endpoint to start, change or stop the sampled profiling of a route, without restarting the server.
+
+    One request out of `every` to the route is profiled: the work it runs in the worker pool and in the
+    main process threads is run under cProfile and, with trace_memory, tracemalloc snapshots are taken
+    around its spoof and encode stages. Tracing memory slows the sampled requests down noticeably.
+
+    Parameters:
+    route (str): The request path to sample, e.g. '/login'.
+    every (int): Profile one request out of `every`, 0 stops the sampling of the route and drops its results.
+    trace_memory (bool): Capture the allocations of the spoof and encode stages.
+    """
+
+    denied = admin_denied(x_admin_token)
+    if denied is not None:
+        return denied
+
+    profiler.configure(route, every, trace_memory)
+    return {"route": route, "every": every, "trace_memory": trace_memory}
+
+@app.get("/admin/profiling")
+async def profiling_report(top: int = Query(20, ge=1),
+                           sort: str = Query('cumulative', regex='^(cumulative|tottime|calls)$'),
+                           x_admin_token: str | None = Header(None)):
+
+    """
+    Endpoint returning the aggregated results of every sampled route.
+
+    Per route: the number of requests seen and sampled, the mean time of a sampled request, the `top` hot
+    functions sorted by `sort` (calls, own time and cumulative time) and, for each traced stage, its peak
+    memory and the `top` source lines by memory still held at its end.
+    """
+
+    denied = admin_denied(x_admin_token)
+    if denied is not None:
+        return denied
+
+    return await run_io(profiler.report, top, sort)
+
+@app.delete("/admin/profiling")
+async def stop_profiling(x_admin_token: str | None = Header(None)):
+
+    """
+    Endpoint to stop the sampling of every route and drop all profiling results.
+    """
+
+    denied = admin_denied(x_admin_token)
+    if denied is not None:
+        return denied
+
+    profiler.reset()
+    return {"message": "Profiling stopped."}
+
+
 @app.post("/register_new_user")
 async def register_new_user(name: str,
                             email: str,
@@ -164,11 +777,14 @@ async def register_new_user(name: str,
           indicating successful registration.
     """
     
+    started = time.perf_counter()
+
     # Check if the user is already registered
-    if user_already_registered(email):
-        return {"status" : 400,
-                "user" : email, 
-                "message": f"You are already registered! Proceed to login."}
+    if await run_io(user_already_registered, email, DB_PATH):
+        return finish('register_new_user', 'already_registered', started,
+                      {"status" : 400,
+                       "user" : email,
+                       "message": f"You are already registered! Proceed to login."})
     
     # Format the name to title case
     name = name.title()
@@ -177,54 +793,210 @@ async def register_new_user(name: str,
     image_path = os.path.join(DB_PATH, '{}.png'.format(email))
     
     # Set a unique filename for the uploaded image
-    contents = await file.read()
+    with STAGE_LATENCY.time(stage='upload_read'):
+        contents = await file.read()
 
-    # # Save the image file
-    with open(image_path, "wb") as f:
-        f.write(contents)
+    # Decode the image in memory, the saved file is only kept as the user's record
+    image = await run_cpu(decode_image, contents)
+    if image is None:
+        return finish('register_new_user', 'invalid_image', started,
+                      {"status": 400, "user": email, "message": "The uploaded file is not a valid image."})
 
-    # Get face embeddings using face_recognition library
-    image = cv2.imread(image_path)  
+    # One face detection shared by the anti-spoofing test and the encoding, reject images without a face
+    bbox = await run_cpu(detect_face, image)
+    if bbox is None:
+        return finish('register_new_user', 'no_face', started,
+                      {"status": 400, "user": email, "message": "No face found in the uploaded image."})
 
-    label = spoof_test(image)
+    # # Save the image file
+    with STAGE_LATENCY.time(stage='user_write'):
+        await run_io(write_file, image_path, contents)
+
+    label = await run_cpu(spoof_test, image, bbox)
 
     if label == 1:
-        embeddings = face_recognition.face_encodings(image)
-
-        # Save the embeddings as a pickle file
-        embeddings_path = os.path.join(DB_PATH, '{}.pickle'.format(email))
-        with open(embeddings_path, 'wb') as file_:
-            pickle.dump(embeddings, file_)
-
-        # Append user details to the CSV file
-        csv_file_path = os.path.join(DB_PATH, 'user_details.csv')
-        is_new_file = not os.path.exists(csv_file_path)
-
-        with open(csv_file_path, 'a', newline='') as csv_file:
-            fieldnames = ['Name', 'Email', 'Phone Number', 'Class', 'Division', 'Image Path', 'Embeddings Path']
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-
-            if is_new_file:
-                writer.writeheader()
-
-            writer.writerow({
-                'Name': name,
-                'Email': email,
-                'Phone Number': phone_number,
-                'Class': class_,
-                'Division': division,
-                'Image Path': image_path,
-                'Embeddings Path': embeddings_path
-            })
-
-        return {'status': 200, 
-                "user" : email,
-                "message": "You registered successfully."}
+        embeddings = [await run_cpu(encode_face, image, bbox)]
+
+        # Save the embeddings, the user details and update the matcher off the event loop
+        with STAGE_LATENCY.time(stage='user_write'):
+            await run_io(save_new_user, name, email, phone_number, class_, division, image_path, embeddings)
+
+        return finish('register_new_user', 'registered', started,
+                      {'status': 200,
+                       "user" : email,
+                       "message": "You registered successfully."})
     
     else:
-        return{'status' : 409,
-               "user" : email,
-               "message" : "Spoofed registration attempt detected. Please provide valid identification."}
+        return finish('register_new_user', 'spoofer', started,
+                      {'status' : 409,
+                       "user" : email,
+                       "message" : "Spoofed registration attempt detected. Please provide valid identification."})
+
+
+def write_file(path, contents):
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+def save_new_user(name, email, phone_number, class_, division, image_path, embeddings):
+
+    """
+    Save the details and embeddings of a new user to the storage and make the user visible to the
+    resident matcher.
+    """
+
+    storage.add_user(name, email, phone_number, class_, division, image_path, embeddings)
+
+    # Make the new user visible to recognize() without reloading the database
+    if len(embeddings) > 0:
+        get_matcher(DB_PATH).add(email, embeddings[0])
+
+
+@app.post("/bulk_register")
+async def bulk_register(archive: UploadFile = File(...), manifest: UploadFile = File(...)):
+
+    """
+    Endpoint for registering many users at once.
+
+    The archive is a zip of the users' photos and the manifest a CSV file with the columns name, email,
+    class, division and, optionally, phone_number and image (the photo's file name in the archive,
+    '<email>.png' or '<email>.jpg' by default). Every photo goes through the same checks as
+    /register_new_user, spread over the worker pool, and all the accepted users are then saved in one
+    write to the storage (one transaction with SQLite) and added to the matcher in one step.
+
+    Parameters:
+    archive (UploadFile): Zip archive of the users' photos.
+    manifest (UploadFile): CSV manifest with one row per user.
+
+    Returns:
+    dict: The number of rows, registered and rejected users, the elapsed time, the images processed per
+          second and, under 'results', the status of every manifest row: 'registered', 'already_registered',
+          'duplicate', 'invalid_row', 'missing_image', 'image_too_large', 'invalid_image', 'spoof' or
+          'no_face'.
+    """
+
+    started = time.perf_counter()
+
+    try:
+        rows = read_manifest((await manifest.read()).decode('utf-8-sig'))
+    except UnicodeDecodeError:
+        return {"status": 400, "message": "The manifest must be a UTF-8 CSV file."}
+
+    if len(rows) > BULK_REGISTER_MAX_ROWS:
+        return {"status": 400, "message": "The manifest has more than {} rows.".format(BULK_REGISTER_MAX_ROWS)}
+
+    try:
+        zip_file = zipfile.ZipFile(archive.file)
+    except zipfile.BadZipFile:
+        return {"status": 400, "message": "The archive must be a zip file."}
+
+    infos = [info for info in zip_file.infolist() if not info.is_dir()]
+    if len(infos) > BULK_REGISTER_MAX_MEMBERS:
+        zip_file.close()
+        return {"status": 400, "message": "The archive has more than {} files.".format(BULK_REGISTER_MAX_MEMBERS)}
+
+    # Photos are looked up by file name, whatever folder they are in inside the archive
+    members = {os.path.basename(info.filename): info for info in infos}
+
+    # Every row is checked against one snapshot of the registry, read off the event loop
+    registered = await run_io(registered_emails)
+
+    # Rows that can be rejected without looking at the photo
+    statuses = [None] * len(rows)
+    pending = []
+    seen = set()
+    for i, row in enumerate(rows):
+        email = row['email']
+        candidates = [row['image']] if row['image'] else ['{}.png'.format(email), '{}.jpg'.format(email)]
+        member = next((members[name] for name in candidates if name in members), None)
+
+        if not (row['name'] and email and row['class'] and row['division']):
+            statuses[i] = 'invalid_row'
+        elif email in seen:
+            statuses[i] = 'duplicate'
+        elif email in registered:
+            statuses[i] = 'already_registered'
+        elif member is None:
+            statuses[i] = 'missing_image'
+        elif not acceptable_member(member):
+            statuses[i] = 'image_too_large'
+        else:
+            pending.append((i, member))
+        seen.add(email)
+
+    semaphore = asyncio.Semaphore(BULK_REGISTER_CONCURRENCY)
+    accepted = []
+
+    async def enroll(i, member):
+        async with semaphore:
+            contents = await run_io(zip_file.read, member)
+            status, embeddings = await run_cpu(enroll_image, contents)
+
+        if status != 'ok':
+            statuses[i] = status
+            return
+
+        row = rows[i]
+        image_path = os.path.join(DB_PATH, '{}.png'.format(row['email']))
+        await run_io(write_file, image_path, contents)
+        accepted.append((i, (row['name'].title(), row['email'], row['phone_number'], row['class'],
+                             row['division'], image_path, embeddings)))
+
+    # Decode, anti-spoofing and encoding of the photos run in parallel in the worker pool
+    await asyncio.gather(*(enroll(i, member) for i, member in pending))
+    zip_file.close()
+
+    # Saved in manifest order, in a single write
+    accepted.sort(key=lambda item: item[0])
+    await run_io(save_new_users, [user for _, user in accepted])
+    for i, _ in accepted:
+        statuses[i] = 'registered'
+
+    elapsed = time.perf_counter() - started
+    return {"status": 200,
+            "rows": len(rows),
+            "registered": len(accepted),
+            "rejected": len(rows) - len(accepted),
+            "elapsed_s": round(elapsed, 3),
+            "images_per_sec": round(len(pending) / elapsed, 2) if elapsed > 0 else None,
+            "results": [{"row": i + 1, "email": row['email'], "status": status}
+                        for i, (row, status) in enumerate(zip(rows, statuses))]}
+
+
+def registered_emails():
+    return {user["email"] for user in storage.users()}
+
+
+def acceptable_member(info):
+
+    """
+    Check the sizes the archive declares for a photo before reading it: its uncompressed size, which
+    zipfile never reads past, and its compression ratio.
+    """
+
+    if info.file_size > BULK_REGISTER_MAX_IMAGE_BYTES:
+        return False
+    return info.file_size <= BULK_REGISTER_MAX_COMPRESSION_RATIO * max(info.compress_size, 1)
+
+
+def save_new_users(users):
+
+    """
+    Save the details and embeddings of several new users in one write to the storage and add them to the
+    resident matcher in one step.
+
+    Parameters:
+    users (list): (name, email, phone_number, class_, division, image_path, embeddings) tuples.
+    """
+
+    if not users:
+        return
+
+    storage.add_users(users)
+
+    enrolled = [(user[1], user[-1][0]) for user in users if len(user[-1]) > 0]
+    if enrolled:
+        get_matcher(DB_PATH).add_many([email for email, _ in enrolled], [embedding for _, embedding in enrolled])
 
 
 @app.get("/get_attendance_logs")
@@ -233,41 +1005,113 @@ async def get_attendance_logs():
     """
     Endpoint to retrieve the attendance logs.
 
-    This function creates a zip archive of the attendance logs located in the ATTENDANCE_LOG_DIR directory.
-    The zip archive is then returned as a response, allowing users to download the attendance logs as a zip file.
-    If the ATTENDANCE_LOG_DIR directory is empty, it returns a response indicating that no one has logged in yet.
+    This function streams a zip archive with one CSV file per day of attendance logs.
+    The zip archive is returned as a response, allowing users to download the attendance logs as a zip file.
+    If there are no attendance logs yet, it returns a response indicating that no one has logged in yet.
+    """
+
+    return await export_attendance(format='zip')
+
+@app.get("/export_attendance")
+async def export_attendance(start: str | None = None,
+                            end: str | None = None,
+                            format: str = Query('zip', regex='^(zip|csv|ndjson)$')):
+
     """
+    Endpoint to export the attendance logs of a date range.
 
-    # File name for the zip archive
-    filename = 'attendance.zip'
+    The export is streamed while it is generated. For zip exports only today's file is compressed again,
+    the closed days come from a cache.
 
-    # Check if the ATTENDANCE_LOG_DIR directory is empty
-    if not os.listdir(ATTENDANCE_LOG_DIR):
-        # If it's empty, return a response with a status code and message
+    Parameters:
+    start (str): First day of the range, "YYYY-MM-DD". Defaults to the first day with attendance logs.
+    end (str): Last day of the range, "YYYY-MM-DD", included. Defaults to the last day with attendance logs.
+    format (str): 'zip' (one CSV per day, as in ATTENDANCE_LOG_DIR), 'csv' (one file with a date column)
+                  or 'ndjson' (one JSON object per entry).
+    """
+
+    for date in (start, end):
+        if date is not None:
+            try:
+                datetime.date.fromisoformat(date)
+            except ValueError:
+                return starlette.responses.JSONResponse(content={"message": "Dates must be formatted as YYYY-MM-DD."},
+                                                        status_code=400)
+
+    dates = await run_io(exporter.dates, start, end)
+    if not dates:
+        # If there are no logs, return a response with a status code and message
         return starlette.responses.JSONResponse(
             content={"message": "No one has logged in yet."},
             status_code=404
         )
 
-    # Create a zip archive of the attendance logs in the ATTENDANCE_LOG_DIR directory
-    shutil.make_archive(filename[:-4], 'zip', ATTENDANCE_LOG_DIR)
+    filename = 'attendance_{}_{}.{}'.format(dates[0], dates[-1], format)
+    return starlette.responses.StreamingResponse(exporter.stream(dates, format),
+                                                 media_type=EXPORT_MEDIA_TYPES[format],
+                                                 headers={"Content-Disposition": 'attachment; filename="{}"'.format(filename)})
+
+@app.get("/registered_users")
+async def registered_users(class_: str | None = None,
+                           division: str | None = None,
+                           page: int = Query(1, ge=1),
+                           page_size: int = Query(50, ge=1, le=500)):
 
-    # Return the zip archive as a response with appropriate media type and filename
-    return starlette.responses.FileResponse(filename, media_type='application/zip', filename=filename)
+    """
+    Endpoint to look up registered users as JSON, one page at a time.
+
+    The users come from the storage: the cached registry of user_details.csv (indexed by email, class and
+    division) or indexed queries on the SQLite users table.
+
+    Parameters:
+    class_ (str): Only return users of this class.
+    division (str): Only return users of this division.
+    page (int): 1-based page number.
+    page_size (int): Number of users per page, at most 500.
 
-@app.get("/get_registered_users_logs")
+    Returns:
+    dict: The total number of matching users, the page, the page size and the users of the page.
+    """
+
+    total, users = await run_io(storage.query_users, class_=class_, division=division, page=page, page_size=page_size)
+    return {"total": total, "page": page, "page_size": page_size, "users": users}
+
+@app.get("/registered_users/{email}")
+async def registered_user(email: str):
+
+    """
+    Endpoint to get the details of one registered user.
+    """
+
+    user = await run_io(storage.get_user, email)
+    if user is None:
+        return starlette.responses.JSONResponse(content={"user": email, "message": "User does not exist"},
+                                                status_code=404)
+    return user
+
+@app.get("/get_registered_users_logs", deprecated=True)
 async def get_registered_users_logs():
 
     """
     Endpoint to retrieve the registered user logs.
 
+    Deprecated: use /registered_users to look up users without downloading the whole file.
+
     This function checks if the user details CSV file exists (located at ./db/user_details.csv).
     If the file exists, it is returned as a response, allowing users to download the registered user logs as a CSV file.
     If the file does not exist, a custom JSON response is returned, indicating that there are no registered users currently.
+    With another STORAGE_BACKEND the file is not kept up to date, the CSV is built from the storage instead.
     """
 
+    if STORAGE_BACKEND != 'files':
+        users = await run_io(storage.users)
+        if not users:
+            return starlette.responses.JSONResponse(content={"message": "No registered users currently."}, status_code=200)
+        return starlette.responses.Response(users_csv(users), media_type='text/csv',
+                                            headers={"Content-Disposition": 'attachment; filename="user_details.csv"'})
+
     # File paths for the csv file in database and output file name for the response
-    db_filename = './db/user_details.csv'
+    db_filename = os.path.join(DB_PATH, 'user_details.csv')
     filename = 'user_details.csv'
 
     # Check if the file exists before proceeding
@@ -275,4 +1119,18 @@ async def get_registered_users_logs():
         return starlette.responses.JSONResponse(content={"message": "No registered users currently."}, status_code=200)
 
     # If the file exists, return it as a response
-    return starlette.responses.FileResponse(db_filename, media_type='application/zip', filename=filename)
\ No newline at end of file
+    return starlette.responses.FileResponse(db_filename, media_type='application/zip', filename=filename)
+
+
+def users_csv(users):
+
+    """
+    Write users, as returned by the storage, in the columns of the user details CSV file (without the paths).
+    """
+
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(USER_FIELDS[:5])
+    for user in users:
+        writer.writerow([user["name"], user["email"], user["phone"], user["class"], user["division"]])
+    return output.getvalue()
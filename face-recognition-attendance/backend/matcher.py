@@ -0,0 +1,478 @@
+import threading
+
+import numpy as np
+
+from ann_index import IVFIndex
+from quantization import PRECISIONS, QuantizedMatrix
+
+
+# Length of the face encodings produced by face_recognition (dlib)
+EMBEDDING_DIM = 128
+
+# Same default as face_recognition.compare_faces
+DEFAULT_TOLERANCE = 0.6
+
+# Below this many users a brute-force scan is faster than probing an ANN index
+ANN_MIN_SIZE = 10000
+
+# Rows of the scopes searched since the last enrollment change kept per SectionIndex
+SCOPE_CACHE_SIZE = 256
+
+
+def in_scope(section, scope):
+
+    """
+    Return True if a (class, division) section is part of a scope.
+
+    A scope is a tuple of (class, division) entries where None matches any value, e.g. (('10', 'A'),) for
+    one division of class 10, (('10', None),) for the whole class or (('10', 'A'), ('11', None)) for both.
+    """
+
+    return any((class_ is None or class_ == section[0]) and (division is None or division == section[1])
+               for class_, division in scope)
+
+
+class SectionIndex:
+
+    """
+    Rows of the enrolled embeddings grouped by (class, division) section, the sub-indexes of scoped searches.
+
+    Built by the first scoped search and then updated with the changed rows on every enrollment, so a scoped
+    search only gathers the rows of its sections. The rows of every scope searched since the last change are kept
+    (up to SCOPE_CACHE_SIZE scopes), a kiosk scoped to its sections finds them ready.
+
+    Parameters:
+    row_sections (list): The (class, division) section of every row, (None, None) when unknown.
+    rows (dict): section -> rows array, computed from row_sections when not given.
+    """
+
+    def __init__(self, row_sections, rows=None):
+        self.row_sections = row_sections
+        if rows is None:
+            grouped = {}
+            for row, section in enumerate(row_sections):
+                grouped.setdefault(section, []).append(row)
+            rows = {section: np.array(section_rows, dtype=np.intp) for section, section_rows in grouped.items()}
+        self.rows = rows
+        self._scopes = {}
+
+    def updated(self, changes):
+
+        """
+        Function to build the index after a change of rows.
+
+        Parameters:
+        changes (iterable): (row, section) pairs of the replaced rows and of the rows appended, in row order.
+
+        Returns:
+        SectionIndex: A new index, this one is left as it is for the searches still using it.
+        """
+
+        row_sections = list(self.row_sections)
+        added, removed = {}, {}
+        for row, section in changes:
+            if row < len(row_sections):
+                if row_sections[row] == section:
+                    continue
+                removed.setdefault(row_sections[row], []).append(row)
+                row_sections[row] = section
+            else:
+                row_sections.append(section)
+            added.setdefault(section, []).append(row)
+
+        rows = dict(self.rows)
+        for section, section_rows in removed.items():
+            rows[section] = np.setdiff1d(rows[section], section_rows)
+        for section, section_rows in added.items():
+            rows[section] = np.union1d(rows.get(section, np.empty(0, dtype=np.intp)), section_rows)
+        return SectionIndex(row_sections, rows)
+
+    def rows_in(self, scope):
+
+        """
+        Return the sorted rows of every section of a scope (see in_scope).
+        """
+
+        rows = self._scopes.get(scope)
+        if rows is None:
+            selected = [section_rows for section, section_rows in self.rows.items() if in_scope(section, scope)]
+            rows = np.sort(np.concatenate(selected)) if selected else np.empty(0, dtype=np.intp)
+            if len(self._scopes) < SCOPE_CACHE_SIZE:
+                self._scopes[scope] = rows
+        return rows
+
+
+class EmbeddingMatcher:
+
+    """
+    Resident in-memory matcher for the enrolled face embeddings.
+
+    All embeddings are kept in one contiguous float32 matrix of shape (N, 128) with a parallel
+    array of emails, so a lookup is a single vectorized distance computation instead of opening
+    and unpickling one file per user.
+
+    With index='ivf' the scan is replaced by an approximate IVF search (see ann_index.IVFIndex) once the
+    database holds at least ANN_MIN_SIZE users. The `rerank` best candidates of the approximate search are
+    scored exactly, and if none of them is within tolerance the matcher falls back to the exact scan, so the
+    accept/reject result is the same as with index='exact'.
+
+    With precision='float16' or 'int8' the exact scan reads a reduced-precision copy of the matrix (see
+    quantization.QuantizedMatrix), half or a quarter of the bytes. Its distances are off by at most the
+    quantization error of a row, so only the rows that can still be the nearest one are scored on the
+    float32 embeddings, and the winner is rescored in float64 as always: the accept/reject result is the
+    same as with precision='float32'.
+
+    With a `sections` lookup the rows are also grouped by the (class, division) of their users (see
+    SectionIndex), and match() / match_many() can search a scope of sections only, optionally falling back
+    to the whole registry when nothing within tolerance is found there.
+
+    Parameters:
+    tolerance (float): Maximum euclidean distance for a match, same meaning as in
+                       face_recognition.compare_faces.
+    index (str): 'exact' for the brute-force scan or 'ivf' for the approximate index.
+    nprobe (int): Number of IVF lists scanned per query, the recall/latency knob of the 'ivf' index.
+    n_lists (int): Number of IVF lists, defaults to about sqrt(N).
+    rerank (int): Number of approximate candidates rescored exactly. With a reduced precision, the number of
+                  rows rescored for a query that can not match anyway (every row is farther than tolerance).
+    exact_fallback (bool): Run the exact scan when the approximate search finds no match.
+    precision (str): 'float32', 'float16' or 'int8', the precision of the matrix read by the exact scan.
+    sections (callable): Returns the (class, division) of every email of a list, None disables scoped search.
+    """
+
+    def __init__(self, tolerance=DEFAULT_TOLERANCE, index='exact', nprobe=8, n_lists=None, rerank=10,
+                 exact_fallback=True, precision='float32', sections=None):
+        if index not in ('exact', 'ivf'):
+            raise ValueError("index must be 'exact' or 'ivf', got {!r}".format(index))
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of {}, got {!r}".format(', '.join(PRECISIONS), precision))
+
+        self.tolerance = tolerance
+        self.index = index
+        self.nprobe = nprobe
+        self.n_lists = n_lists
+        self.rerank = rerank
+        self.exact_fallback = exact_fallback
+        self.precision = precision
+        self.sections = sections
+        self._lock = threading.Lock()
+        # Bumped on every change of the enrolled embeddings, lets callers invalidate cached results
+        self.generation = 0
+        self._set(np.empty((0,), dtype=object), np.empty((0, EMBEDDING_DIM), dtype=np.float32))
+
+    def __len__(self):
+        return len(self.emails)
+
+    @property
+    def emails(self):
+        return self._state[0]
+
+    @property
+    def embeddings(self):
+        return self._state[1]
+
+    def refresh(self):
+
+        """
+        Pick up changes made by other processes. Nothing to do for a matcher private to this process,
+        see shared_registry.SharedEmbeddingMatcher.
+        """
+
+        return self
+
+    def load_arrays(self, emails, embeddings):
+
+        """
+        Replace the current content with an email list and the matching (N, 128) embedding matrix.
+        """
+
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        self._set(np.array(emails, dtype=object), matrix, self._build_index(matrix), self._quantize(matrix))
+        return self
+
+    def _build_index(self, matrix):
+        if self.index != 'ivf' or len(matrix) < ANN_MIN_SIZE:
+            return None
+        return IVFIndex(n_lists=self.n_lists, nprobe=self.nprobe).build(matrix)
+
+    def _quantize(self, matrix):
+        if self.precision == 'float32':
+            return None
+        return QuantizedMatrix.fit(matrix, self.precision)
+
+    def add(self, email, embedding):
+
+        """
+        Add (or replace) the embedding of a single user without reloading the whole database.
+        """
+
+        self.add_many([email], [embedding])
+
+    def add_many(self, emails, embeddings):
+
+        """
+        Add (or replace) the embeddings of several users with a single copy of the matrix.
+        """
+
+        new_embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+        with self._lock:
+            current_emails, matrix, _, index, quantized, sections = self._state
+            rows = {email: row for row, email in enumerate(current_emails)}
+
+            # Users already enrolled are replaced in place, the others appended at the end
+            appended_emails, appended = [], []
+            matrix = matrix.copy()
+            changed_rows = []
+            for email, embedding in zip(emails, new_embeddings):
+                if email in rows:
+                    matrix[rows[email]] = embedding
+                    changed_rows.append(rows[email])
+                else:
+                    rows[email] = len(current_emails) + len(appended)
+                    appended_emails.append(email)
+                    appended.append(embedding)
+                    changed_rows.append(rows[email])
+
+            if appended:
+                matrix = np.concatenate([matrix, np.asarray(appended, dtype=np.float32)])
+                current_emails = np.append(current_emails, np.array(appended_emails, dtype=object))
+
+            # The index is built once the database grows past ANN_MIN_SIZE, then updated in place
+            if index is None:
+                index = self._build_index(matrix)
+            else:
+                for row in changed_rows:
+                    index.add(row, matrix[row])
+
+            # Only the changed rows are quantized again, unless they fall outside the int8 range
+            if quantized is not None:
+                quantized = quantized.update(matrix, changed_rows)
+
+            # The section of a user enrolled again may have changed too, nothing to do before the first scoped search
+            if sections is not None:
+                sections = sections.updated(zip(changed_rows, self.sections(list(emails))))
+
+            self._set(current_emails, matrix, index, quantized, sections)
+
+    def _set(self, emails, matrix, index=None, quantized=None, sections=None):
+        # Swap in the new arrays as one tuple so concurrent readers always see a consistent state
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self._state = (emails, matrix, np.einsum('ij,ij->i', matrix, matrix), index, quantized, sections)
+        self.generation += 1
+
+    def distances(self, embedding):
+
+        """
+        Compute the euclidean distance between an embedding and every enrolled embedding.
+
+        Uses ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2 so the scan is one matrix-vector product. Always computed
+        on the float32 embeddings, whatever the precision of the scan.
+        """
+
+        return self._distances(self._state, embedding)
+
+    @staticmethod
+    def _distances(state, embedding, rows=None):
+        _, embeddings, sq_norms, _, _, _ = state
+        query = np.asarray(embedding, dtype=np.float32)
+
+        if rows is not None:
+            embeddings, sq_norms = embeddings[rows], sq_norms[rows]
+
+        sq_distances = sq_norms - 2 * (embeddings @ query) + query @ query
+        return np.sqrt(np.maximum(sq_distances, 0))
+
+    def distance_to(self, email, embedding):
+
+        """
+        Compute the float64 distance between an embedding and the enrolled embedding of one user, to confirm
+        a match found earlier without searching the whole database again.
+
+        Returns:
+        float: The distance, infinite when the user is not enrolled.
+        """
+
+        state = self._state
+        rows = self._rows_of(state, email)
+        if len(rows) == 0:
+            return float('inf')
+        return self._exact_distance(state, int(rows[-1]), embedding)
+
+    def _rows_of(self, state, email):
+        return np.flatnonzero(state[0] == email)
+
+    @staticmethod
+    def _exact_distance(state, row, embedding):
+        # float64 distance of one row, the same computation as face_recognition.face_distance
+        return float(np.linalg.norm(state[1][row].astype(np.float64) - np.asarray(embedding, dtype=np.float64)))
+
+    def _candidates(self, quantized, queries):
+
+        """
+        Function to select, for every query, the rows to rescore after the reduced-precision scan.
+
+        A scanned distance is within quantized.error of the real one, so the nearest row is among the rows
+        scanned within 2 * error of the closest. When even the closest can not be within tolerance, the
+        `rerank` closest rows are enough to name the (rejected) best match.
+
+        Returns:
+        list: One array of rows per query.
+        """
+
+        sq_distances = quantized.sq_distances(queries)
+        closest = np.sqrt(np.maximum(sq_distances.min(axis=1), 0))
+        limits = (closest + 2 * quantized.error) ** 2
+
+        candidates = []
+        for sq_distance, limit, distance in zip(sq_distances, limits, closest):
+            rows = np.flatnonzero(sq_distance <= limit)
+            if len(rows) > self.rerank and distance - quantized.error > self.tolerance:
+                rows = rows[np.argpartition(sq_distance[rows], self.rerank - 1)[:self.rerank]]
+            candidates.append(rows)
+        return candidates
+
+    def _rerank(self, state, embedding, rows):
+        # Closest of the candidate rows on the float32 embeddings
+        return int(rows[np.argmin(self._distances(state, embedding, rows))])
+
+    def _approximate_match(self, state, embedding):
+        emails, embeddings, _, index, _, _ = state
+
+        # Rows added after this state was taken may already be in the index lists
+        rows = index.candidates(embedding, self.nprobe)
+        rows = rows[rows < len(emails)]
+        if len(rows) == 0:
+            return None, float('inf')
+
+        # Rescore the best candidates exactly and keep the closest
+        distances = self._distances(state, embedding, rows)
+        k = min(self.rerank, len(rows))
+        top = rows[np.argpartition(distances, k - 1)[:k]]
+        exact = [self._exact_distance(state, row, embedding) for row in top]
+        best = int(np.argmin(exact))
+
+        return emails[top[best]], exact[best]
+
+    def _email_list(self, emails):
+        return list(emails)
+
+    def _scope_rows(self, state, scope):
+        sections = state[5]
+        if sections is None:
+            if self.sections is None:
+                raise ValueError("a scoped search needs the sections of the users, see the sections option")
+
+            # Built on the first scoped search only, matchers never searched by scope do not look users up
+            with self._lock:
+                current = self._state
+                sections = current[5]
+                if sections is None:
+                    sections = SectionIndex(list(self.sections(self._email_list(current[0]))))
+                    self._state = current[:5] + (sections,)
+
+        # The index may be newer than the state of this search, drop the rows it does not have
+        rows = sections.rows_in(scope)
+        return rows[:np.searchsorted(rows, len(state[0]))]
+
+    def match(self, embedding, scope=None, fallback=False):
+
+        """
+        Find the closest enrolled user for a face embedding.
+
+        Parameters:
+        embedding (numpy.ndarray): The 128-d face encoding to look up.
+        scope (tuple): Only search these (class, division) sections, see in_scope. None searches everyone.
+        fallback (bool): Search everyone when no user of the scope is within tolerance.
+
+        Returns:
+        tuple: The best matching email (or None when the database or the scope is empty) and its distance.
+               The caller accepts the match when the distance is <= self.tolerance.
+        """
+
+        state = self._state
+        emails, _, _, index, quantized, _ = state
+        if len(emails) == 0:
+            return None, float('inf')
+
+        if scope is not None:
+            rows = self._scope_rows(state, scope)
+            email, distance = None, float('inf')
+            if len(rows) > 0:
+                best = int(rows[np.argmin(self._distances(state, embedding, rows))])
+                email, distance = emails[best], self._exact_distance(state, best, embedding)
+            if distance <= self.tolerance or not fallback:
+                return email, distance
+
+        if index is not None:
+            email, distance = self._approximate_match(state, embedding)
+            if distance <= self.tolerance or not self.exact_fallback:
+                return email, distance
+
+        if quantized is not None:
+            query = np.asarray(embedding, dtype=np.float32).reshape(1, EMBEDDING_DIM)
+            best = self._rerank(state, embedding, self._candidates(quantized, query)[0])
+        else:
+            best = int(np.argmin(self._distances(state, embedding)))
+
+        # Recompute the winner in float64 so the accept/reject decision matches compare_faces
+        return emails[best], self._exact_distance(state, best, embedding)
+
+    def match_many(self, embeddings, scope=None, fallback=False):
+
+        """
+        Find the closest enrolled user for several face embeddings at once.
+
+        Without an index every query is scored against the whole database in one matrix product.
+
+        Parameters:
+        embeddings (list): The 128-d face encodings to look up.
+        scope (tuple): Only search these (class, division) sections, see match().
+        fallback (bool): Search everyone for the faces without a match in the scope.
+
+        Returns:
+        list: One (email, distance) tuple per embedding, as returned by match().
+        """
+
+        state = self._state
+        emails, matrix, sq_norms, index, quantized, _ = state
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+        if len(emails) == 0:
+            return [(None, float('inf'))] * len(queries)
+
+        if scope is not None:
+            return self._scoped_match_many(state, queries, embeddings, scope, fallback)
+
+        if index is not None:
+            return [self.match(query) for query in queries]
+
+        if quantized is not None:
+            candidates = self._candidates(quantized, queries)
+            best = [self._rerank(state, query, rows) for query, rows in zip(queries, candidates)]
+        else:
+            sq_distances = (sq_norms[None, :] - 2 * (queries @ matrix.T)
+                            + np.einsum('ij,ij->i', queries, queries)[:, None])
+            best = np.argmin(sq_distances, axis=1)
+
+        # Recompute the winners in float64 so the accept/reject decision matches compare_faces
+        return [(emails[row], self._exact_distance(state, row, embedding))
+                for row, embedding in zip(best, embeddings)]
+
+    def _scoped_match_many(self, state, queries, embeddings, scope, fallback):
+        # One matrix product over the rows of the scope, then the misses against everyone if asked
+        emails, matrix, sq_norms = state[:3]
+        rows = self._scope_rows(state, scope)
+        if len(rows) == 0:
+            matches = [(None, float('inf'))] * len(queries)
+        else:
+            sq_distances = (sq_norms[rows][None, :] - 2 * (queries @ matrix[rows].T)
+                            + np.einsum('ij,ij->i', queries, queries)[:, None])
+            best = rows[np.argmin(sq_distances, axis=1)]
+            matches = [(emails[row], self._exact_distance(state, row, embedding))
+                       for row, embedding in zip(best, embeddings)]
+
+        misses = [i for i, (_, distance) in enumerate(matches) if distance > self.tolerance]
+        if fallback and misses:
+            for i, match in zip(misses, self.match_many([embeddings[i] for i in misses])):
+                matches[i] = match
+        return matches
@@ -0,0 +1,178 @@
+import bisect
+import threading
+import time
+
+
+# Latency buckets in seconds, from a cached match (sub-millisecond) to a cold encoding on a slow CPU
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Every metric created in this process, in creation order, rendered by render()
+REGISTRY = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join('{}="{}"'.format(name, value) for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def _header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(_Metric):
+
+    """
+    Monotonic counter, one value per combination of label values.
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + ['{}{} {}'.format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+                                 for key, value in values]
+
+
+class Gauge(_Metric):
+
+    """
+    Gauge read from a callback when the metrics are rendered, so nothing is recorded on the request path.
+
+    The callback returns a dictionary from a tuple of label values to the current value.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def render(self):
+        values = self.callback() if self.callback is not None else {}
+        return self._header() + ['{}{} {}'.format(self.name, _format_labels(self.labelnames, key), _format_value(value))
+                                 for key, value in values.items()]
+
+
+class _Timer:
+
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+
+    """
+    Latency histogram with cumulative buckets, a sum and a count per combination of label values.
+
+    observe() is one bisect and a few additions under a lock, cheap enough for every stage of every request.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+
+        """
+        Return a context manager observing the time spent in its block.
+        """
+
+        return _Timer(self, labels)
+
+    def render(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+
+        lines = self._header()
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, key,
+                                                                               [('le', _format_value(bound))]),
+                                                      cumulative))
+            labels = _format_labels(self.labelnames, key)
+            lines.append('{}_sum{} {}'.format(self.name, labels, _format_value(counts[-1])))
+            lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+def render():
+
+    """
+    Function to render every metric of this process in the Prometheus text exposition format.
+    """
+
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics of the attendance pipeline, recorded by main.py, utils.py and anti_spoof/test.py
+
+REQUESTS = Counter('attendance_requests_total', 'Requests by endpoint and outcome.', ['endpoint', 'outcome'])
+
+REQUEST_LATENCY = Histogram('attendance_request_duration_seconds', 'Time to answer a request, by endpoint.',
+                            ['endpoint'])
+
+STAGE_LATENCY = Histogram('attendance_stage_duration_seconds',
+                          'Time spent in one stage of the pipeline (upload_read, decode, detect, encode, match, '
+                          'spoof, attendance_write, user_write).', ['stage'])
+
+SPOOF_MODEL_LATENCY = Histogram('attendance_spoof_model_duration_seconds',
+                                'Forward time of one anti-spoofing model, including its micro-batch wait.', ['model'])
+
+MODEL_LOADS = Counter('attendance_model_loads_total', 'Models loaded from disk, by model.', ['model'])
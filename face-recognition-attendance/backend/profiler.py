@@ -0,0 +1,304 @@
+import contextlib
+import contextvars
+import cProfile
+import pstats
+import threading
+import time
+import tracemalloc
+
+
+# Frames kept per allocation while tracemalloc traces, more frames cost more memory and time per allocation
+TRACEMALLOC_FRAMES = 1
+
+# Allocation sites kept per stage and per call, the aggregated top-lists are built from these
+TRACE_TOP_LINES = 50
+
+# Sampled routes, path -> RouteProfile
+_routes = {}
+_routes_lock = threading.Lock()
+
+# Route profile of the request being handled, set by ProfilingMiddleware on sampled requests only
+_current = contextvars.ContextVar('profiled_route', default=None)
+
+# Allocation diffs of the stages run by the current thread during a sampled call
+_local = threading.local()
+
+_trace_lock = threading.Lock()
+_trace_users = 0
+_trace_started = False
+
+
+class _Stats:
+
+    # Minimal profile object for pstats.Stats, which reads .stats after calling create_stats()
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class RouteProfile:
+
+    """
+    Sampling settings and aggregated results of one route.
+
+    Every `every`-th request to the route is profiled: the functions it runs in the worker pool (run_cpu) and
+    in the main process threads (run_io), where the CPU time of a request is spent, are run under cProfile
+    and their statistics are added to the route's. With trace_memory the allocations of the spoof and encode
+    stages are also measured with tracemalloc snapshots taken around them.
+
+    Parameters:
+    every (int): Profile one request out of `every`.
+    trace_memory (bool): Capture tracemalloc snapshots around the spoof and encode stages.
+    """
+
+    def __init__(self, every, trace_memory=False):
+        self.every = every
+        self.trace_memory = trace_memory
+        self.seen = 0
+        self.sampled = 0
+        self.sampled_time = 0.0
+        self.calls = 0
+        self.stats = None
+        self.allocations = {}
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            self.seen += 1
+            return self.seen % self.every == 0
+
+    def finish(self, elapsed):
+        with self._lock:
+            self.sampled += 1
+            self.sampled_time += elapsed
+
+    def add(self, stats, allocations):
+
+        """
+        Add the cProfile statistics and the allocation diffs of one profiled call.
+        """
+
+        with self._lock:
+            self.calls += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(_Stats(stats))
+            else:
+                self.stats.add(_Stats(stats))
+
+            for stage, peak, lines in allocations:
+                peaks, sites = self.allocations.setdefault(stage, ([], {}))
+                peaks.append(peak)
+                for location, size, count in lines:
+                    site = sites.setdefault(location, [0, 0, 0])
+                    site[0] += size
+                    site[1] += count
+                    site[2] += 1
+
+    def report(self, top=20, sort='cumulative'):
+        with self._lock:
+            report = {"every": self.every,
+                      "trace_memory": self.trace_memory,
+                      "requests": self.seen,
+                      "sampled": self.sampled,
+                      "sampled_mean_ms": self.sampled_time / self.sampled * 1000 if self.sampled else None,
+                      "profiled_calls": self.calls,
+                      "functions": [],
+                      "allocations": {}}
+
+            if self.stats is not None:
+                self.stats.sort_stats(sort)
+                for func in self.stats.fcn_list[:top]:
+                    primitive_calls, calls, tottime, cumtime, _ = self.stats.stats[func]
+                    report["functions"].append({"function": pstats.func_std_string(func),
+                                                "calls": calls,
+                                                "primitive_calls": primitive_calls,
+                                                "tottime_ms": tottime * 1000,
+                                                "cumtime_ms": cumtime * 1000,
+                                                "percall_ms": cumtime / calls * 1000 if calls else None})
+
+            for stage, (peaks, sites) in self.allocations.items():
+                ranked = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:top]
+                report["allocations"][stage] = {
+                    "traced": len(peaks),
+                    "peak_kb_mean": sum(peaks) / len(peaks) / 1024,
+                    "peak_kb_max": max(peaks) / 1024,
+                    "sites": [{"location": location, "size_kb": size / 1024, "count": count, "calls": calls,
+                               "mean_kb": size / calls / 1024}
+                              for location, (size, count, calls) in ranked],
+                }
+            return report
+
+
+def configure(route, every, trace_memory=False):
+
+    """
+    Function to start, change or stop the sampling of a route.
+
+    Changing the settings of a route clears its results.
+
+    Parameters:
+    route (str): The request path, e.g. '/login'.
+    every (int): Profile one request out of `every`, 0 stops the sampling and drops the route's results.
+    trace_memory (bool): Capture tracemalloc snapshots around the spoof and encode stages.
+    """
+
+    with _routes_lock:
+        if every <= 0:
+            _routes.pop(route, None)
+        else:
+            _routes[route] = RouteProfile(every, trace_memory)
+
+
+def reset():
+
+    """
+    Function to stop the sampling of every route and drop all results.
+    """
+
+    with _routes_lock:
+        _routes.clear()
+
+
+def report(top=20, sort='cumulative'):
+
+    """
+    Function to build the profiling report of every sampled route.
+
+    Parameters:
+    top (int): Number of functions and of allocation sites per stage to return.
+    sort (str): pstats sort key of the function table ('cumulative', 'tottime', 'calls', ...).
+
+    Returns:
+    dict: Per route, the request counters, the hot functions table and, for every traced stage, its peak
+          memory and the top-list of the source lines still holding memory at its end.
+    """
+
+    with _routes_lock:
+        routes = list(_routes.items())
+    return {route: profile.report(top, sort) for route, profile in routes}
+
+
+def current():
+
+    """
+    Return the RouteProfile of the request being handled if it is sampled, else None.
+    """
+
+    return _current.get()
+
+
+def profiled_call(call, trace_memory=False):
+
+    """
+    Function to run call() under cProfile, and with tracemalloc when trace_memory is set.
+
+    Runs in the thread (or worker process) that executes the call, cProfile only sees the calling thread.
+
+    Returns:
+    tuple: The result of call(), the raw cProfile statistics and the allocation diffs of the traced stages,
+           all picklable so a process pool can send them back.
+    """
+
+    profile = cProfile.Profile()
+    if trace_memory:
+        _start_tracing()
+        _local.allocations = []
+    try:
+        profile.enable()
+        try:
+            result = call()
+        finally:
+            profile.disable()
+    finally:
+        allocations = getattr(_local, 'allocations', None) or []
+        _local.allocations = None
+        if trace_memory:
+            _stop_tracing()
+
+    profile.create_stats()
+    return result, profile.stats, allocations
+
+
+def _start_tracing():
+    global _trace_users, _trace_started
+
+    with _trace_lock:
+        if _trace_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _trace_started = True
+        _trace_users += 1
+
+
+def _stop_tracing():
+    global _trace_users, _trace_started
+
+    # Stop tracing with the last traced call, unless tracemalloc was started by someone else
+    with _trace_lock:
+        _trace_users -= 1
+        if _trace_users == 0 and _trace_started:
+            tracemalloc.stop()
+            _trace_started = False
+
+
+_SNAPSHOT_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),
+                     tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                     tracemalloc.Filter(False, '<unknown>'))
+
+
+@contextlib.contextmanager
+def trace_stage(stage):
+
+    """
+    Context manager measuring the memory allocated by a stage of a traced call.
+
+    Records the peak traced memory of the stage and the source lines whose allocations are still held at
+    its end. Only takes snapshots inside profiled_call(trace_memory=True), anywhere else it costs one
+    attribute lookup. Snapshots cover the whole process, so with a thread pool the allocations of concurrent
+    requests are counted too.
+    """
+
+    allocations = getattr(_local, 'allocations', None)
+    if allocations is None:
+        yield
+        return
+
+    before = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        yield
+    finally:
+        # Peak memory above the start of the stage, including the buffers already freed at its end
+        peak = tracemalloc.get_traced_memory()[1] - start
+        after = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        lines = [(str(diff.traceback[0]), diff.size_diff, diff.count_diff)
+                 for diff in after.compare_to(before, 'lineno')[:TRACE_TOP_LINES] if diff.size_diff]
+        allocations.append((stage, peak, lines))
+
+
+class ProfilingMiddleware:
+
+    """
+    ASGI middleware marking the sampled requests of the configured routes.
+
+    Requests to routes without sampling pass through with one dictionary lookup.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        profile = _routes.get(scope['path']) if scope['type'] == 'http' and _routes else None
+        if profile is None or not profile.sample():
+            await self.app(scope, receive, send)
+            return
+
+        token = _current.set(profile)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
+            profile.finish(time.perf_counter() - started)
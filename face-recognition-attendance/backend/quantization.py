@@ -0,0 +1,173 @@
+import numpy as np
+
+
+# Precisions of the scanned copy of the embeddings, 'float32' scans the embeddings themselves
+PRECISIONS = ('float32', 'float16', 'int8')
+
+# Rows converted to float32 at a time during a scan, bounds the temporary buffer to 2 MB
+SCAN_BLOCK_ROWS = 4096
+
+# Headroom added on both sides of the fitted range of every int8 dimension, as a fraction of the range,
+# so the faces registered later rarely fall outside it and force a refit
+INT8_RANGE_MARGIN = 0.1
+
+
+class QuantizedMatrix:
+
+    """
+    Reduced-precision copy of an embedding matrix, scanned to select the candidates of an exact rerank.
+
+    With 'float16' every value is stored in half precision (2 bytes). With 'int8' every dimension has its own
+    scale: a value is offset[d] + scale[d] * code, with codes in [-127, 127] spanning the range of the
+    dimension over the fitted embeddings plus INT8_RANGE_MARGIN (1 byte, a quarter of float32).
+
+    The scan converts SCAN_BLOCK_ROWS rows at a time to float32 for the matrix product, so the codes are
+    the only full-size array read per query. The distances it returns are those to the decoded rows. `error`
+    is the largest distance between a row and its decoded row, so by the triangle inequality the distance
+    to the real row is within `error` of the scanned one: the caller rescores the rows within 2 * error of
+    the closest one on the float32 embeddings, and the nearest row is always among them.
+
+    Use QuantizedMatrix.fit() to build one and update() on registrations.
+    """
+
+    def __init__(self, precision, codes, sq_norms, offset=None, scale=None, error=0.0):
+        self.precision = precision
+        self.codes = codes
+        self.sq_norms = sq_norms
+        self.offset = offset
+        self.scale = scale
+        self.error = error
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.sq_norms.nbytes
+
+    @classmethod
+    def fit(cls, matrix, precision):
+
+        """
+        Function to quantize a float32 (N, D) matrix, fitting the int8 scales on its rows.
+
+        Parameters:
+        matrix (numpy.ndarray): The float32 embeddings.
+        precision (str): 'float16' or 'int8'.
+
+        Returns:
+        QuantizedMatrix: The quantized copy of matrix.
+        """
+
+        if precision not in ('float16', 'int8'):
+            raise ValueError("precision must be 'float16' or 'int8', got {!r}".format(precision))
+
+        offset = scale = None
+        if precision == 'int8':
+            low = matrix.min(axis=0) if len(matrix) else np.zeros(matrix.shape[1], dtype=np.float32)
+            high = matrix.max(axis=0) if len(matrix) else np.zeros(matrix.shape[1], dtype=np.float32)
+            # The floor keeps a usable scale on a registry of one user or a constant dimension
+            margin = np.maximum((high - low) * INT8_RANGE_MARGIN, 1e-2)
+            offset = ((low + high) / 2).astype(np.float32)
+            scale = ((high - low + 2 * margin) / 254).astype(np.float32)
+
+        quantized = cls(precision, None, None, offset, scale)
+        quantized.codes = quantized._encode(matrix)
+        quantized.sq_norms, quantized.error = quantized._decoded_stats(matrix, quantized.codes)
+        return quantized
+
+    def _encode(self, matrix):
+        if self.precision == 'float16':
+            return matrix.astype(np.float16)
+        return np.clip(np.rint((matrix - self.offset) / self.scale), -127, 127).astype(np.int8)
+
+    def _decode(self, codes):
+        if self.precision == 'float16':
+            return codes.astype(np.float32)
+        return self.offset + self.scale * codes.astype(np.float32)
+
+    def _decoded_stats(self, matrix, codes):
+        # Squared norm of every decoded row and the largest distance between a row and its decoded row
+        sq_norms = np.empty(len(codes), dtype=np.float32)
+        error = 0.0
+        for start in range(0, len(codes), SCAN_BLOCK_ROWS):
+            block = self._decode(codes[start:start + SCAN_BLOCK_ROWS])
+            sq_norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+            residuals = block - matrix[start:start + len(block)]
+            error = max(error, float(np.sqrt(np.einsum('ij,ij->i', residuals, residuals).max())))
+        return sq_norms, error
+
+    def covers(self, embeddings):
+
+        """
+        Return True if every value of embeddings is within the int8 range (always True for float16).
+        """
+
+        if self.precision == 'float16':
+            return True
+        codes = (embeddings - self.offset) / self.scale
+        return bool(np.all(np.abs(codes) <= 127.5))
+
+    def update(self, matrix, rows):
+
+        """
+        Function to quantize the rows of a matrix that changed since this copy was made.
+
+        Parameters:
+        matrix (numpy.ndarray): The float32 embeddings after the change, rows may have been appended.
+        rows (list): The rows of matrix that were replaced or appended.
+
+        Returns:
+        QuantizedMatrix: A new copy, refitted on the whole matrix when a changed row is out of the int8 range.
+        """
+
+        rows = np.asarray(rows, dtype=np.intp)
+        if not self.covers(matrix[rows]):
+            return QuantizedMatrix.fit(matrix, self.precision)
+
+        codes = np.empty((len(matrix), matrix.shape[1]), dtype=self.codes.dtype)
+        codes[:len(self.codes)] = self.codes
+        sq_norms = np.empty(len(matrix), dtype=np.float32)
+        sq_norms[:len(self.sq_norms)] = self.sq_norms
+
+        codes[rows] = self._encode(matrix[rows])
+        sq_norms[rows], error = self._decoded_stats(matrix[rows], codes[rows])
+        # The error of a replaced row may stay counted, the bound is only less tight
+        return QuantizedMatrix(self.precision, codes, sq_norms, self.offset, self.scale, max(self.error, error))
+
+    def sq_distances(self, queries):
+
+        """
+        Function to compute the squared distances between float32 queries and every decoded row.
+
+        Parameters:
+        queries (numpy.ndarray): float32 matrix of shape (Q, D).
+
+        Returns:
+        numpy.ndarray: float32 matrix of shape (Q, N), one row of distances per query.
+        """
+
+        # q.(offset + scale * code) = q.offset + (q * scale).code, so the codes are multiplied as they are
+        if self.precision == 'int8':
+            weights = queries * self.scale
+            shift = (queries @ self.offset)[:, None]
+        else:
+            weights = queries
+            shift = 0
+
+        dots = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        buffer = np.empty((min(SCAN_BLOCK_ROWS, len(self.codes)), queries.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.codes), SCAN_BLOCK_ROWS):
+            block = self.codes[start:start + SCAN_BLOCK_ROWS]
+            converted = buffer[:len(block)]
+            converted[...] = block
+            if len(queries) == 1:
+                np.matmul(converted, weights[0], out=dots[0, start:start + len(block)])
+            else:
+                dots[:, start:start + len(block)] = weights @ converted.T
+
+        dots += shift
+        dots *= -2
+        dots += self.sq_norms[None, :]
+        dots += np.einsum('ij,ij->i', queries, queries)[:, None]
+        return dots
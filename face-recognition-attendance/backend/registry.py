@@ -0,0 +1,122 @@
+import csv
+import os
+import threading
+
+
+# Columns of the user details CSV file, as written by register_new_user
+USER_FIELDS = ['Name', 'Email', 'Phone Number', 'Class', 'Division', 'Image Path', 'Embeddings Path']
+
+
+class UserRegistry:
+
+    """
+    Cached, indexed view of the user details CSV file.
+
+    The file is parsed once into a dictionary keyed by email, with secondary indexes by class and by
+    division. Every access compares the file's modification time and size with the parsed version and
+    parses it again only when they changed, so new registrations and external edits are picked up
+    without re-reading the file on every lookup.
+
+    Parameters:
+    csv_path (str): Path of the user details CSV file.
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self._signature = None
+        self._state = ({}, {}, {})
+        self._lock = threading.Lock()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _refresh(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return
+
+        with self._lock:
+            if signature == self._signature:
+                return
+
+            users, by_class, by_division = {}, {}, {}
+            if signature is not None:
+                with open(self.csv_path, newline='') as csvfile:
+                    for row in csv.reader(csvfile):
+                        # Skip the header row and malformed lines
+                        if len(row) != len(USER_FIELDS) or row == USER_FIELDS:
+                            continue
+
+                        name, email, phone, class_, division, _, _ = row
+                        users[email] = {"name": name, "email": email, "phone": phone,
+                                        "class": class_, "division": division}
+
+                # Built after parsing so a user registered twice is only indexed once
+                for email, user in users.items():
+                    by_class.setdefault(user["class"], []).append(email)
+                    by_division.setdefault(user["division"], []).append(email)
+
+            # Swapped as one tuple so concurrent readers never mix two versions of the file
+            self._state = (users, by_class, by_division)
+            self._signature = signature
+
+    def __contains__(self, email):
+        self._refresh()
+        return email in self._state[0]
+
+    def __len__(self):
+        self._refresh()
+        return len(self._state[0])
+
+    def get(self, email):
+
+        """
+        Return the details of one user, or None if the email is not registered.
+        """
+
+        self._refresh()
+        return self._state[0].get(email)
+
+    def users(self):
+
+        """
+        Return the details of every registered user, in registration order.
+        """
+
+        self._refresh()
+        return list(self._state[0].values())
+
+    def query(self, class_=None, division=None, page=1, page_size=50):
+
+        """
+        Return one page of the users, optionally filtered by class and division.
+
+        Parameters:
+        class_ (str): Only return users of this class.
+        division (str): Only return users of this division.
+        page (int): 1-based page number.
+        page_size (int): Number of users per page.
+
+        Returns:
+        tuple: The total number of matching users and the list of users of the requested page.
+        """
+
+        self._refresh()
+        users, by_class, by_division = self._state
+
+        if class_ is not None and division is not None:
+            in_division = set(by_division.get(division, []))
+            emails = [email for email in by_class.get(class_, []) if email in in_division]
+        elif class_ is not None:
+            emails = by_class.get(class_, [])
+        elif division is not None:
+            emails = by_division.get(division, [])
+        else:
+            emails = list(users)
+
+        start = (page - 1) * page_size
+        return len(emails), [users[email] for email in emails[start:start + page_size]]
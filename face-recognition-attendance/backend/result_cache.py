@@ -0,0 +1,206 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cv2
+import numpy as np
+
+
+def dhash(image, hash_size=16):
+
+    """
+    Function to compute the difference hash (dHash) of an image.
+
+    The image is converted to grayscale and shrunk to (hash_size + 1) x hash_size pixels, and every bit
+    tells whether a pixel is brighter than its right neighbour. Re-encoded or slightly noisy copies of the
+    same frame give the same hash or one a few bits away, while a different scene or a moved face does not.
+
+    Parameters:
+    image (numpy.ndarray): The decoded BGR image.
+    hash_size (int): Side of the hash grid, the hash has hash_size * hash_size bits.
+
+    Returns:
+    int: The bits of the hash.
+    """
+
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class ResultCache:
+
+    """
+    Size-bounded LRU cache with a time to live, for the results of repeated frames.
+
+    Keys are perceptual hashes. A lookup first tries the exact hash, then the closest cached hash within
+    max_distance bits, so camera noise between two shots of the same scene still hits. An optional context
+    (the scope of a search) is part of the key: the same frame looked up in another context is a miss and
+    is stored next to the entry of the first one.
+
+    The near-duplicate search does not scan the cache: the hash_bits bits of every key are split into
+    max_distance + 1 bands, and two hashes at most max_distance bits apart share at least one whole band,
+    so only the keys filed under one of the query's bands are compared.
+
+    Entries are stored with the generation of the enrolled embeddings they were computed with
+    (EmbeddingMatcher.generation), so any enrollment change makes every older entry a miss, dropped when a
+    lookup meets it. Expired entries are dropped in the order they were stored, from the front of a queue,
+    so a lookup only touches the entries that expired since the last one. Hits, misses, evictions and
+    expirations are counted for tuning the size and the TTL.
+
+    Parameters:
+    max_size (int): Maximum number of entries, 0 disables the cache.
+    ttl_s (float): Seconds an entry stays valid.
+    max_distance (int): Largest Hamming distance between two hashes of the same frame, 0 for exact keys.
+    hash_bits (int): Number of bits of the keys (256 for dhash() with its default hash_size).
+    """
+
+    def __init__(self, max_size=1024, ttl_s=10.0, max_distance=0, hash_bits=256):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._expiry = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        # (shift, mask) of every band, max_distance + 1 bands covering the hash_bits bits
+        n_bands = max_distance + 1 if max_distance > 0 else 0
+        bounds = [hash_bits * i // n_bands for i in range(n_bands + 1)] if n_bands else []
+        self._bands = [(low, (1 << (high - low)) - 1) for low, high in zip(bounds, bounds[1:])]
+        self._buckets = [{} for _ in self._bands]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, generation, context=None):
+
+        """
+        Return the value cached for key in context, or None if it is missing, expired or from another generation.
+        """
+
+        found = self.lookup(key, generation, context)
+        return None if found is None else found[0]
+
+    def lookup(self, key, generation, context=None):
+
+        """
+        Return the entry cached for key in context with how close and how recent it is.
+
+        Returns:
+        tuple: The value, the Hamming distance between key and the cached key (0 for the same hash) and the
+               seconds since the value was stored, or None if there is no valid entry.
+        """
+
+        if self.max_size <= 0:
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+
+            key = (context, key)
+            found, distance = key, 0
+            if not self._valid(key, generation) and self._bands:
+                # Closest near-duplicate frame of the same context among the keys sharing a band with this one
+                candidates = set()
+                for (shift, mask), buckets in zip(self._bands, self._buckets):
+                    candidates.update(buckets.get((context, key[1] >> shift & mask), ()))
+                found, distance = min(((other, hamming_distance(key[1], other[1])) for other in candidates
+                                       if self._valid(other, generation)),
+                                      default=(None, None), key=lambda item: item[1])
+                if found is not None and distance > self.max_distance:
+                    found = None
+
+            if found is None or not self._valid(found, generation):
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(found)
+            self.hits += 1
+            stored, value = self._entries[found][1:]
+            return value, distance, now - stored
+
+    def _valid(self, key, generation):
+        # Whether key has an entry of this generation, the entry of an older one is dropped on the way
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] != generation:
+            self._remove(key)
+            self.expirations += 1
+            return False
+        return entry is not None
+
+    def _expire(self, now):
+        # The queue is in storage order, so the expired entries are at its front. An entry stored again
+        # since has a later time than its queue item and stays.
+        while self._expiry and self._expiry[0][0] + self.ttl_s <= now:
+            stored, key = self._expiry.popleft()
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == stored:
+                self._remove(key)
+                self.expirations += 1
+
+    def _remove(self, key):
+        del self._entries[key]
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            band = (key[0], key[1] >> shift & mask)
+            bucket = buckets[band]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[band]
+
+    def put(self, key, generation, value, context=None):
+
+        """
+        Store value for key in context, evicting the least recently used entries beyond max_size.
+        """
+
+        if self.max_size <= 0:
+            return
+
+        key = (context, key)
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._entries:
+                for (shift, mask), buckets in zip(self._bands, self._buckets):
+                    buckets.setdefault((context, key[1] >> shift & mask), set()).add(key)
+            self._entries[key] = (generation, now, value)
+            self._entries.move_to_end(key)
+            self._expiry.append((now, key))
+            if len(self._expiry) > 2 * self.max_size:
+                # Mostly items of entries evicted or stored again since, rebuilt from the live entries
+                self._expiry = deque(sorted((entry[1], key) for key, entry in self._entries.items()))
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            for buckets in self._buckets:
+                buckets.clear()
+
+    def stats(self):
+
+        """
+        Return the counters and the hit rate of the cache.
+        """
+
+        lookups = self.hits + self.misses
+        return {"size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_s": self.ttl_s,
+                "max_distance": self.max_distance,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
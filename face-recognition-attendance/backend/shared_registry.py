@@ -0,0 +1,347 @@
+import contextlib
+import fcntl
+import mmap
+import os
+import random
+import threading
+
+import numpy as np
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM
+
+
+# Segment file layout: a header page of uint64 fields, then the (capacity, 128) float32 embedding matrix,
+# the float32 squared norm of every row and one fixed-size slot per row for the email
+MAGIC = int.from_bytes(b'EMBSEG01', 'little')
+HEADER_BYTES = 4096
+EMAIL_BYTES = 256
+INITIAL_CAPACITY = 1024
+
+# Header fields
+_MAGIC, _EPOCH, _GENERATION, _COUNT, _CAPACITY, _RETIRED, _REPLACED = range(7)
+
+# Values written over the row of a replaced embedding, the row is never the closest to any face again
+TOMBSTONE_VALUE = 1e3
+TOMBSTONE_NORM = 1e12
+
+
+def _layout(capacity):
+    # Byte offsets of the matrix, the norms and the emails, and the file size, for a capacity in rows
+    matrix_offset = HEADER_BYTES
+    norms_offset = matrix_offset + capacity * EMBEDDING_DIM * 4
+    emails_offset = norms_offset + capacity * 4
+    return matrix_offset, norms_offset, emails_offset, emails_offset + capacity * EMAIL_BYTES
+
+
+def encode_emails(emails):
+
+    """
+    Function to convert emails to the fixed-size slots of the segment.
+    """
+
+    encoded = [email.encode('utf-8') for email in emails]
+    for email, raw in zip(emails, encoded):
+        if len(raw) > EMAIL_BYTES:
+            raise ValueError("email {!r} is longer than {} bytes".format(email, EMAIL_BYTES))
+    return np.array(encoded, dtype='S{}'.format(EMAIL_BYTES)).reshape(-1)
+
+
+def write_segment(path, epoch, generation, capacity, emails, matrix, norms, replaced=0):
+
+    """
+    Function to write a complete segment file next to path and move it in place atomically.
+
+    Processes that still map the previous file keep reading it until they see it retired.
+
+    Parameters:
+    emails (numpy.ndarray): The encoded email slots of the rows (see encode_emails).
+    matrix (numpy.ndarray): The (count, 128) float32 embedding rows.
+    norms (numpy.ndarray): The float32 squared norm of every row.
+    replaced (int): Number of rows overwritten by a later row of the same user.
+    """
+
+    matrix_offset, norms_offset, emails_offset, size = _layout(capacity)
+
+    header = np.zeros(HEADER_BYTES // 8, dtype=np.uint64)
+    header[[_MAGIC, _EPOCH, _GENERATION, _COUNT, _CAPACITY, _REPLACED]] = [MAGIC, epoch, generation, len(matrix),
+                                                                          capacity, replaced]
+
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.truncate(size)
+        f.write(header.tobytes())
+        f.seek(matrix_offset)
+        f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+        f.seek(norms_offset)
+        f.write(np.ascontiguousarray(norms, dtype=np.float32).tobytes())
+        f.seek(emails_offset)
+        f.write(emails.tobytes())
+    os.replace(temporary, path)
+
+
+class SegmentMapping:
+
+    """
+    Read/write numpy views over one mapped segment file.
+
+    The views share the pages of every other process mapping the same file, nothing is copied.
+    """
+
+    def __init__(self, path):
+        with open(path, 'r+b') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0)
+
+        self.header = np.frombuffer(self.mmap, dtype=np.uint64, count=HEADER_BYTES // 8)
+        if int(self.header[_MAGIC]) != MAGIC:
+            raise ValueError("{} is not an embedding segment".format(path))
+
+        capacity = int(self.header[_CAPACITY])
+        matrix_offset, norms_offset, emails_offset, _ = _layout(capacity)
+        self.matrix = np.frombuffer(self.mmap, dtype=np.float32, count=capacity * EMBEDDING_DIM,
+                                    offset=matrix_offset).reshape(capacity, EMBEDDING_DIM)
+        self.norms = np.frombuffer(self.mmap, dtype=np.float32, count=capacity, offset=norms_offset)
+        self.emails = np.frombuffer(self.mmap, dtype='S{}'.format(EMAIL_BYTES), count=capacity, offset=emails_offset)
+
+    def field(self, name):
+        return int(self.header[name])
+
+
+class SharedEmbeddingMatcher(EmbeddingMatcher):
+
+    """
+    Embedding matcher whose matrix lives in a memory-mapped segment file shared by every process.
+
+    With uvicorn --workers N each worker would otherwise load its own copy of every embedding and only see
+    the registrations it handled itself. Here the embeddings, their squared norms and the emails are kept
+    in one segment file that every worker maps, so the matrix is in memory once whatever the number of
+    workers, and the matching reads it in place.
+
+    Writes (registrations and the initial load) are serialized across processes by an exclusive lock on
+    `<path>.lock`, so there is a single writer at a time. A write appends rows, then bumps the count and the
+    generation counter in the header; every worker compares the generation with its own on refresh() (one
+    integer read) and picks up the new rows. A replaced embedding is appended as a new row and its old row is
+    overwritten with far away values. When the segment is full the writer copies it to a larger file, moves
+    it in place and marks the old one retired, and the readers map the new file on their next refresh().
+
+    The segment is a cache of the storage: the first process to attach (no other process holds
+    `<path>.users`) rebuilds it from the storage, the others map it as it is.
+
+    The emails are read from the segment too (decoded only for the returned match), so a process only keeps
+    its own IVF lists with index='ivf'.
+
+    Parameters:
+    path (str): Path of the segment file, e.g. in DB_PATH or in /dev/shm.
+    **options: Keyword arguments of EmbeddingMatcher (tolerance, index, nprobe, ...).
+    """
+
+    def __init__(self, path, **options):
+        super().__init__(**options)
+        if self.precision != 'float32':
+            # A private quantized copy per process would undo the sharing of the segment
+            raise ValueError("a shared registry is scanned in float32, got precision {!r}".format(self.precision))
+        self.path = path
+        self._mapping = None
+        self._epoch = None
+        # Replaced rows already removed from the IVF lists
+        self._replaced = 0
+        self._write_thread_lock = threading.Lock()
+        self._lock_file = open(path + '.lock', 'a+b')
+        self._users_file = None
+
+    def __len__(self):
+        # Replaced rows stay in the segment until it is rebuilt, count the users
+        self.refresh()
+        return self._mapping.field(_COUNT) - self._mapping.field(_REPLACED)
+
+    def attach(self, load):
+
+        """
+        Map the segment, after building it with load() if this is the first process to use it.
+
+        Parameters:
+        load (callable): Returns the emails and the (N, 128) embeddings of the storage, e.g.
+                         storage.load_embeddings. Only called by the first process.
+        """
+
+        # Held shared by every attached process until it exits, so a process getting it exclusively knows
+        # it is alone and the segment may be stale
+        self._users_file = open(self.path + '.users', 'a+b')
+        try:
+            fcntl.flock(self._users_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            first = True
+        except BlockingIOError:
+            first = False
+            # Waits for the first process to finish building the segment
+            fcntl.flock(self._users_file, fcntl.LOCK_SH)
+
+        try:
+            if first or not os.path.exists(self.path):
+                self.load_arrays(*load())
+        finally:
+            if first:
+                fcntl.flock(self._users_file, fcntl.LOCK_SH)
+
+        return self.refresh()
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        # flock only excludes other processes, the thread lock the other threads of this one
+        with self._write_thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _current_mapping(self):
+        if self._mapping is None or self._mapping.field(_RETIRED):
+            return SegmentMapping(self.path)
+        return self._mapping
+
+    def load_arrays(self, emails, embeddings):
+
+        """
+        Replace the whole segment with an email list and the matching (N, 128) embedding matrix.
+        """
+
+        matrix = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        slots = encode_emails(emails)
+
+        with self._write_lock():
+            previous = SegmentMapping(self.path) if os.path.exists(self.path) else None
+            # Generations keep growing across rebuilds so results cached for the old segment never match
+            generation = previous.field(_GENERATION) + 1 if previous is not None else 1
+
+            write_segment(self.path, random.getrandbits(63), generation, max(INITIAL_CAPACITY, 2 * len(matrix)),
+                          slots, matrix, np.einsum('ij,ij->i', matrix, matrix))
+            if previous is not None:
+                self._retire(previous)
+
+        return self.refresh()
+
+    @staticmethod
+    def _retire(mapping):
+        mapping.header[_RETIRED] = 1
+        mapping.header[_GENERATION] += 1
+
+    def _grow(self, mapping, needed):
+        # Copy the segment to a file with room for `needed` rows, same epoch so readers keep their state
+        count, capacity = mapping.field(_COUNT), mapping.field(_CAPACITY)
+        write_segment(self.path, mapping.field(_EPOCH), mapping.field(_GENERATION) + 1, max(needed, 2 * capacity),
+                      mapping.emails[:count], mapping.matrix[:count], mapping.norms[:count], mapping.field(_REPLACED))
+        self._retire(mapping)
+        return SegmentMapping(self.path)
+
+    def add_many(self, emails, embeddings):
+
+        """
+        Append the embeddings of several users to the segment, replacing the rows of users already enrolled.
+        """
+
+        new_embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        slots = encode_emails(emails)
+
+        with self._write_lock():
+            mapping = self._current_mapping()
+            count = mapping.field(_COUNT)
+            if count + len(new_embeddings) > mapping.field(_CAPACITY):
+                mapping = self._grow(mapping, count + len(new_embeddings))
+
+            # Live rows of the users enrolled again, whichever process wrote them
+            live = mapping.norms[:count] != TOMBSTONE_NORM
+            old_rows = {}
+            for row in np.flatnonzero(np.isin(mapping.emails[:count], slots) & live):
+                old_rows[bytes(mapping.emails[row])] = row
+
+            replaced = 0
+            for offset, (slot, embedding) in enumerate(zip(slots, new_embeddings)):
+                old = old_rows.get(bytes(slot))
+                if old is not None:
+                    # Norm first, so a reader never pairs the old norm with a half-written row
+                    mapping.norms[old] = TOMBSTONE_NORM
+                    mapping.matrix[old] = TOMBSTONE_VALUE
+                    replaced += 1
+
+                row = count + offset
+                mapping.matrix[row] = embedding
+                mapping.norms[row] = embedding @ embedding
+                mapping.emails[row] = slot
+                old_rows[bytes(slot)] = row
+
+            # Rows first, then the count, then the generation the readers poll
+            mapping.header[_REPLACED] += replaced
+            mapping.header[_COUNT] = count + len(new_embeddings)
+            mapping.header[_GENERATION] += 1
+
+        self.refresh()
+
+    def refresh(self):
+
+        """
+        Pick up the rows written by any process since the last call, one integer read when nothing changed.
+        """
+
+        mapping = self._mapping
+        if mapping is not None and mapping.field(_GENERATION) == self.generation:
+            return self
+
+        with self._lock:
+            mapping = self._current_mapping()
+
+            # Generation before count: rows counted here may be newer than the generation, never older
+            generation = mapping.field(_GENERATION)
+            count = mapping.field(_COUNT)
+            epoch = mapping.field(_EPOCH)
+
+            replaced = mapping.field(_REPLACED)
+
+            emails, _, _, index, _, sections = self._state
+            start = len(emails)
+            if epoch != self._epoch:
+                # A rebuilt segment, nothing known about it yet
+                start, index, sections = 0, None, None
+
+            matrix = mapping.matrix[:count]
+            removed = self._replaced
+            if index is None:
+                index = self._build_index(matrix)
+                removed = 0
+            else:
+                for row in range(start, count):
+                    index.add(row, matrix[row])
+
+            # The old rows of the users enrolled again since, by any process, leave their IVF lists
+            if index is not None and replaced != removed:
+                index.remove(np.flatnonzero(mapping.norms[:count] == TOMBSTONE_NORM))
+
+            # Sections of the rows written by any process, once a scoped search built them. A replaced row keeps
+            # its section but is never the closest again.
+            if sections is not None:
+                new_sections = self.sections(self._email_list(mapping.emails[start:count]))
+                sections = sections.updated(zip(range(start, count), new_sections))
+
+            self._state = (mapping.emails[:count], matrix, mapping.norms[:count], index, None, sections)
+            self._mapping, self._epoch, self.generation, self._replaced = mapping, epoch, generation, replaced
+
+        return self
+
+    def _email_list(self, emails):
+        return [_decode(email) for email in emails]
+
+    def _rows_of(self, state, email):
+        # Replaced rows keep their email, only the live one counts
+        emails, _, norms, _, _, _ = state
+        rows = np.flatnonzero(emails == encode_emails([email])[0])
+        return rows[norms[rows] != TOMBSTONE_NORM]
+
+    def match(self, embedding, scope=None, fallback=False):
+        email, distance = super().match(embedding, scope, fallback)
+        return _decode(email), distance
+
+    def match_many(self, embeddings, scope=None, fallback=False):
+        return [(_decode(email), distance) for email, distance in super().match_many(embeddings, scope, fallback)]
+
+
+def _decode(email):
+    # Email slots are bytes, None when the registry is empty
+    return email.decode('utf-8') if isinstance(email, bytes) else email
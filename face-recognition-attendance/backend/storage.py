@@ -0,0 +1,395 @@
+import argparse
+import contextlib
+import csv
+import os
+import pickle
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process lock on Windows, the threads of one process are still serialized by AttendanceState
+    fcntl = None
+
+import numpy as np
+
+from embedding_store import EmbeddingStore, read_pickles
+from matcher import EMBEDDING_DIM
+from registry import UserRegistry, USER_FIELDS
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    # Exclusive lock between the processes sharing a storage, released when the file is closed
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class FileStorage:
+
+    """
+    Storage backend over the original file layout.
+
+    Users are rows of '<DB_PATH>/user_details.csv' (read through the cached UserRegistry), embeddings are
+    rows of the memory-mapped EmbeddingStore of DB_PATH and attendance is one '<ATTENDANCE_LOG_DIR>/<date>.csv'
+    per day. A DB_PATH written before the store existed keeps its one '<DB_PATH>/<email>.pickle' per user
+    until embedding_store.convert_pickles is run on it.
+
+    Parameters:
+    DB_PATH (str): The directory of the user details and embeddings.
+    ATTENDANCE_LOG_DIR (str): The directory of the daily attendance CSV files.
+    """
+
+    def __init__(self, DB_PATH, ATTENDANCE_LOG_DIR):
+        self.db_path = DB_PATH
+        self.log_dir = ATTENDANCE_LOG_DIR
+        self.registry = UserRegistry(os.path.join(DB_PATH, 'user_details.csv'))
+        self.embedding_store = EmbeddingStore(DB_PATH)
+        self._write_lock = threading.Lock()
+        self._has_pickles = None
+
+    def _uses_store(self):
+        # New and converted directories use the store, the ones with pickles only go on with their pickles
+        if self.embedding_store.exists():
+            return True
+        if self._has_pickles is None:
+            self._has_pickles = any(name.endswith('.pickle') for name in os.listdir(self.db_path))
+        return not self._has_pickles
+
+    def user_exists(self, email):
+        return email in self.registry
+
+    def get_user(self, email):
+        return self.registry.get(email)
+
+    def users(self):
+        return self.registry.users()
+
+    def query_users(self, class_=None, division=None, page=1, page_size=50):
+        return self.registry.query(class_=class_, division=division, page=page, page_size=page_size)
+
+    def add_user(self, name, email, phone_number, class_, division, image_path, embeddings):
+
+        """
+        Save the embeddings of a new user and append the user details to the CSV file.
+        """
+
+        self.add_users([(name, email, phone_number, class_, division, image_path, embeddings)])
+
+    def add_users(self, users):
+
+        """
+        Save the embeddings of new users and append all their details to the CSV file in one write.
+
+        Parameters:
+        users (list): (name, email, phone_number, class_, division, image_path, embeddings) tuples.
+        """
+
+        uses_store = self._uses_store()
+        stored_emails = []
+        stored_embeddings = []
+
+        rows = []
+        for name, email, phone_number, class_, division, image_path, embeddings in users:
+            if uses_store:
+                # Only the first embedding is ever matched, as in the SQLite backend
+                embeddings_path = self.embedding_store.matrix_path
+                if len(embeddings) > 0:
+                    stored_emails.append(email)
+                    stored_embeddings.append(embeddings[0])
+            else:
+                # Save the embeddings as a pickle file
+                embeddings_path = os.path.join(self.db_path, '{}.pickle'.format(email))
+                with open(embeddings_path, 'wb') as file_:
+                    pickle.dump(embeddings, file_)
+
+            rows.append({
+                'Name': name,
+                'Email': email,
+                'Phone Number': phone_number,
+                'Class': class_,
+                'Division': division,
+                'Image Path': image_path,
+                'Embeddings Path': embeddings_path
+            })
+
+        # Append all the embeddings to the store in one write
+        if stored_emails:
+            self.embedding_store.append(stored_emails, stored_embeddings)
+
+        # Append user details to the CSV file
+        csv_file_path = self.registry.csv_path
+        with self._write_lock:
+            is_new_file = not os.path.exists(csv_file_path)
+
+            with open(csv_file_path, 'a', newline='') as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=USER_FIELDS)
+
+                if is_new_file:
+                    writer.writeheader()
+
+                writer.writerows(rows)
+
+    def load_embeddings(self):
+
+        """
+        Map the embedding store, or read the first embedding of every pickle of a directory not converted yet.
+
+        Returns:
+        tuple: The list of emails and the (N, 128) embedding matrix, float32 memory-mapped from the store or
+               float64 read from the pickles.
+        """
+
+        if self._uses_store():
+            return self.embedding_store.load()
+        return read_pickles(self.db_path)
+
+    def record_attendance(self, entries):
+
+        """
+        Append attendance entries, a list of (email, date, time, direction) tuples.
+        """
+
+        by_date = {}
+        for email, date, time_, direction in entries:
+            by_date.setdefault(date, []).append('{},{},{}\n'.format(email, time_, direction))
+
+        with self._write_lock:
+            for date, lines in by_date.items():
+                with open(os.path.join(self.log_dir, '{}.csv'.format(date)), 'a') as f:
+                    f.write(''.join(lines))
+
+    def attendance_dates(self):
+
+        """
+        Return the sorted "YYYY-MM-DD" dates that have attendance entries.
+        """
+
+        return sorted(name[:-4] for name in os.listdir(self.log_dir) if name.endswith('.csv'))
+
+    def attendance_rows(self, date):
+
+        """
+        Return the (email, time, direction) entries of one day, in the order they were written.
+        """
+
+        path = os.path.join(self.log_dir, '{}.csv'.format(date))
+        if not os.path.exists(path):
+            return []
+
+        with open(path, newline='') as csvfile:
+            return [tuple(row) for row in csv.reader(csvfile) if len(row) == 3]
+
+    def attendance_status(self, date):
+
+        """
+        Return the IN (True) / OUT (False) status of every user with an entry on that day.
+        """
+
+        return {email: direction == "IN" for email, _, direction in self.attendance_rows(date)}
+
+    def attendance_signature(self, date):
+
+        """
+        Return the modification time and size of the day's log, None before its first entry. It changes with
+        every entry written, by any process.
+        """
+
+        try:
+            stat = os.stat(os.path.join(self.log_dir, '{}.csv'.format(date)))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def attendance_lock(self):
+
+        """
+        Return a context manager holding the attendance write lock of every process using the log directory.
+        """
+
+        return _file_lock(os.path.join(self.log_dir, '.attendance.lock'))
+
+
+class SQLiteStorage:
+
+    """
+    Storage backend in a single SQLite database in WAL mode.
+
+    Users, embeddings (float64 BLOBs) and attendance events live in three tables, indexed on email and on
+    date, so every lookup or write from a handler is one indexed query. WAL lets readers run while a writer
+    commits, and every thread uses its own connection.
+
+    Parameters:
+    path (str): Path of the SQLite database file, created if missing.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            phone TEXT,
+            class TEXT,
+            division TEXT,
+            image_path TEXT
+        );
+        CREATE INDEX IF NOT EXISTS users_class_division ON users (class, division);
+        CREATE INDEX IF NOT EXISTS users_division ON users (division);
+
+        CREATE TABLE IF NOT EXISTS embeddings (
+            email TEXT PRIMARY KEY REFERENCES users (email),
+            vector BLOB NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS attendance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            direction TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS attendance_date_email ON attendance (date, email);
+        CREATE INDEX IF NOT EXISTS attendance_email ON attendance (email);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _user(row):
+        return {"name": row["name"], "email": row["email"], "phone": row["phone"],
+                "class": row["class"], "division": row["division"]}
+
+    def user_exists(self, email):
+        return self._connection().execute('SELECT 1 FROM users WHERE email = ?', (email,)).fetchone() is not None
+
+    def get_user(self, email):
+        row = self._connection().execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
+        return None if row is None else self._user(row)
+
+    def users(self):
+        return [self._user(row) for row in self._connection().execute('SELECT * FROM users ORDER BY rowid')]
+
+    def query_users(self, class_=None, division=None, page=1, page_size=50):
+        conditions, params = [], []
+        if class_ is not None:
+            conditions.append('class = ?')
+            params.append(class_)
+        if division is not None:
+            conditions.append('division = ?')
+            params.append(division)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        conn = self._connection()
+        total = conn.execute('SELECT COUNT(*) FROM users' + where, params).fetchone()[0]
+        rows = conn.execute('SELECT * FROM users' + where + ' ORDER BY rowid LIMIT ? OFFSET ?',
+                            params + [page_size, (page - 1) * page_size])
+        return total, [self._user(row) for row in rows]
+
+    def add_users(self, users):
+
+        """
+        Insert users and their first embedding in one transaction.
+
+        Parameters:
+        users (list): (name, email, phone_number, class_, division, image_path, embeddings) tuples.
+        """
+
+        with self._connection() as conn:
+            for name, email, phone_number, class_, division, image_path, embeddings in users:
+                conn.execute('INSERT OR REPLACE INTO users (email, name, phone, class, division, image_path) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (email, name, phone_number, class_, division, image_path))
+                if len(embeddings) > 0:
+                    conn.execute('INSERT OR REPLACE INTO embeddings (email, vector) VALUES (?, ?)',
+                                 (email, np.asarray(embeddings[0], dtype=np.float64).tobytes()))
+
+    def add_user(self, name, email, phone_number, class_, division, image_path, embeddings):
+        self.add_users([(name, email, phone_number, class_, division, image_path, embeddings)])
+
+    def load_embeddings(self):
+        rows = self._connection().execute('SELECT email, vector FROM embeddings ORDER BY email').fetchall()
+        matrix = np.frombuffer(b''.join(row['vector'] for row in rows), dtype=np.float64)
+        return [row['email'] for row in rows], matrix.reshape(-1, EMBEDDING_DIM)
+
+    def record_attendance(self, entries):
+        with self._connection() as conn:
+            conn.executemany('INSERT INTO attendance (email, date, time, direction) VALUES (?, ?, ?, ?)', entries)
+
+    def attendance_dates(self):
+        return [row[0] for row in self._connection().execute('SELECT DISTINCT date FROM attendance ORDER BY date')]
+
+    def attendance_rows(self, date):
+        rows = self._connection().execute('SELECT email, time, direction FROM attendance WHERE date = ? ORDER BY id',
+                                          (date,))
+        return [tuple(row) for row in rows]
+
+    def attendance_status(self, date):
+        return {email: direction == "IN" for email, _, direction in self.attendance_rows(date)}
+
+    def attendance_signature(self, date):
+        # Entries are only ever inserted, the last id changes with every entry written by any process
+        return self._connection().execute('SELECT MAX(id) FROM attendance').fetchone()[0]
+
+    def attendance_lock(self):
+        return _file_lock(self.path + '.attendance.lock')
+
+
+def migrate_files_to_sqlite(DB_PATH, ATTENDANCE_LOG_DIR, sqlite_path):
+
+    """
+    Function to copy the file layout (user CSV, embeddings, daily logs) into a SQLite database.
+
+    Users and embeddings are upserted. Attendance days that already have entries in the database are
+    skipped, so running the migration twice does not duplicate them.
+
+    Returns:
+    dict: The number of migrated users, embeddings and attendance entries.
+    """
+
+    source = FileStorage(DB_PATH, ATTENDANCE_LOG_DIR)
+    target = SQLiteStorage(sqlite_path)
+
+    emails, matrix = source.load_embeddings()
+    embeddings = dict(zip(emails, matrix))
+
+    users = []
+    for user in source.users():
+        email = user["email"]
+        users.append((user["name"], email, user["phone"], user["class"], user["division"],
+                      os.path.join(DB_PATH, '{}.png'.format(email)),
+                      [embeddings[email]] if email in embeddings else []))
+    target.add_users(users)
+
+    existing_dates = set(target.attendance_dates())
+    entries = []
+    for date in source.attendance_dates():
+        if date not in existing_dates:
+            entries += [(email, date, time_, direction) for email, time_, direction in source.attendance_rows(date)]
+    target.record_attendance(entries)
+
+    return {"users": len(users), "embeddings": sum(1 for user in users if user[-1]), "attendance": len(entries)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the file layout to a SQLite database")
+    parser.add_argument("--db_path", type=str, default="./db")
+    parser.add_argument("--log_dir", type=str, default="./logs")
+    parser.add_argument("--sqlite_path", type=str, default="./db/attendance.sqlite3")
+    args = parser.parse_args()
+
+    print(migrate_files_to_sqlite(args.db_path, args.log_dir, args.sqlite_path))
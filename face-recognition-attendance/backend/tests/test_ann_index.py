@@ -0,0 +1,77 @@
+import numpy as np
+
+import matcher as matcher_module
+from ann_index import IVFIndex
+from benchmarks.bench_ann import synthetic_encodings
+from matcher import EmbeddingMatcher, EMBEDDING_DIM
+
+
+def noisy(embeddings, rows, seed=1):
+    rng = np.random.default_rng(seed)
+    return embeddings[rows] + rng.normal(0, 0.02, size=(len(rows), EMBEDDING_DIM)).astype(np.float32)
+
+
+def test_lists_hold_every_row_once():
+    embeddings = synthetic_encodings(2000, n_clusters=50)
+    index = IVFIndex(n_lists=20).build(embeddings)
+
+    assert len(index.lists) == 20
+    rows = np.concatenate(index.lists)
+    assert np.array_equal(np.sort(rows), np.arange(2000))
+    for label, rows in enumerate(index.lists):
+        assert (index.labels[rows] == label).all()
+
+
+def test_recall_grows_with_nprobe_and_is_exact_with_every_list():
+    embeddings = synthetic_encodings(5000, n_clusters=200)
+    index = IVFIndex(n_lists=70).build(embeddings)
+    rows = np.random.default_rng(0).choice(len(embeddings), 200, replace=False)
+    queries = noisy(embeddings, rows)
+
+    recall = {}
+    for nprobe in (1, 8, 70):
+        recall[nprobe] = np.mean([row in index.candidates(query, nprobe) for row, query in zip(rows, queries)])
+
+    assert recall[1] <= recall[8] <= recall[70] == 1.0
+    assert recall[8] >= 0.95
+
+
+def test_add_and_remove_keep_rows_in_one_list():
+    embeddings = synthetic_encodings(1000, n_clusters=30)
+    index = IVFIndex(n_lists=10).build(embeddings)
+
+    # A replaced row moves to the list of its new embedding, an appended one joins its list
+    index.add(5, embeddings[900])
+    index.add(1000, embeddings[7])
+    assert index.labels[5] == index.labels[900]
+    assert index.labels[1000] == index.labels[7]
+
+    index.remove([5, 1000, 123456])
+    for row in (5, 1000):
+        assert index.labels[row] == -1
+        assert not any(row in rows for rows in index.lists)
+    assert sum(len(rows) for rows in index.lists) == 999
+
+
+def test_ivf_matcher_answers_like_the_exact_one(monkeypatch):
+    monkeypatch.setattr(matcher_module, 'ANN_MIN_SIZE', 100)
+    embeddings = synthetic_encodings(3000, n_clusters=100)
+    emails = ['user{}@example.com'.format(i) for i in range(len(embeddings))]
+    exact = EmbeddingMatcher().load_arrays(emails, embeddings)
+    ivf = EmbeddingMatcher(index='ivf', nprobe=2).load_arrays(emails, embeddings)
+    assert ivf._state[3] is not None
+
+    # Enrolled faces plus noise, and strangers only matched by the exact fallback scan if at all
+    rng = np.random.default_rng(2)
+    queries = np.concatenate([noisy(embeddings, rng.choice(len(embeddings), 100)),
+                              rng.normal(0, 0.1, size=(20, EMBEDDING_DIM)).astype(np.float32)])
+    for query in queries:
+        email, distance = ivf.match(query)
+        expected_email, expected_distance = exact.match(query)
+        assert (distance <= ivf.tolerance) == (expected_distance <= exact.tolerance)
+        if expected_distance <= exact.tolerance:
+            assert email == expected_email
+
+    # Registrations after the build are found through the index
+    ivf.add('new@example.com', embeddings[10] + 0.3)
+    assert ivf.match(embeddings[10] + 0.3)[0] == 'new@example.com'
@@ -0,0 +1,109 @@
+import datetime
+import threading
+
+import pytest
+
+from attendance import AttendanceState, LOCAL_TIMEZONE
+from storage import FileStorage, SQLiteStorage
+
+
+@pytest.fixture(params=['files', 'sqlite'])
+def storage(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteStorage(str(tmp_path / 'attendance.sqlite3'))
+    db_path, log_dir = tmp_path / 'db', tmp_path / 'logs'
+    db_path.mkdir()
+    log_dir.mkdir()
+    return FileStorage(str(db_path), str(log_dir))
+
+
+class Clock:
+
+    """
+    Settable replacement of AttendanceState._now.
+    """
+
+    def __init__(self, *args):
+        self.now = LOCAL_TIMEZONE.localize(datetime.datetime(*args))
+
+    def __call__(self):
+        return self.now
+
+
+def state_at(storage, clock):
+    state = AttendanceState(storage)
+    state._now = clock
+    return state
+
+
+def test_concurrent_log_ins_write_one_entry(storage):
+    state = state_at(storage, Clock(2024, 1, 15, 9, 0))
+    barrier = threading.Barrier(8)
+    times = []
+
+    def log_in():
+        barrier.wait()
+        times.append(state.log_in('user@example.com'))
+
+    threads = [threading.Thread(target=log_in) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert times.count(None) == 7
+    assert storage.attendance_rows('2024-01-15') == [('user@example.com', '09:00:00', 'IN')]
+
+
+def test_log_in_after_log_out_and_many(storage):
+    state = state_at(storage, Clock(2024, 1, 15, 9, 0))
+    assert state.status('user@example.com') is None
+    assert state.log_in('user@example.com') == '09:00:00'
+    assert state.record('user@example.com', 'OUT') == '09:00:00'
+    assert state.status('user@example.com') is False
+
+    # A user twice in one call and one already logged in get a single entry between them
+    state.log_in('other@example.com')
+    times = state.log_in_many(['user@example.com', 'user@example.com', 'other@example.com'])
+    assert times == {'user@example.com': '09:00:00', 'other@example.com': None}
+    assert state.present() == ['other@example.com', 'user@example.com']
+    assert len(storage.attendance_rows('2024-01-15')) == 4
+
+
+def test_table_starts_over_at_the_date_rollover(storage):
+    clock = Clock(2024, 1, 15, 23, 59)
+    state = state_at(storage, clock)
+    state.log_in('user@example.com')
+    assert state.present() == ['user@example.com']
+
+    clock.now += datetime.timedelta(minutes=2)
+    assert state.present() == []
+    assert state.status('user@example.com') is None
+    assert state.log_in('user@example.com') == '00:01:00'
+    assert storage.attendance_dates() == ['2024-01-15', '2024-01-16']
+
+
+def test_table_is_rebuilt_from_the_day_already_logged(storage):
+    storage.record_attendance([('user@example.com', '2024-01-15', '08:00:00', 'IN'),
+                               ('gone@example.com', '2024-01-15', '08:10:00', 'IN'),
+                               ('gone@example.com', '2024-01-15', '12:00:00', 'OUT')])
+    state = state_at(storage, Clock(2024, 1, 15, 13, 0))
+
+    assert state.present() == ['user@example.com']
+    assert state.log_in('user@example.com') is None
+    assert state.status('gone@example.com') is False
+
+
+def test_states_of_two_workers_see_each_other(storage):
+    clock = Clock(2024, 1, 15, 9, 0)
+    first, second = state_at(storage, clock), state_at(storage, clock)
+    assert first.present() == second.present() == []
+
+    first.log_in('user@example.com')
+    assert second.status('user@example.com') is True
+    assert second.log_in('user@example.com') is None
+
+    second.record('user@example.com', 'OUT')
+    assert first.present() == []
+    assert first.log_in('user@example.com') == '09:00:00'
+    assert [direction for _, _, direction in storage.attendance_rows('2024-01-15')] == ['IN', 'OUT', 'IN']
@@ -0,0 +1,158 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from anti_spoof.src.batch_scheduler import MicroBatcher
+
+
+class RecordingForward:
+
+    """
+    Forward pass doubling its input and recording the size of every batch it receives.
+    """
+
+    def __init__(self, fail=False):
+        self.batch_sizes = []
+        self.fail = fail
+
+    def __call__(self, batch):
+        self.batch_sizes.append(len(batch))
+        if self.fail:
+            raise RuntimeError("forward failed")
+        return batch * 2
+
+
+def sample(value):
+    return torch.full((1, 3), float(value))
+
+
+def test_full_batches_flush_without_waiting():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=4, max_wait_ms=10000)
+    try:
+        start = time.monotonic()
+        futures = [batcher.submit(sample(i)) for i in range(8)]
+        results = [future.result(timeout=5) for future in futures]
+        elapsed = time.monotonic() - start
+    finally:
+        batcher.close()
+
+    # Two full batches, none of them waits for the 10 s deadline
+    assert forward.batch_sizes == [4, 4]
+    assert elapsed < 5
+    for i, result in enumerate(results):
+        assert result.shape == (1, 3)
+        assert torch.equal(result, sample(2 * i))
+
+
+def test_partial_batch_flushes_at_the_deadline():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=8, max_wait_ms=50)
+    try:
+        start = time.monotonic()
+        futures = [batcher.submit(sample(i)) for i in range(3)]
+        results = [future.result(timeout=5) for future in futures]
+        elapsed = time.monotonic() - start
+    finally:
+        batcher.close()
+
+    assert forward.batch_sizes == [3]
+    assert 0.04 <= elapsed < 2
+    assert [float(result[0, 0]) for result in results] == [0.0, 2.0, 4.0]
+
+
+def test_lone_sample_waits_at_most_max_wait():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=16, max_wait_ms=20)
+    try:
+        start = time.monotonic()
+        result = batcher(sample(5))
+        elapsed = time.monotonic() - start
+    finally:
+        batcher.close()
+
+    assert forward.batch_sizes == [1]
+    assert torch.equal(result, sample(10))
+    assert elapsed < 1
+
+
+def test_concurrent_callers_share_batches():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=4, max_wait_ms=200)
+    results = {}
+    barrier = threading.Barrier(8)
+
+    def call(i):
+        barrier.wait()
+        results[i] = batcher(sample(i))
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=5)
+    finally:
+        batcher.close()
+
+    # Every caller gets its own row back, whatever batch it went in
+    assert sorted(results) == list(range(8))
+    for i, result in results.items():
+        assert torch.equal(result, sample(2 * i))
+    assert sum(forward.batch_sizes) == 8
+    assert max(forward.batch_sizes) <= 4
+    assert len(forward.batch_sizes) < 8
+
+
+def test_forward_error_reaches_every_caller_of_the_batch():
+    forward = RecordingForward(fail=True)
+    batcher = MicroBatcher(forward, max_batch_size=2, max_wait_ms=1000)
+    try:
+        futures = [batcher.submit(sample(i)) for i in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="forward failed"):
+                future.result(timeout=5)
+
+        # The worker survives the failure and serves the next batch
+        forward.fail = False
+        assert torch.equal(batcher.submit(sample(1)).result(timeout=5), sample(2))
+    finally:
+        batcher.close()
+
+
+def test_close_stops_the_worker_after_the_pending_batch():
+    forward = RecordingForward()
+    batcher = MicroBatcher(forward, max_batch_size=4, max_wait_ms=1000)
+    future = batcher.submit(sample(3))
+    batcher.close()
+
+    # The stop marker ends the batch being collected instead of waiting for the deadline
+    assert torch.equal(future.result(timeout=1), sample(6))
+    assert not batcher._thread.is_alive()
+    assert batcher.queue_depth == 0
+
+
+def test_batched_outputs_equal_single_forwards():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.Flatten(), torch.nn.Linear(4 * 6 * 6, 3),
+                                torch.nn.Softmax(dim=1)).eval()
+    crops = [torch.rand(1, 3, 8, 8) for _ in range(6)]
+    with torch.no_grad():
+        expected = [model(crop) for crop in crops]
+
+    def forward(batch):
+        with torch.no_grad():
+            return model(batch)
+
+    batcher = MicroBatcher(forward, max_batch_size=6, max_wait_ms=1000)
+    try:
+        results = [future.result(timeout=5) for future in [batcher.submit(crop) for crop in crops]]
+    finally:
+        batcher.close()
+
+    # The crops of concurrent requests get the scores they would get one at a time
+    for result, single in zip(results, expected):
+        assert result.shape == single.shape
+        assert torch.allclose(result, single, atol=1e-6)
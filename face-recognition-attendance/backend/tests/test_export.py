@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+import zipfile
+
+import pytest
+
+from export import AttendanceExporter
+from storage import FileStorage
+
+
+ATTENDANCE = [
+    ('user0@example.com', '2024-01-15', '09:00:00', 'IN'),
+    ('user1@example.com', '2024-01-15', '09:05:00', 'IN'),
+    ('user0@example.com', '2024-01-15', '15:30:00', 'OUT'),
+    ('user2@example.com', '2024-01-16', '08:55:00', 'IN'),
+    ('user1@example.com', '2024-01-18', '10:00:00', 'IN'),
+]
+
+
+@pytest.fixture
+def exporter(tmp_path):
+    db_path, log_dir = tmp_path / 'db', tmp_path / 'logs'
+    db_path.mkdir()
+    log_dir.mkdir()
+    storage = FileStorage(str(db_path), str(log_dir))
+    storage.record_attendance(ATTENDANCE)
+    return AttendanceExporter(storage)
+
+
+def day_csv(date):
+    return ''.join('{},{},{}\n'.format(email, time_, direction)
+                   for email, day, time_, direction in ATTENDANCE if day == date)
+
+
+def test_dates_of_a_range(exporter):
+    assert exporter.dates() == ['2024-01-15', '2024-01-16', '2024-01-18']
+    assert exporter.dates('2024-01-16') == ['2024-01-16', '2024-01-18']
+    assert exporter.dates('2024-01-16', '2024-01-17') == ['2024-01-16']
+    assert exporter.dates(end='2024-01-14') == []
+
+
+def test_streamed_zip_is_a_valid_archive(exporter):
+    dates = exporter.dates()
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(exporter.stream(dates, 'zip'))))
+
+    assert archive.testzip() is None
+    assert archive.namelist() == ['{}.csv'.format(date) for date in dates]
+    for date in dates:
+        info = archive.getinfo('{}.csv'.format(date))
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.date_time[:3] == tuple(int(part) for part in date.split('-'))
+        assert archive.read(info).decode() == day_csv(date)
+
+
+def test_cached_closed_days_give_the_same_archive(exporter):
+    dates = exporter.dates()
+    first = b''.join(exporter.stream(dates, 'zip'))
+    assert list(exporter._closed_days) == dates
+
+    assert b''.join(exporter.stream(dates, 'zip')) == first
+    # A sub-range reuses the cached members at other offsets
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(exporter.stream(dates[1:], 'zip'))))
+    assert archive.testzip() is None
+    assert archive.read('2024-01-18.csv').decode() == day_csv('2024-01-18')
+
+
+def test_empty_range_is_an_empty_archive(exporter):
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(exporter.stream([], 'zip'))))
+    assert archive.namelist() == []
+
+
+def test_csv_and_ndjson_hold_every_entry(exporter):
+    dates = exporter.dates()
+    rows = list(csv.reader(io.StringIO(b''.join(exporter.stream(dates, 'csv')).decode())))
+    assert rows[0] == ['date', 'email', 'time', 'direction']
+    assert rows[1:] == [[day, email, time_, direction] for email, day, time_, direction in ATTENDANCE]
+
+    lines = b''.join(exporter.stream(dates, 'ndjson')).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [{"date": day, "email": email, "time": time_, "direction": direction}
+                                                    for email, day, time_, direction in ATTENDANCE]
+
+    with pytest.raises(ValueError):
+        exporter.stream(dates, 'xlsx')
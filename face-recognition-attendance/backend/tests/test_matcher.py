@@ -0,0 +1,69 @@
+import face_recognition
+import numpy as np
+import pytest
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM, DEFAULT_TOLERANCE
+
+
+def known_and_queries(n_known=200, n_queries=100, seed=0):
+    # Enrolled faces about 1.6 apart, queries from 0 to 1.2 away from one of them, and some right at the
+    # tolerance, the boundary where a float32 rounding could flip the decision
+    rng = np.random.default_rng(seed)
+    known = rng.normal(0, 0.1, size=(n_known, EMBEDDING_DIM))
+    owners = rng.integers(n_known, size=n_queries)
+    directions = rng.normal(size=(n_queries, EMBEDDING_DIM))
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    offsets = rng.uniform(0, 1.2, size=n_queries)
+    boundary = min(20, n_queries)
+    offsets[:boundary] = DEFAULT_TOLERANCE + rng.choice([-1e-6, 1e-6], size=boundary)
+    return known, known[owners] + directions * offsets[:, None]
+
+
+def emails_of(n):
+    return ['user{}@example.com'.format(i) for i in range(n)]
+
+
+def test_distances_equal_face_distance():
+    known, queries = known_and_queries()
+    matcher = EmbeddingMatcher().load_arrays(emails_of(len(known)), known)
+
+    for query in queries[:10]:
+        np.testing.assert_allclose(matcher.distances(query), face_recognition.face_distance(known, query), atol=1e-5)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_decisions_equal_compare_faces(batch):
+    known, queries = known_and_queries()
+    emails = emails_of(len(known))
+    matcher = EmbeddingMatcher().load_arrays(emails, known)
+
+    # The enrolled embeddings are stored in float32, as in the embedding store
+    stored = known.astype(np.float32).astype(np.float64)
+
+    matches = matcher.match_many(queries) if batch else [matcher.match(query) for query in queries]
+    for query, (email, distance) in zip(queries, matches):
+        distances = face_recognition.face_distance(stored, query)
+        # Accepted exactly when compare_faces finds someone, and then it is the closest of them
+        assert (distance <= matcher.tolerance) == any(face_recognition.compare_faces(stored, query))
+        assert email == emails[int(np.argmin(distances))]
+        assert distance == pytest.approx(distances.min(), abs=1e-12)
+
+
+def test_add_replaces_and_appends():
+    known, queries = known_and_queries(n_known=10, n_queries=1)
+    matcher = EmbeddingMatcher().load_arrays(emails_of(10), known)
+    generation = matcher.generation
+
+    matcher.add('user3@example.com', queries[0])
+    matcher.add('new@example.com', known[3])
+    assert len(matcher) == 11
+    assert matcher.generation > generation
+    assert matcher.match(queries[0]) == ('user3@example.com', pytest.approx(0, abs=1e-6))
+    assert matcher.match(known[3])[0] == 'new@example.com'
+
+
+def test_empty_matcher_matches_nobody():
+    matcher = EmbeddingMatcher()
+    assert matcher.match(np.zeros(EMBEDDING_DIM)) == (None, float('inf'))
+    assert matcher.match_many(np.zeros((2, EMBEDDING_DIM))) == [(None, float('inf'))] * 2
+    assert matcher.distance_to('nobody@example.com', np.zeros(EMBEDDING_DIM)) == float('inf')
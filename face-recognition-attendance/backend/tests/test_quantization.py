@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from benchmarks.bench_ann import synthetic_encodings
+from benchmarks.bench_quantization import make_queries
+from matcher import EmbeddingMatcher
+from quantization import QuantizedMatrix
+
+
+def emails_of(n, prefix='user'):
+    return ['{}{}@example.com'.format(prefix, i) for i in range(n)]
+
+
+@pytest.fixture(scope='module')
+def registry():
+    # Half the queries are enrolled faces 0.3 to 0.9 away, around the 0.6 tolerance, half are strangers
+    embeddings = synthetic_encodings(5000, n_clusters=300)
+    queries = make_queries(embeddings, 300, np.random.default_rng(1))
+    return emails_of(len(embeddings)), embeddings, queries
+
+
+@pytest.mark.parametrize('precision', ['float16', 'int8'])
+def test_scanned_distances_are_within_the_error(registry, precision):
+    _, embeddings, queries = registry
+    quantized = QuantizedMatrix.fit(embeddings, precision)
+
+    scanned = np.sqrt(np.maximum(quantized.sq_distances(queries[:20]), 0))
+    real = np.linalg.norm(embeddings[None, :, :] - queries[:20, None, :], axis=2)
+    assert np.abs(scanned - real).max() <= quantized.error + 1e-4
+
+
+@pytest.mark.parametrize('precision', ['float16', 'int8'])
+@pytest.mark.parametrize('rerank', [1, 10])
+def test_decisions_equal_float32(registry, precision, rerank):
+    emails, embeddings, queries = registry
+    reference = EmbeddingMatcher().load_arrays(emails, embeddings)
+    matcher = EmbeddingMatcher(precision=precision, rerank=rerank).load_arrays(emails, embeddings)
+
+    expected = reference.match_many(queries)
+    for found in ([matcher.match(query) for query in queries], matcher.match_many(queries)):
+        assert_same_decisions(found, expected, matcher.tolerance)
+
+
+def assert_same_decisions(found, expected, tolerance):
+    # The same accept/reject decision, and an accepted face goes to the same user at the same float64
+    # distance. A face that can not match anyone only rescores a few rows, its closest row may differ.
+    assert [distance <= tolerance for _, distance in found] == [distance <= tolerance for _, distance in expected]
+    for (email, distance), (expected_email, expected_distance) in zip(found, expected):
+        if expected_distance <= tolerance:
+            assert (email, distance) == (expected_email, expected_distance)
+
+
+def test_registrations_keep_the_decisions(registry):
+    emails, embeddings, queries = registry
+    reference = EmbeddingMatcher().load_arrays(emails[:4000], embeddings[:4000])
+    matcher = EmbeddingMatcher(precision='int8').load_arrays(emails[:4000], embeddings[:4000])
+    quantized = matcher._state[4]
+
+    # Users within the fitted range only quantize their rows, a far one refits the scales
+    within = embeddings[:1000] * 0.99
+    for matcher_ in (reference, matcher):
+        matcher_.add_many(emails_of(1000, 'new'), within)
+        matcher_.add('user0@example.com', embeddings[1])
+    assert matcher._state[4].scale is quantized.scale
+    outlier = embeddings[2] + 5
+    for matcher_ in (reference, matcher):
+        matcher_.add('far@example.com', outlier)
+    assert matcher._state[4].scale is not quantized.scale
+
+    assert_same_decisions(matcher.match_many(queries), reference.match_many(queries), matcher.tolerance)
+    assert matcher.match(outlier) == ('far@example.com', 0.0)
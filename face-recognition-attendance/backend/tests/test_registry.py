@@ -0,0 +1,85 @@
+import csv
+import os
+
+import pytest
+
+from registry import UserRegistry, USER_FIELDS
+
+
+def append_users(path, rows):
+    with open(path, 'a', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+
+def user_row(i, class_='10', division='A', name=None):
+    return [name or 'User {}'.format(i), 'user{}@example.com'.format(i), '', class_, division, '', '']
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = str(tmp_path / 'user_details.csv')
+    append_users(path, [USER_FIELDS] + [user_row(i, str(10 + i % 2), 'AB'[i % 3 == 0]) for i in range(6)])
+    return path
+
+
+def test_unchanged_file_is_not_parsed_again(csv_path):
+    registry = UserRegistry(csv_path)
+    assert len(registry) == 6
+    state = registry._state
+
+    assert registry.get('user1@example.com')['class'] == '11'
+    assert 'user5@example.com' in registry
+    assert registry._state is state
+
+
+def test_appended_users_are_picked_up(csv_path):
+    registry = UserRegistry(csv_path)
+    assert 'user6@example.com' not in registry
+
+    append_users(csv_path, [user_row(6, '12', 'C')])
+    assert 'user6@example.com' in registry
+    assert registry.query(class_='12') == (1, [registry.get('user6@example.com')])
+
+
+def test_external_edit_of_the_same_size_is_picked_up(csv_path):
+    registry = UserRegistry(csv_path)
+    assert registry.get('user0@example.com')['name'] == 'User 0'
+
+    with open(csv_path) as f:
+        content = f.read()
+    with open(csv_path, 'w') as f:
+        f.write(content.replace('User 0', 'User X'))
+    # Same size, a later modification time
+    stat = os.stat(csv_path)
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+    assert registry.get('user0@example.com')['name'] == 'User X'
+
+
+def test_user_registered_again_is_indexed_once(csv_path):
+    append_users(csv_path, [user_row(1, '12', 'C', name='Moved')])
+    registry = UserRegistry(csv_path)
+
+    assert len(registry) == 6
+    assert registry.get('user1@example.com')['name'] == 'Moved'
+    assert registry.query(class_='11')[0] == 2
+    assert registry.query(class_='12', division='C') == (1, [registry.get('user1@example.com')])
+
+
+def test_query_filters_and_pages(csv_path):
+    registry = UserRegistry(csv_path)
+
+    total, users = registry.query(page=2, page_size=4)
+    assert total == 6
+    assert [user['email'] for user in users] == ['user4@example.com', 'user5@example.com']
+    assert [user['email'] for user in registry.query(class_='10', division='B')[1]] == ['user0@example.com']
+    assert registry.query(division='Z') == (0, [])
+
+
+def test_removed_file_empties_the_registry(csv_path):
+    registry = UserRegistry(csv_path)
+    assert len(registry) == 6
+
+    os.remove(csv_path)
+    assert len(registry) == 0
+    assert registry.get('user0@example.com') is None
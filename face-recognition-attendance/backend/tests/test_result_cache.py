@@ -0,0 +1,132 @@
+import random
+
+import numpy as np
+import pytest
+
+import result_cache
+from result_cache import ResultCache, dhash, hamming_distance
+
+
+class Clock:
+
+    """
+    Settable replacement of time.monotonic.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_cache.time, 'monotonic', clock)
+    return clock
+
+
+def flip(key, bits, seed=0):
+    for bit in random.Random(seed).sample(range(256), bits):
+        key ^= 1 << bit
+    return key
+
+
+KEY = random.Random(42).getrandbits(256)
+
+
+def test_enrollment_change_makes_older_entries_miss(clock):
+    cache = ResultCache(max_size=8, ttl_s=10, max_distance=8)
+    cache.put(KEY, 1, 'user@example.com')
+    assert cache.get(KEY, 1) == 'user@example.com'
+
+    # Exact and near-duplicate lookups of the next generation both miss, and drop the entry
+    assert cache.get(flip(KEY, 3), 2) is None
+    assert cache.get(KEY, 2) is None
+    assert len(cache) == 0
+    assert cache.stats()['expirations'] == 1
+
+
+def test_scope_is_part_of_the_key(clock):
+    cache = ResultCache(max_size=8, ttl_s=10, max_distance=8)
+    cache.put(KEY, 1, 'in 10/A', context=(('10', 'A'),))
+
+    assert cache.get(KEY, 1) is None
+    assert cache.get(flip(KEY, 2), 1, context=(('10', 'B'),)) is None
+    assert cache.get(flip(KEY, 2), 1, context=(('10', 'A'),)) == 'in 10/A'
+
+    # The same frame in another scope is stored next to it
+    cache.put(KEY, 1, 'everyone')
+    assert cache.get(KEY, 1) == 'everyone'
+    assert cache.get(KEY, 1, context=(('10', 'A'),)) == 'in 10/A'
+
+
+def test_near_duplicates_within_max_distance_hit(clock):
+    cache = ResultCache(max_size=64, ttl_s=10, max_distance=8)
+    others = [random.Random(i).getrandbits(256) for i in range(50)]
+    for i, key in enumerate(others):
+        cache.put(key, 1, i)
+    cache.put(KEY, 1, 'target')
+
+    for seed in range(20):
+        assert cache.lookup(flip(KEY, 8, seed), 1) == ('target', 8, 0.0)
+        assert cache.get(flip(KEY, 9, seed), 1) is None
+
+
+def test_lookup_reports_distance_and_age(clock):
+    cache = ResultCache(max_size=8, ttl_s=10, max_distance=8)
+    cache.put(KEY, 1, 'value')
+    clock.now += 1.5
+
+    assert cache.lookup(KEY, 1) == ('value', 0, 1.5)
+    assert cache.lookup(flip(KEY, 4), 1) == ('value', 4, 1.5)
+
+
+def test_entries_expire_in_storage_order(clock):
+    cache = ResultCache(max_size=8, ttl_s=10)
+    cache.put(1, 1, 'first')
+    clock.now += 5
+    cache.put(2, 1, 'second')
+    # Stored again, it lives 10 s from now instead of from its first storage
+    cache.put(1, 1, 'first again')
+
+    clock.now += 6
+    assert cache.get(1, 1) == 'first again'
+    assert cache.get(2, 1) == 'second'
+    clock.now += 5
+    assert cache.get(1, 1) is None
+    assert cache.get(2, 1) is None
+    assert cache.stats()['expirations'] == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResultCache(max_size=2, ttl_s=10, max_distance=8)
+    cache.put(KEY, 1, 'a')
+    cache.put(flip(KEY, 100), 1, 'b')
+    cache.get(KEY, 1)
+    cache.put(flip(KEY, 200), 1, 'c')
+
+    assert cache.get(flip(KEY, 100), 1) is None
+    assert cache.get(KEY, 1) == 'a'
+    assert cache.stats()['evictions'] == 1
+    # An evicted key leaves no band behind for near-duplicate lookups
+    assert sum(len(bucket) for buckets in cache._buckets for bucket in buckets.values()) == 2 * len(cache._bands)
+
+
+def test_disabled_cache_stores_nothing(clock):
+    cache = ResultCache(max_size=0)
+    cache.put(KEY, 1, 'value')
+    assert cache.get(KEY, 1) is None
+    assert len(cache) == 0
+
+
+def test_dhash_of_a_noisy_copy_is_close():
+    rng = np.random.default_rng(0)
+    image = (rng.random((120, 100, 3)) * 255).astype(np.uint8)
+    noisy = np.clip(image + rng.normal(0, 2, size=image.shape), 0, 255).astype(np.uint8)
+    other = (rng.random((120, 100, 3)) * 255).astype(np.uint8)
+
+    assert dhash(image) == dhash(image.copy())
+    assert hamming_distance(dhash(image), dhash(noisy)) <= 8
+    assert hamming_distance(dhash(image), dhash(other)) > 64
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from matcher import EmbeddingMatcher, EMBEDDING_DIM, in_scope
+
+
+SECTIONS = [('10', 'A'), ('10', 'B'), ('11', 'A'), ('11', 'B')]
+
+
+@pytest.fixture
+def registry():
+    # 40 users, 10 per section, user i in SECTIONS[i % 4]
+    embeddings = np.random.default_rng(0).normal(0, 0.1, size=(40, EMBEDDING_DIM)).astype(np.float32)
+    sections = {'user{}@example.com'.format(i): SECTIONS[i % 4] for i in range(40)}
+    matcher = EmbeddingMatcher(sections=lambda emails: [sections.get(email, (None, None)) for email in emails])
+    return matcher.load_arrays(list(sections), embeddings), embeddings, sections
+
+
+def test_in_scope():
+    assert in_scope(('10', 'A'), (('10', 'A'),))
+    assert in_scope(('10', 'B'), (('10', None),))
+    assert in_scope(('11', 'A'), ((None, 'A'),))
+    assert in_scope(('11', 'B'), (('10', 'A'), ('11', None)))
+    assert not in_scope(('11', 'B'), (('10', None), (None, 'A')))
+
+
+def test_scoped_search_only_sees_its_sections(registry):
+    matcher, embeddings, sections = registry
+
+    # User 5 is in 10/B: found in its class, out of reach from 10/A where the best is someone of 10/A
+    assert matcher.match(embeddings[5], (('10', None),)) == ('user5@example.com', 0.0)
+    email, distance = matcher.match(embeddings[5], (('10', 'A'),))
+    assert sections[email] == ('10', 'A')
+    assert distance > matcher.tolerance
+
+
+def test_fallback_searches_everyone_on_a_miss(registry):
+    matcher, embeddings, _ = registry
+    scope = (('10', 'A'),)
+
+    assert matcher.match(embeddings[5], scope, fallback=True) == ('user5@example.com', 0.0)
+    # A hit in the scope does not search further
+    assert matcher.match(embeddings[4], scope, fallback=True) == ('user4@example.com', 0.0)
+    # An empty scope finds nobody, unless it falls back
+    assert matcher.match(embeddings[5], (('12', None),)) == (None, float('inf'))
+    assert matcher.match(embeddings[5], (('12', None),), fallback=True)[0] == 'user5@example.com'
+
+
+def test_match_many_falls_back_for_the_misses_only(registry):
+    matcher, embeddings, _ = registry
+    queries = embeddings[[4, 5, 8, 9]]
+    scope = (('10', 'A'),)
+
+    found = matcher.match_many(queries, scope, fallback=True)
+    assert [email for email, _ in found] == ['user4@example.com', 'user5@example.com',
+                                             'user8@example.com', 'user9@example.com']
+    assert found == [matcher.match(query, scope, fallback=True) for query in queries]
+
+    without = matcher.match_many(queries, scope)
+    assert [distance <= matcher.tolerance for _, distance in without] == [True, False, True, False]
+
+
+def test_enrollment_moves_a_user_between_sections(registry):
+    matcher, embeddings, sections = registry
+    scope = (('11', 'B'),)
+    matcher.match(embeddings[0], scope)
+
+    # Registered again in 11/B, and a new user of 11/B, after the section index was built
+    sections['user0@example.com'] = ('11', 'B')
+    sections['new@example.com'] = ('11', 'B')
+    matcher.add_many(['user0@example.com', 'new@example.com'], [embeddings[0], embeddings[1] + 0.2])
+
+    assert matcher.match(embeddings[0], scope) == ('user0@example.com', 0.0)
+    assert matcher.match(embeddings[1] + 0.2, scope)[0] == 'new@example.com'
+    assert matcher.match(embeddings[0], (('10', 'A'),))[1] > matcher.tolerance
+
+
+def test_scoped_search_needs_the_sections():
+    matcher = EmbeddingMatcher().load_arrays(['user@example.com'], np.zeros((1, EMBEDDING_DIM)))
+    with pytest.raises(ValueError):
+        matcher.match(np.zeros(EMBEDDING_DIM), (('10', 'A'),))
@@ -0,0 +1,163 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+import shared_registry
+from matcher import EMBEDDING_DIM
+from shared_registry import SharedEmbeddingMatcher, SegmentMapping, TOMBSTONE_NORM
+
+
+def random_embeddings(n, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, EMBEDDING_DIM)).astype(np.float32)
+
+
+def emails_of(n, prefix='user'):
+    return ['{}{}@example.com'.format(prefix, i) for i in range(n)]
+
+
+@pytest.fixture
+def segment(tmp_path):
+    return str(tmp_path / 'registry.seg')
+
+
+@pytest.fixture
+def small_capacity(monkeypatch):
+    # Segments start with room for 4 rows, so a few registrations make them grow
+    monkeypatch.setattr(shared_registry, 'INITIAL_CAPACITY', 4)
+
+
+def attach(path, emails, embeddings, **options):
+    return SharedEmbeddingMatcher(path, **options).attach(lambda: (emails, embeddings))
+
+
+def test_second_matcher_maps_the_segment_of_the_first(segment):
+    embeddings = random_embeddings(5)
+    first = attach(segment, emails_of(5), embeddings)
+    # The second matcher finds the segment built and never calls its load
+    second = SharedEmbeddingMatcher(segment).attach(lambda: pytest.fail("the segment was built again"))
+
+    assert len(first) == len(second) == 5
+    for i, embedding in enumerate(embeddings):
+        assert second.match(embedding) == ('user{}@example.com'.format(i), pytest.approx(0, abs=1e-3))
+
+
+def test_registrations_are_seen_by_the_other_matcher_on_refresh(segment):
+    embeddings = random_embeddings(6)
+    first = attach(segment, emails_of(3), embeddings[:3])
+    second = SharedEmbeddingMatcher(segment).attach(lambda: None)
+    generation = second.generation
+    state = second._state
+
+    # Nothing changed: refresh keeps the same state
+    assert second.refresh()._state is state
+
+    first.add_many(['new0@example.com', 'new1@example.com'], embeddings[3:5])
+    assert second.generation == generation
+    second.refresh()
+    assert second.generation > generation
+    assert len(second) == 5
+    assert second.match(embeddings[4])[0] == 'new1@example.com'
+
+    # get_matcher() refreshes on every call, a single add is picked up the same way
+    first.add('new2@example.com', embeddings[5])
+    assert second.refresh().match(embeddings[5])[0] == 'new2@example.com'
+
+
+def test_segment_grows_past_its_capacity(segment, small_capacity):
+    embeddings = random_embeddings(40)
+    first = attach(segment, emails_of(2), embeddings[:2])
+    second = SharedEmbeddingMatcher(segment).attach(lambda: None)
+    capacity = first._mapping.field(shared_registry._CAPACITY)
+    assert capacity == 4
+
+    # One at a time and in one batch larger than the capacity
+    for i in range(2, 10):
+        first.add('user{}@example.com'.format(i), embeddings[i])
+    first.add_many(emails_of(40)[10:], embeddings[10:])
+
+    second.refresh()
+    assert second._mapping.field(shared_registry._CAPACITY) >= 40
+    assert len(second) == 40
+    for i in (0, 3, 9, 25, 39):
+        assert second.match(embeddings[i])[0] == 'user{}@example.com'.format(i)
+
+    # The old segment files are retired, the readers moved to the current one
+    assert not second._mapping.field(shared_registry._RETIRED)
+    assert SegmentMapping(segment).field(shared_registry._COUNT) == 40
+
+
+def test_enrolling_again_tombstones_the_old_row(segment):
+    embeddings = random_embeddings(4)
+    first = attach(segment, emails_of(3), embeddings[:3])
+    second = SharedEmbeddingMatcher(segment).attach(lambda: None)
+
+    first.add('user1@example.com', embeddings[3])
+    second.refresh()
+
+    # One user more in the segment rows, not in the users
+    assert len(second) == 3
+    mapping = SegmentMapping(segment)
+    assert mapping.field(shared_registry._COUNT) == 4
+    assert mapping.field(shared_registry._REPLACED) == 1
+    assert mapping.norms[1] == np.float32(TOMBSTONE_NORM)
+
+    # The new embedding matches, the old one no longer matches that user
+    assert second.match(embeddings[3]) == ('user1@example.com', pytest.approx(0, abs=1e-3))
+    email, distance = second.match(embeddings[1])
+    assert email != 'user1@example.com' or distance > second.tolerance
+    assert second.distance_to('user1@example.com', embeddings[3]) == pytest.approx(0, abs=1e-3)
+
+
+def test_rebuilt_segment_resets_the_state_of_the_readers(segment):
+    embeddings = random_embeddings(8)
+    first = attach(segment, emails_of(4), embeddings[:4])
+    second = SharedEmbeddingMatcher(segment).attach(lambda: None)
+    generation = second.generation
+
+    first.load_arrays(emails_of(4, prefix='other'), embeddings[4:])
+    second.refresh()
+
+    assert second.generation > generation
+    assert len(second) == 4
+    assert second.match(embeddings[5])[0] == 'other1@example.com'
+    assert second.distance_to('user1@example.com', embeddings[1]) == float('inf')
+
+
+def test_replaced_rows_leave_their_ivf_list(segment, monkeypatch):
+    monkeypatch.setattr('matcher.ANN_MIN_SIZE', 16)
+    embeddings = random_embeddings(80)
+    first = attach(segment, emails_of(64), embeddings[:64], index='ivf', n_lists=4, nprobe=4)
+    second = SharedEmbeddingMatcher(segment, index='ivf', n_lists=4, nprobe=4).attach(lambda: None)
+
+    first.add_many(emails_of(16), embeddings[64:])
+    second.refresh()
+
+    for matcher in (first, second):
+        index = matcher._state[3]
+        rows = np.concatenate(index.lists)
+        # Every live row exactly once, the 16 replaced rows in no list
+        assert len(rows) == len(np.unique(rows)) == 64
+        assert not np.isin(np.arange(16), rows).any()
+        assert matcher.match(embeddings[70])[0] == 'user6@example.com'
+
+
+def _register_in_child(path, email, embedding):
+    matcher = SharedEmbeddingMatcher(path).attach(lambda: None)
+    matcher.add(email, embedding)
+
+
+def test_registration_in_another_process(segment):
+    embeddings = random_embeddings(3)
+    matcher = attach(segment, emails_of(2), embeddings[:2])
+
+    process = multiprocessing.get_context('fork').Process(target=_register_in_child,
+                                                          args=(segment, 'child@example.com', embeddings[2]))
+    process.start()
+    process.join(timeout=30)
+    assert process.exitcode == 0
+
+    assert matcher.refresh().match(embeddings[2])[0] == 'child@example.com'
+    assert len(matcher) == 3
+    assert os.path.exists(segment + '.lock')
@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pytest
+
+from matcher import EMBEDDING_DIM
+from storage import FileStorage, SQLiteStorage, migrate_files_to_sqlite
+
+
+@pytest.fixture
+def file_storage(tmp_path):
+    db_path, log_dir = tmp_path / 'db', tmp_path / 'logs'
+    db_path.mkdir()
+    log_dir.mkdir()
+    return FileStorage(str(db_path), str(log_dir))
+
+
+def add_users(storage, n, seed=0):
+    embeddings = np.random.default_rng(seed).normal(size=(n, EMBEDDING_DIM))
+    users = [('User {}'.format(i), 'user{}@example.com'.format(i), '98765{}'.format(i), str(10 + i % 2), 'AB'[i % 2],
+              os.path.join(storage.db_path, 'user{}@example.com.png'.format(i)), [embeddings[i]])
+             for i in range(n)]
+    storage.add_users(users)
+    return embeddings
+
+
+ATTENDANCE = [
+    ('user0@example.com', '2024-01-15', '09:00:00', 'IN'),
+    ('user1@example.com', '2024-01-15', '09:05:00', 'IN'),
+    ('user0@example.com', '2024-01-15', '15:30:00', 'OUT'),
+    ('user2@example.com', '2024-01-16', '08:55:00', 'IN'),
+]
+
+
+def test_migration_round_trip(file_storage, tmp_path):
+    embeddings = add_users(file_storage, 5)
+    # A user without any embedding (no face found at registration)
+    file_storage.add_user('No Face', 'noface@example.com', '', '10', 'A', '', [])
+    file_storage.record_attendance(ATTENDANCE)
+
+    sqlite_path = str(tmp_path / 'attendance.sqlite3')
+    counts = migrate_files_to_sqlite(file_storage.db_path, file_storage.log_dir, sqlite_path)
+    assert counts == {"users": 6, "embeddings": 5, "attendance": len(ATTENDANCE)}
+
+    target = SQLiteStorage(sqlite_path)
+    assert {user["email"]: user for user in target.users()} == {user["email"]: user for user in file_storage.users()}
+    assert target.get_user('user3@example.com') == file_storage.get_user('user3@example.com')
+    assert target.user_exists('noface@example.com')
+
+    # The float32 rows of the embedding store, as float64 in the database
+    emails, matrix = target.load_embeddings()
+    assert sorted(emails) == ['user{}@example.com'.format(i) for i in range(5)]
+    for email, embedding in zip(emails, matrix):
+        np.testing.assert_allclose(embedding, embeddings[int(email[4])], rtol=1e-6)
+
+    assert target.attendance_dates() == file_storage.attendance_dates() == ['2024-01-15', '2024-01-16']
+    for date in target.attendance_dates():
+        assert target.attendance_rows(date) == file_storage.attendance_rows(date)
+        assert target.attendance_status(date) == file_storage.attendance_status(date)
+    assert target.attendance_status('2024-01-15') == {'user0@example.com': False, 'user1@example.com': True}
+
+
+def test_migration_twice_does_not_duplicate(file_storage, tmp_path):
+    add_users(file_storage, 3)
+    file_storage.record_attendance(ATTENDANCE)
+    sqlite_path = str(tmp_path / 'attendance.sqlite3')
+    migrate_files_to_sqlite(file_storage.db_path, file_storage.log_dir, sqlite_path)
+
+    # A new day and a new user since the first run
+    file_storage.record_attendance([('user1@example.com', '2024-01-17', '10:00:00', 'IN')])
+    add_users(file_storage, 4)
+    counts = migrate_files_to_sqlite(file_storage.db_path, file_storage.log_dir, sqlite_path)
+
+    target = SQLiteStorage(sqlite_path)
+    assert counts["attendance"] == 1
+    assert len(target.users()) == 4
+    assert len(target.load_embeddings()[0]) == 4
+    assert sum(len(target.attendance_rows(date)) for date in target.attendance_dates()) == len(ATTENDANCE) + 1
+
+
+
+@pytest.fixture(params=['files', 'sqlite'])
+def storage(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteStorage(str(tmp_path / 'attendance.sqlite3'))
+    db_path, log_dir = tmp_path / 'db', tmp_path / 'logs'
+    db_path.mkdir()
+    log_dir.mkdir()
+    return FileStorage(str(db_path), str(log_dir))
+
+
+def test_both_backends_filter_and_page_users(storage):
+    for i in range(7):
+        storage.add_user('User {}'.format(i), 'user{}@example.com'.format(i), '', str(10 + i % 2), 'AB'[i % 3 == 0],
+                         '', [np.zeros(EMBEDDING_DIM)])
+
+    total, users = storage.query_users(page=2, page_size=3)
+    assert total == 7
+    assert [user['email'] for user in users] == ['user3@example.com', 'user4@example.com', 'user5@example.com']
+
+    total, users = storage.query_users(class_='10', division='B')
+    assert total == 2
+    assert [user['email'] for user in users] == ['user0@example.com', 'user6@example.com']
+    assert storage.query_users(class_='12') == (0, [])
+
+
+def test_both_backends_replace_the_embedding_of_a_user_enrolled_again(storage):
+    first, second = np.random.default_rng(0).normal(size=(2, EMBEDDING_DIM))
+    storage.add_user('Old Name', 'user@example.com', '', '10', 'A', '', [first])
+    storage.add_user('New Name', 'user@example.com', '', '11', 'B', '', [second])
+
+    emails, matrix = storage.load_embeddings()
+    assert list(emails) == ['user@example.com']
+    np.testing.assert_allclose(matrix[0], second, rtol=1e-6)
+    assert storage.get_user('user@example.com')['name'] == 'New Name'
+    assert storage.get_user('missing@example.com') is None
+
+
+def test_both_backends_keep_the_last_direction_of_the_day(storage):
+    storage.record_attendance(ATTENDANCE)
+
+    assert storage.attendance_dates() == ['2024-01-15', '2024-01-16']
+    assert storage.attendance_rows('2024-01-15') == [(email, time_, direction)
+                                                     for email, _, time_, direction in ATTENDANCE[:3]]
+    assert storage.attendance_status('2024-01-15') == {'user0@example.com': False, 'user1@example.com': True}
+    assert storage.attendance_status('2024-01-20') == {}
@@ -0,0 +1,136 @@
+import itertools
+
+import numpy as np
+
+
+def iou_matrix(boxes_a, boxes_b):
+
+    """
+    Function to compute the intersection over union of every pair of [x, y, w, h] boxes.
+
+    Returns:
+    numpy.ndarray: A (len(boxes_a), len(boxes_b)) matrix of IoU values.
+    """
+
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+
+    left = np.maximum(a[:, None, 0], b[None, :, 0])
+    top = np.maximum(a[:, None, 1], b[None, :, 1])
+    right = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    bottom = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - intersection
+    return intersection / np.maximum(union, 1e-9)
+
+
+class Track:
+
+    """
+    One face followed across the frames of a stream.
+
+    The identity (user, status) is set by the recognition pipeline and kept while the face stays matched
+    to the same track. confidence is the detector score times the IoU with the previous box, it drops when
+    the detection gets unsure or the face moves abruptly, which is when the identity should be checked again.
+    """
+
+    def __init__(self, track_id, bbox, score):
+        self.id = track_id
+        self.bbox = bbox
+        self.score = score
+        self.confidence = score
+        self.missed = 0
+        self.frames_since_recognition = 0
+        self.user = None
+        self.status = None
+
+    def as_dict(self):
+        return {"track": self.id, "bbox": self.bbox, "user": self.user, "status": self.status}
+
+
+class FaceTracker:
+
+    """
+    IoU tracker of the faces of one video stream.
+
+    Every frame's detections are greedily matched to the live tracks by decreasing IoU. Unmatched detections
+    start new tracks and tracks left unmatched for more than max_missed frames are dropped. update() returns
+    the tracks whose identity must be computed: new tracks, tracks whose confidence fell below min_confidence
+    and tracks still without a recognized user after retry_frames frames.
+
+    Parameters:
+    iou_threshold (float): Smallest IoU for a detection to continue a track.
+    max_missed (int): Number of frames a track survives without a detection.
+    min_confidence (float): Tracks under this confidence are recognized again.
+    retry_frames (int): Frames between two recognition attempts of a track without a recognized user.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_missed=5, min_confidence=0.5, retry_frames=15):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.min_confidence = min_confidence
+        self.retry_frames = retry_frames
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def update(self, detections):
+
+        """
+        Advance the tracker by one frame.
+
+        Parameters:
+        detections (list): The ([x, y, w, h], score) of every face detected in the frame.
+
+        Returns:
+        tuple: The tracks to recognize and the tracks dropped in this frame.
+        """
+
+        matched_tracks, matched_detections = set(), set()
+
+        if self.tracks and detections:
+            ious = iou_matrix([track.bbox for track in self.tracks], [bbox for bbox, _ in detections])
+
+            # Greedy assignment by decreasing IoU, enough for the few faces in front of a kiosk
+            for flat in np.argsort(-ious, axis=None):
+                t, d = np.unravel_index(flat, ious.shape)
+                if ious[t, d] < self.iou_threshold:
+                    break
+                if t in matched_tracks or d in matched_detections:
+                    continue
+
+                track = self.tracks[t]
+                bbox, score = detections[d]
+                track.confidence = score * ious[t, d]
+                track.bbox, track.score = bbox, score
+                track.missed = 0
+                track.frames_since_recognition += 1
+                matched_tracks.add(t)
+                matched_detections.add(d)
+
+        live, dropped = [], []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+            (dropped if track.missed > self.max_missed else live).append(track)
+
+        new = [Track(next(self._ids), bbox, score)
+               for d, (bbox, score) in enumerate(detections) if d not in matched_detections]
+        self.tracks = live + new
+
+        to_recognize = new + [track for track in live if track.missed == 0 and self._needs_recognition(track)]
+        return to_recognize, dropped
+
+    def _needs_recognition(self, track):
+        if track.confidence < self.min_confidence:
+            return True
+        return track.status in (None, 'unknown_person', 'no_face') and track.frames_since_recognition >= self.retry_frames
+
+    def recognized(self, track, user, status):
+
+        """
+        Store the identity computed for a track.
+        """
+
+        track.user, track.status = user, status
+        track.frames_since_recognition = 0
@@ -1,79 +1,257 @@
 
-import pytz
-import datetime
 import os
+import sys
 import csv
-import pickle
+import io
+import time
+import uuid
+import random
+import threading
 
-import face_recognition
+import cv2
+import numpy as np
 
-from anti_spoof.test import test
+# face_recognition (dlib and its models) and the anti-spoofing package (torch) take seconds to import, they
+# are imported on first use, normally by warm_up(), so importing this module stays fast
+from matcher import EmbeddingMatcher
+from storage import FileStorage, SQLiteStorage
+from result_cache import dhash
+from metrics import STAGE_LATENCY
+from profiler import trace_stage
 
+# Anti-spoofing ensemble and the device it runs on
+ANTI_SPOOF_MODEL_DIR = "./anti_spoof/resources/anti_spoof_models"
+ANTI_SPOOF_DEVICE_ID = 0
 
-def get_login_status_csv(ATTENDANCE_LOG_DIR):
+# Cross-request micro-batching of the anti-spoofing models. A batch size of 1 disables it, larger
+# values only pay off when several requests run spoof_test() at the same time.
+ANTI_SPOOF_MAX_BATCH_SIZE = 8
+ANTI_SPOOF_MAX_WAIT_MS = 5
 
+# Detector input size for group photos (about GROUP_DETECTION_SIZE x GROUP_DETECTION_SIZE pixels), larger
+# than the 192 used for single faces so the faces at the back of a classroom are still found
+GROUP_DETECTION_SIZE = 640
+
+# Shape of the synthetic frame warm_up() runs every model on
+WARM_UP_FRAME_SHAPE = (640, 480, 3)
+
+# Number of audit frames written between two retention passes over the login directory
+LOGIN_AUDIT_PRUNE_EVERY = 100
+
+# Above this many emails the section lookup of the matcher reads every user at once, not one at a time
+SECTION_LOOKUP_BATCH = 64
+
+# Resident matchers, one per database directory, loaded on first use
+_matchers = {}
+_matchers_lock = threading.Lock()
+
+# Options of every matcher get_matcher() creates, set once by configure_matchers() before the first request
+_matcher_options = {}
+
+# Storage backends, one per database directory
+_storages = {}
+_storages_lock = threading.Lock()
+
+_login_audit_writes = 0
+_login_audit_lock = threading.Lock()
+
+
+def open_storage(DB_PATH, ATTENDANCE_LOG_DIR='./logs', backend='files', sqlite_path=None):
+
+    """
+    Function to open the storage backend of a database directory.
+
+    Parameters:
+    DB_PATH (str): The database directory, also holding the registration images.
+    ATTENDANCE_LOG_DIR (str): The directory of the daily attendance CSV files ('files' backend).
+    backend (str): 'files' for the CSV/pickle layout or 'sqlite' for a SQLite database in WAL mode.
+    sqlite_path (str): The SQLite database file, defaults to '<DB_PATH>/attendance.sqlite3'.
+
+    Returns:
+    FileStorage or SQLiteStorage: The storage, also returned by get_storage(DB_PATH) from now on.
+    """
+
+    if backend == 'files':
+        storage = FileStorage(DB_PATH, ATTENDANCE_LOG_DIR)
+    elif backend == 'sqlite':
+        storage = SQLiteStorage(sqlite_path or os.path.join(DB_PATH, 'attendance.sqlite3'))
+    else:
+        raise ValueError("backend must be 'files' or 'sqlite', got {!r}".format(backend))
+
+    with _storages_lock:
+        _storages[DB_PATH] = storage
+    return storage
+
+def get_storage(DB_PATH='./db'):
+
+    """
+    Function to get the storage backend of a database directory, the file layout if none was opened.
+    """
+
+    with _storages_lock:
+        if DB_PATH not in _storages:
+            _storages[DB_PATH] = FileStorage(DB_PATH, './logs')
+        return _storages[DB_PATH]
+
+def get_registered_users(DB_PATH='./db'):
+
+    """
+    Function to get the details (name, email, phone, class, division) of every registered user.
+    """
+
+    return get_storage(DB_PATH).users()
+
+def read_manifest(text):
+
+    """
+    Function to parse the CSV manifest of a bulk enrollment.
+
+    The header names the columns: name, email, class, division and, optionally, phone_number and image
+    (the file name of the user's photo in the archive, '<email>.png' or '<email>.jpg' when missing).
+    Header names are not case sensitive and 'class_' is accepted for 'class'.
+
+    Parameters:
+    text (str): The content of the manifest.
+
+    Returns:
+    list: One dictionary per row with the keys name, email, phone_number, class, division and image.
+    """
+
+    reader = csv.DictReader(io.StringIO(text))
+    rows = []
+    for row in reader:
+        row = {(key or '').strip().lower(): (value or '').strip() for key, value in row.items()}
+        rows.append({
+            'name': row.get('name', ''),
+            'email': row.get('email', ''),
+            'phone_number': row.get('phone_number', row.get('phone', '')),
+            'class': row.get('class', row.get('class_', '')),
+            'division': row.get('division', ''),
+            'image': row.get('image', ''),
+        })
+    return rows
+
+def decode_image(contents):
+
+    """
+    Function to decode an uploaded image straight from its bytes.
+
+    Parameters:
+    contents (bytes): The encoded image (PNG, JPEG, ...) as uploaded.
+
+    Returns:
+    numpy.ndarray: The decoded BGR image, the same array cv2.imread would return for the file,
+                   or None if the bytes are not a valid image.
     """
-    Function to get the CSV file path for the current date.
 
-    This function retrieves the current date and time in the Asia/Kolkata timezone and formats it as "YYYY-MM-DD".
-    It then generates the CSV file name based on the current date and returns the complete file path.
+    if not contents:
+        return None
+    with STAGE_LATENCY.time(stage='decode'):
+        return cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+def decode_and_hash_face(contents):
+
+    """
+    Function to decode an uploaded image, detect its face and compute the perceptual hash of the face crop,
+    the key of the login result cache.
+
+    The hash only covers the face box, so another face pasted into the same scene does not look like the
+    cached frame, while the background, an overlay or a label drawn around the face do not change it.
 
     Returns:
-    str: The complete file path of the CSV file for the current date in the ATTENDANCE_LOG_DIR directory.
+    tuple: The decoded image, the [x, y, w, h] face box and the dHash of its crop. The image is None if the
+           bytes are not a valid image, the box and the hash are None if no face is found.
     """
 
-    # Get the current date and time in the Asia/Kolkata timezone
-    local_timezone = pytz.timezone('Asia/Kolkata')
-    current_datetime = datetime.datetime.now(local_timezone)
+    image = decode_image(contents)
+    if image is None:
+        return None, None, None
 
-    # Format the current date as "YYYY-MM-DD"
-    formatted_date = current_datetime.strftime("%Y-%m-%d")
+    bbox = detect_face(image)
+    if bbox is None:
+        return image, None, None
 
-    # Generate the CSV file name for the current date and return the complete file path
-    return os.path.join(ATTENDANCE_LOG_DIR, f"{formatted_date}.csv")
+    x, y, w, h = (int(value) for value in bbox)
+    crop = image[max(y, 0):max(y + h, 0), max(x, 0):max(x + w, 0)]
+    return image, bbox, dhash(crop) if crop.size else None
 
-def get_logged_in_users(ATTENDANCE_LOG_DIR):
-    logged_in_users = {}
+def save_login_frame(contents, LOGIN_DIR, sample_rate, retention_days, max_files):
 
-    LOGIN_STATUS_CSV = get_login_status_csv(ATTENDANCE_LOG_DIR)
-    if os.path.exists(LOGIN_STATUS_CSV):
-        with open(LOGIN_STATUS_CSV, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                email_id, login_time, is_logged_in = row
-                # Convert the is_logged_in value to a boolean
-                logged_in_users[email_id] = is_logged_in == "IN"
+    """
+    Function to persist a sampled share of the login frames for auditing.
+
+    Meant to run as a background task after the response is sent. Every LOGIN_AUDIT_PRUNE_EVERY writes,
+    the retention policy is applied to the login directory.
 
-    return logged_in_users
+    Parameters:
+    contents (bytes): The uploaded image.
+    LOGIN_DIR (str): The directory of the audit frames.
+    sample_rate (float): Share of the frames to keep, between 0 (none) and 1 (all).
+    retention_days (float): Frames older than this are deleted.
+    max_files (int): Only the most recent max_files frames are kept.
+    """
 
-def get_registered_users():
-    registered_users = []
+    global _login_audit_writes
 
-    USERS_CSV = r".db\user_details.csv"
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return
 
-    if os.path.exists(USERS_CSV):
-        with open(USERS_CSV, newline='') as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                user = {}
-                name, email, phone, class_, division, _, _ = row
-                # Convert the is_logged_in value to a boolean
-                user["name"] = name
-                user["email"] = email
-                user["phone"] = phone
-                user["class"] = class_
-                user["division"] = division
-                registered_users.append(user)
+    # Timestamp first so the file names sort by age
+    file_name = '{}_{}.png'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4())
+    with open(os.path.join(LOGIN_DIR, file_name), 'wb') as f:
+        f.write(contents)
 
-    return registered_users
+    with _login_audit_lock:
+        _login_audit_writes += 1
+        prune = _login_audit_writes % LOGIN_AUDIT_PRUNE_EVERY == 0
 
-def spoof_test(image):
+    if prune:
+        prune_login_frames(LOGIN_DIR, retention_days, max_files)
+
+def prune_login_frames(LOGIN_DIR, retention_days, max_files):
+
+    """
+    Function to apply the retention policy of the login audit frames.
+
+    Deletes the frames older than retention_days, then the oldest frames beyond max_files.
+
+    Returns:
+    int: The number of deleted frames.
+    """
+
+    entries = []
+    for entry in os.scandir(LOGIN_DIR):
+        if entry.is_file():
+            entries.append((entry.stat().st_mtime, entry.path))
+    entries.sort()
+
+    cutoff = time.time() - retention_days * 24 * 3600
+    expired = [path for mtime, path in entries if mtime < cutoff]
+    kept = len(entries) - len(expired)
+    if kept > max_files:
+        expired += [path for _, path in entries[len(expired):len(expired) + kept - max_files]]
+
+    for path in expired:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return len(expired)
+
+def _spoof_engine_options():
+    # Passed by every call into the anti-spoofing package, whichever call creates the engine
+    return dict(max_batch_size=ANTI_SPOOF_MAX_BATCH_SIZE, max_wait_ms=ANTI_SPOOF_MAX_WAIT_MS)
+
+def spoof_test(image, bbox=None):
 
     """
     Function to perform anti-spoofing test on an input image.
 
     Parameters:
         image (image array): The input image to be tested.
+        bbox (list): The [x, y, w, h] face box already found in the image by detect_face(), so the
+                     detector does not run a second time. Detected here when missing.
 
     Returns:
         str: The label of the test result (either "real" or "spoof").
@@ -84,30 +262,176 @@ def spoof_test(image):
     #   - image: The input image to be tested.
     #   - model_dir: The directory containing the anti-spoofing models.
     #   - device_id: The ID of the device (e.g., GPU) to use for inference.
-    label = test(image=image,
-                    model_dir="./anti_spoof/resources/anti_spoof_models",
-                    device_id=0)
+    #   - image_bbox: The face box found by the request's detection stage, if any.
+    from anti_spoof.test import test
+
+    with STAGE_LATENCY.time(stage='spoof'), trace_stage('spoof'):
+        label = test(image=image,
+                        model_dir=ANTI_SPOOF_MODEL_DIR,
+                        device_id=ANTI_SPOOF_DEVICE_ID,
+                        image_bbox=bbox,
+                        **_spoof_engine_options())
     return label
 
+def load_spoof_engine():
+
+    """
+    Function to load the anti-spoofing detector and models ahead of the first request.
+
+    The engine is created once and shared by every later spoof_test() call, so model loading is not
+    part of the per-request cost.
+
+    Returns:
+    AntiSpoofEngine: The resident anti-spoofing engine.
+    """
+
+    from anti_spoof.test import get_engine
+
+    return get_engine(ANTI_SPOOF_MODEL_DIR, ANTI_SPOOF_DEVICE_ID, **_spoof_engine_options())
+
 
-def user_already_registered(email: str) -> bool:
+def warm_up():
+
+    """
+    Function to load and exercise every model once, before the first request.
+
+    Imports face_recognition (dlib) and the anti-spoofing package (torch), loads the RetinaFace detector and
+    the anti-spoofing models, then runs the detection, the face encoding and every anti-spoofing model on a
+    synthetic frame at a fixed face box. The first request then finds the modules imported, the weights
+    loaded and the first-call allocations of torch and dlib done.
+
+    Returns:
+    dict: The seconds spent importing ('import_s'), loading the models ('load_s') and running them on the
+          synthetic frame ('exercise_s').
+    """
+
+    timings = {}
+
+    start = time.perf_counter()
+    import face_recognition  # noqa: F401 (loads the dlib models)
+    import anti_spoof.test  # noqa: F401 (imports torch)
+    timings['import_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_spoof_engine()
+    timings['load_s'] = time.perf_counter() - start
+
+    # Random pixels, the detector finds no face in them so the other models run at a fixed box
+    start = time.perf_counter()
+    frame = np.random.default_rng(0).integers(0, 256, WARM_UP_FRAME_SHAPE, dtype=np.uint8)
+    height, width = frame.shape[:2]
+    bbox = [width // 4, height // 4, width // 2, height // 2]
+    detect_faces(frame)
+    encode_faces_at(frame, [bbox])
+    spoof_test(frame, bbox)
+    timings['exercise_s'] = time.perf_counter() - start
+
+    return timings
+
+def spoof_queue_depths():
+
+    """
+    Function to read the queue depth of every anti-spoofing micro-batcher, without importing the
+    anti-spoofing package when no model is loaded yet.
+    """
+
+    if 'anti_spoof.test' not in sys.modules:
+        return {}
+    return sys.modules['anti_spoof.test'].batcher_queue_depths()
+
+def user_already_registered(email: str, DB_PATH='./db') -> bool:
 
     """
     Function to check if a user with the given email is already registered.
 
     Parameters:
     email (str): The email of the user to check.
+    DB_PATH (str): The database directory.
 
     Returns:
-    bool: True if a user with the given email is found in the 'user_details.csv' file, False otherwise.
+    bool: True if a user with the given email is found in the storage, False otherwise.
     """
 
-    registered_users = get_registered_users()
+    return get_storage(DB_PATH).user_exists(email)
 
-    if email in [user['email'] for user in registered_users]:
-        return True
-    
-    return False
+def section_lookup(DB_PATH):
+
+    """
+    Function to make the lookup of the (class, division) sections of users in the storage of DB_PATH.
+
+    The matcher calls it with every email on its first scoped search and with the new ones on every
+    registration after it, to keep the sub-index of every section used by scoped searches.
+
+    Returns:
+    callable: Takes a list of emails and returns their (class, division), (None, None) for unknown users.
+    """
+
+    storage = get_storage(DB_PATH)
+
+    def sections(emails):
+        if len(emails) > SECTION_LOOKUP_BATCH:
+            find = {user["email"]: user for user in storage.users()}.get
+        else:
+            find = storage.get_user
+        return [(user["class"], user["division"]) if user is not None else (None, None)
+                for user in map(find, emails)]
+
+    return sections
+
+def configure_matchers(shared_path=None, **options):
+
+    """
+    Function to set the options of the resident matchers, before the first call to get_matcher().
+
+    Every caller of get_matcher() then gets a matcher built with them, whichever request or the warm-up
+    creates it first.
+
+    Parameters:
+    shared_path (str): Segment file of a registry shared between processes, None for a private matcher.
+    **options: Keyword arguments of EmbeddingMatcher (index, nprobe, precision, ...).
+    """
+
+    with _matchers_lock:
+        _matcher_options.clear()
+        _matcher_options.update(options, shared_path=shared_path)
+
+def get_matcher(DB_PATH, **options):
+
+    """
+    Function to get the resident embedding matcher for a database directory.
+
+    The embeddings are read from the storage of DB_PATH only once, the first time this function is
+    called for that directory. Later registrations must be added to the returned matcher with `add()`.
+
+    With shared_path the matcher maps the embeddings from a segment file shared by every process using
+    the same path (shared_registry.SharedEmbeddingMatcher): only the first process reads the storage and
+    the registrations made by any process are visible to all of them.
+
+    Parameters:
+    DB_PATH (str): The database directory.
+    **options: shared_path and keyword arguments of EmbeddingMatcher (index, nprobe, ...) overriding the
+               ones of configure_matchers(), only used when the matcher is created by this call. The
+               sections default to the ones of the storage (section_lookup).
+
+    Returns:
+    EmbeddingMatcher: The matcher holding every enrolled embedding of DB_PATH, up to date with the
+                      registrations of the other processes.
+    """
+
+    with _matchers_lock:
+        if DB_PATH not in _matchers:
+            options = {**_matcher_options, **options}
+            shared_path = options.pop('shared_path', None)
+            options.setdefault('sections', section_lookup(DB_PATH))
+            if shared_path is None:
+                _matchers[DB_PATH] = EmbeddingMatcher(**options).load_arrays(*get_storage(DB_PATH).load_embeddings())
+            else:
+                # Imported here, the shared segment relies on POSIX file locks
+                from shared_registry import SharedEmbeddingMatcher
+                _matchers[DB_PATH] = SharedEmbeddingMatcher(shared_path, **options).attach(
+                    get_storage(DB_PATH).load_embeddings)
+        matcher = _matchers[DB_PATH]
+    return matcher.refresh()
 
 def recognize(img, DB_PATH):
 
@@ -115,7 +439,9 @@ def recognize(img, DB_PATH):
     Function to recognize a person's face using face_recognition library.
 
     Given an image (img) as input, this function extracts the face embeddings from the image and compares them
-    with the embeddings of known users stored in the database (DB_PATH). It assumes there will be at most one match in the database.
+    with the embeddings of known users stored in the database (DB_PATH). The comparison is a single vectorized
+    search over the resident embedding matrix, and the closest user is accepted if it is within the
+    face_recognition default tolerance of 0.6.
 
     Parameters:
     img (numpy.ndarray): The image containing the face to be recognized.
@@ -125,48 +451,272 @@ def recognize(img, DB_PATH):
            If a match is found, the tuple contains the person's name and True. Otherwise, it contains 'unknown_person' and False.
     """
     
-    # It is assumed there will be at most 1 match in the db
-    # Extract the face embeddings from the input image
-    embeddings_unknown = face_recognition.face_encodings(img)
+    # Find the face once and extract its embedding at that box
+    _, embeddings_unknown = locate_and_encode_face(img)
 
     # Check if any face embeddings are extracted from the image
-    if len(embeddings_unknown) == 0:
+    if embeddings_unknown is None:
 
         # If no face embeddings are found, return 'no_persons_found' and False
         return 'no_persons_found', False
-    
-    else:
-        # Take the extracted face embedding
-        embeddings_unknown = embeddings_unknown[0]
 
-    # Initialize variables for matching and indexing through the database
-    match = False
-    j = 0
+    return match_embedding(embeddings_unknown, DB_PATH)
+
+def encode_face(img, bbox=None):
+
+    """
+    Function to extract the face embedding of the first face found in an image.
+
+    This is the CPU heavy part of recognize() and does not depend on the database, so it can run in a
+    separate worker process.
+
+    Parameters:
+    img (numpy.ndarray): The image containing the face to be recognized.
+    bbox (list): The [x, y, w, h] face box found by detect_face(). Without it face_recognition searches
+                 the image with its own HOG detector.
+
+    Returns:
+    numpy.ndarray: The 128-d face embedding, or None if no face is found in the image.
+    """
+
+    if bbox is not None:
+        return encode_faces_at(img, [bbox])[0]
+
+    import face_recognition
+
+    with STAGE_LATENCY.time(stage='encode'), trace_stage('encode'):
+        embeddings = face_recognition.face_encodings(img)
+    if len(embeddings) == 0:
+        return None
+    return embeddings[0]
+
+def detect_face(img):
+
+    """
+    Function to run the request's single face detection.
+
+    The RetinaFace detector of the anti-spoofing engine runs once and its box is shared by the face
+    encoding (as a known face location) and by the anti-spoofing crops, instead of each of them
+    searching the image again.
+
+    Parameters:
+    img (numpy.ndarray): The decoded image, as uploaded.
+
+    Returns:
+    list: The [x, y, w, h] box of the most confident face, or None if no face is found.
+    """
+
+    detections = detect_faces(img)
+    if not detections:
+        return None
+    return detections[0][0]
+
+def locate_and_encode_face(img):
+
+    """
+    Function to detect the face of an image once and extract its embedding at that box.
+
+    Returns:
+    tuple: The [x, y, w, h] face box and the 128-d embedding, or (None, None) if no face is found.
+    """
+
+    bbox = detect_face(img)
+    if bbox is None:
+        return None, None
+    return bbox, encode_face(img, bbox)
+
+def enroll_image(contents):
+
+    """
+    Function to run the whole enrollment pipeline of one image: decode, anti-spoofing test and face encoding.
+
+    Only takes and returns picklable values, so bulk enrollment can spread the images over the worker pool
+    whether it holds threads or processes.
+
+    Parameters:
+    contents (bytes): The encoded image (PNG, JPEG, ...).
+
+    Returns:
+    tuple: A status ('ok', 'invalid_image', 'spoof' or 'no_face') and the list of face embeddings.
+    """
+
+    image = decode_image(contents)
+    if image is None:
+        return 'invalid_image', []
+
+    # One detection shared by the anti-spoofing test and the encoding, photos without a face stop here
+    bbox = detect_face(image)
+    if bbox is None:
+        return 'no_face', []
+
+    if spoof_test(image, bbox) != 1:
+        return 'spoof', []
+
+    return 'ok', encode_faces_at(image, [bbox])
+
+def bbox_to_location(bbox):
+
+    """
+    Function to convert a detector box [x, y, w, h] to a face_recognition location (top, right, bottom, left).
+    """
+
+    x, y, w, h = bbox
+    return y, x + w - 1, y + h - 1, x
+
+def encode_faces(img):
+
+    """
+    Function to find every face of a group photo and extract all their embeddings in one call.
+
+    The faces are found once with the RetinaFace detector of the anti-spoofing engine and the same boxes
+    are given to face_recognition, so the image is not searched for faces a second time.
+
+    Parameters:
+    img (numpy.ndarray): The group photo.
+
+    Returns:
+    tuple: The [x, y, w, h] box of every face and the list of their 128-d embeddings, in the same order.
+    """
+
+    bboxes = [bbox for bbox, _ in detect_faces(img, GROUP_DETECTION_SIZE)]
+    return bboxes, encode_faces_at(img, bboxes)
+
+def encode_faces_at(img, bboxes):
+
+    """
+    Function to extract the embeddings of the faces at known [x, y, w, h] boxes in one call.
+    """
+
+    import face_recognition
+
+    if not bboxes:
+        return []
+    with STAGE_LATENCY.time(stage='encode'), trace_stage('encode'):
+        return face_recognition.face_encodings(img, known_face_locations=[bbox_to_location(bbox) for bbox in bboxes])
+
+def detect_faces(img, input_size=192):
+
+    """
+    Function to run only the RetinaFace detector, without any encoding or anti-spoofing work.
+
+    Returns:
+    list: The ([x, y, w, h], confidence) of every face found in the image.
+    """
 
-    # Get a sorted list of files ending with '.pickle' in the database directory
-    db_dir = sorted([j for j in os.listdir(DB_PATH) if j.endswith('.pickle')])
+    with STAGE_LATENCY.time(stage='detect'):
+        return load_spoof_engine().get_detections(img, input_size)
 
-    # Loop through the database embeddings and compare them with the input image embeddings
-    while ((not match) and (j < len(db_dir))):
+def detect_frame(contents, input_size=192):
 
-        # Get the path to the database pickle file
-        path_ = os.path.join(DB_PATH, db_dir[j])
+    """
+    Function to decode a stream frame and run only the RetinaFace detector on it, the cheap per-frame step
+    of stream tracking.
+
+    Returns:
+    list: The ([x, y, w, h], confidence) of every face found in the frame, or None if it is not a valid image.
+    """
 
-        # Load the embeddings from the database pickle file
-        file = open(path_, 'rb')
+    image = decode_image(contents)
+    if image is None:
+        return None
+    return detect_faces(image, input_size)
 
-        embeddings = pickle.load(file)[0]
+def analyze_frame(contents, bboxes):
 
-        # Compare the embeddings from the database with the input image embeddings
-        match = face_recognition.compare_faces([embeddings], embeddings_unknown)[0]
+    """
+    Function to run the expensive stages, encoding and anti-spoofing, on the faces of a stream frame at
+    known boxes.
+
+    The frame is decoded again from its bytes instead of being passed around, so a process pool only has
+    to move the compressed frame.
 
-        # Move to the next index
-        j += 1
+    Returns:
+    tuple: The 128-d embedding and the anti-spoofing label (1 for a real face) of every face, in box order.
+    """
+
+    image = decode_image(contents)
+    return encode_faces_at(image, bboxes), spoof_test_faces(image, bboxes)
+
+def spoof_test_faces(image, bboxes):
+
+    """
+    Function to perform the anti-spoofing test on several faces of one image.
+
+    Parameters:
+        image (image array): The group photo, as decoded (not resized).
+        bboxes (list): The [x, y, w, h] box of every face to test.
+
+    Returns:
+        list: The label of every face, 1 for a real face.
+    """
+
+    from anti_spoof.test import test_faces
+
+    with STAGE_LATENCY.time(stage='spoof'), trace_stage('spoof'):
+        results = test_faces(image=image,
+                             image_bboxes=bboxes,
+                             model_dir=ANTI_SPOOF_MODEL_DIR,
+                             device_id=ANTI_SPOOF_DEVICE_ID,
+                             **_spoof_engine_options())
+    return [result["label"] for result in results]
+
+def match_embeddings(embeddings, DB_PATH, scope=None, fallback=False):
+
+    """
+    Function to look up several face embeddings in the resident matcher of DB_PATH with one query.
+
+    Parameters:
+    scope (tuple): Only search these (class, division) sections (see matcher.in_scope), None for everyone.
+    fallback (bool): Search everyone for the faces without a match in the scope.
+
+    Returns:
+    list: One (email, match status, distance) tuple per embedding, 'unknown_person' when there is no match.
+    """
+
+    matcher = get_matcher(DB_PATH)
+    with STAGE_LATENCY.time(stage='match'):
+        matches = matcher.match_many(embeddings, scope, fallback)
+    return [(email_id, True, distance) if distance <= matcher.tolerance else ('unknown_person', False, distance)
+            for email_id, distance in matches]
+
+def match_embedding(embedding, DB_PATH, scope=None, fallback=False):
+
+    """
+    Function to look up a face embedding in the resident matcher of DB_PATH.
+
+    Parameters:
+    embedding (numpy.ndarray): The 128-d face embedding to look up.
+    DB_PATH (str): The database directory.
+    scope (tuple): Only search these (class, division) sections (see matcher.in_scope), None for everyone.
+    fallback (bool): Search everyone when no user of the scope matches.
+
+    Returns:
+    tuple: The recognized person's email and True, or 'unknown_person' and False.
+    """
+
+    # Search the whole database (or the scope) in one go and keep the closest user
+    matcher = get_matcher(DB_PATH)
+    with STAGE_LATENCY.time(stage='match'):
+        email_id, distance = matcher.match(embedding, scope, fallback)
 
     # Check if a match is found and return the recognized person's name and match status
-    if match:
-        return db_dir[j - 1][:-7], True
+    if distance <= matcher.tolerance:
+        return email_id, True
     
     else:
         return 'unknown_person', False
 
+def confirm_match(embedding, email, DB_PATH):
+
+    """
+    Function to check that a face embedding is within tolerance of the enrolled embedding of one user.
+
+    Costs one distance instead of a search, it confirms a match reused from the login result cache.
+
+    Returns:
+    bool: True if the user is enrolled and the embedding matches it.
+    """
+
+    matcher = get_matcher(DB_PATH)
+    with STAGE_LATENCY.time(stage='match'):
+        return matcher.distance_to(email, embedding) <= matcher.tolerance
@@ -0,0 +1,159 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import profiler
+
+
+# Worker pool used for the CPU heavy stages (decode, face encoding, anti-spoofing).
+# 'thread' shares the resident models between workers, 'process' gives every worker its own copy
+# of the models and sidesteps the GIL for the Python parts of the pipeline.
+WORKER_POOL_KIND = 'thread'
+WORKER_POOL_SIZE = os.cpu_count() or 1
+
+_pool = None
+_pool_kind = None
+_pool_size = 0
+
+# Tasks submitted through run_cpu() and not finished yet, queued or running
+_pending = 0
+
+
+def _init_process_worker():
+
+    """
+    Initializer of the process pool workers: load and exercise every model once so no request pays for it.
+    """
+
+    import torch
+
+    import utils
+
+    # One intra-op thread per process, the pool already provides the parallelism. A worker only
+    # handles one request at a time, so there is nothing to micro-batch either.
+    torch.set_num_threads(1)
+    utils.ANTI_SPOOF_MAX_BATCH_SIZE = 1
+    utils.warm_up()
+
+
+def start_pool(kind=None, size=None):
+
+    """
+    Function to create the worker pool used by run_cpu().
+
+    Parameters:
+    kind (str): 'thread' for a ThreadPoolExecutor or 'process' for a ProcessPoolExecutor,
+                defaults to WORKER_POOL_KIND.
+    size (int): Number of workers, defaults to WORKER_POOL_SIZE.
+
+    Returns:
+    concurrent.futures.Executor: The worker pool.
+    """
+
+    global _pool, _pool_kind, _pool_size
+
+    kind = kind or WORKER_POOL_KIND
+    size = size or WORKER_POOL_SIZE
+    _pool_kind, _pool_size = kind, size
+
+    if kind == 'thread':
+        _pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix='cpu-worker')
+    elif kind == 'process':
+        # spawn instead of fork, forking a process that already runs torch threads is not safe
+        _pool = ProcessPoolExecutor(max_workers=size, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=_init_process_worker)
+
+        # Workers are spawned on demand, submit one no-op per worker so they all load their models now
+        for _ in range(size):
+            _pool.submit(int)
+    else:
+        raise ValueError("kind must be 'thread' or 'process', got {!r}".format(kind))
+
+    return _pool
+
+
+def shutdown_pool():
+
+    """
+    Function to stop the worker pool, waiting for the running tasks to finish.
+    """
+
+    global _pool
+
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+async def run_cpu(fn, *args, **kwargs):
+
+    """
+    Run a CPU heavy function in the worker pool without blocking the event loop.
+
+    With a process pool, fn and its arguments must be picklable and fn must not rely on state of
+    the main process such as the resident embedding matcher.
+    """
+
+    global _pending
+
+    pool = _pool or start_pool()
+    loop = asyncio.get_running_loop()
+
+    # Only changed from the event loop thread, no lock needed
+    _pending += 1
+    try:
+        return await _run(loop, pool, functools.partial(fn, *args, **kwargs))
+    finally:
+        _pending -= 1
+
+
+async def warm_up_pool(fn):
+
+    """
+    Run fn (a warm-up function) where the requests will run: once with a thread pool, whose workers share
+    the models of the main process, and as many times as there are workers with a process pool, so every
+    worker is spawned and has run its initializer when this returns.
+
+    Returns:
+    list: The results of every call.
+    """
+
+    if _pool is None:
+        start_pool()
+    count = _pool_size if _pool_kind == 'process' else 1
+    return await asyncio.gather(*(run_cpu(fn) for _ in range(count)))
+
+
+def pending_tasks():
+
+    """
+    Return the number of run_cpu() tasks waiting for or running in the worker pool.
+    """
+
+    return _pending
+
+
+async def run_io(fn, *args, **kwargs):
+
+    """
+    Run a blocking function that needs the main process state (file writes, matcher updates)
+    in the event loop's default thread pool.
+    """
+
+    loop = asyncio.get_running_loop()
+    return await _run(loop, None, functools.partial(fn, *args, **kwargs))
+
+
+async def _run(loop, pool, call):
+    # A request sampled by the profiler runs its calls under cProfile in the executor and adds their
+    # statistics to its route's
+    profile = profiler.current()
+    if profile is None:
+        return await loop.run_in_executor(pool, call)
+
+    result, stats, allocations = await loop.run_in_executor(
+        pool, functools.partial(profiler.profiled_call, call, profile.trace_memory))
+    profile.add(stats, allocations)
+    return result